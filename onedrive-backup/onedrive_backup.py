@@ -1,26 +1,1472 @@
 import os
+import io
+import sys
 import shutil
 from pathlib import Path
 from datetime import datetime
 import json
 import getpass
+import argparse
+import time
+import base64
+import hashlib
+import re
+import copy
+import fnmatch
+import sqlite3
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from array import array
+from bisect import bisect_left
 import requests
 import webbrowser
-from urllib.parse import urljoin, urlparse, parse_qs
+from urllib.parse import urljoin, urlparse, parse_qs, quote
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None  # Optional: only needed to cache the login between runs
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None  # Optional: only needed for encrypted backups
+
+class CompactIdIndex:
+    """Memory-compact membership index for downloaded item IDs
+
+    Graph item IDs are long strings, so a Python set of them costs gigabytes at
+    tens of millions of items. Each ID is reduced to a 64-bit blake2b digest and
+    kept in a sorted array (8 bytes per item) searched with bisect. Recent
+    additions live in a small set and are appended to a journal file, so saving
+    progress every few files never rewrites the whole index.
+
+    Two IDs sharing a digest would make the second one look downloaded and it
+    would be skipped. With n items the chance of any such collision is about
+    n² / 2**65: 3 in a million at 10 million items, 3 in 10,000 at 100 million.
+    """
+    INDEX_NAME = ".progress.idx"
+    JOURNAL_NAME = ".progress.journal"
+    MAGIC = b"ODIDX001"
+
+    def __init__(self):
+        self._sorted = array('Q')
+        self._pending = set()
+        self._unsaved = []
+        self._journal_count = 0
+
+    @staticmethod
+    def hash_id(item_id):
+        """Reduce an item ID to a 64-bit integer key"""
+        digest = hashlib.blake2b(item_id.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def __len__(self):
+        return len(self._sorted) + len(self._pending)
+
+    def __contains__(self, item_id):
+        key = self.hash_id(item_id)
+        if key in self._pending:
+            return True
+        pos = bisect_left(self._sorted, key)
+        return pos < len(self._sorted) and self._sorted[pos] == key
+
+    def add(self, item_id):
+        """Mark an item ID as downloaded"""
+        self._add_key(self.hash_id(item_id))
+
+    def update(self, item_ids):
+        """Mark several item IDs as downloaded"""
+        for item_id in item_ids:
+            self.add(item_id)
+
+    def _add_key(self, key, journal=True):
+        if key in self._pending:
+            return
+        pos = bisect_left(self._sorted, key)
+        if pos < len(self._sorted) and self._sorted[pos] == key:
+            return
+        self._pending.add(key)
+        if journal:
+            self._unsaved.append(key)
+        # Merge geometrically so the total merge cost stays linear in the item count
+        if len(self._pending) > max(65536, len(self._sorted) // 16):
+            self._compact()
+
+    def _compact(self):
+        """Fold pending keys into the sorted array
+
+        Only the pending keys are sorted. The stored keys are copied into the
+        new array in runs between them, straight from the old buffer, so they
+        never become Python ints.
+        """
+        if not self._pending:
+            return
+        merged = array('Q')
+        width = self._sorted.itemsize
+        with memoryview(self._sorted).cast('B') as stored:
+            start = 0
+            for key in sorted(self._pending):
+                pos = bisect_left(self._sorted, key, start)
+                merged.frombytes(stored[start * width:pos * width])
+                merged.append(key)
+                start = pos
+            merged.frombytes(stored[start * width:])
+        self._sorted = merged
+        self._pending = set()
+
+    @staticmethod
+    def _to_bytes(values):
+        data = array('Q', values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data.tobytes()
+
+    @staticmethod
+    def _from_bytes(raw):
+        data = array('Q')
+        data.frombytes(raw[:len(raw) - len(raw) % 8])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        return data
+
+    def save(self, folder, full=False):
+        """Persist new keys to the journal, or rewrite the whole index when full=True"""
+        folder = Path(folder)
+        index_file = folder / self.INDEX_NAME
+        journal_file = folder / self.JOURNAL_NAME
+
+        # Rewrite the index once the journal grows, keeping resume replay short
+        if self._journal_count + len(self._unsaved) > max(65536, len(self._sorted) // 4):
+            full = True
+
+        if full or not index_file.exists():
+            self._compact()
+            tmp_file = index_file.with_suffix('.tmp')
+            with open(tmp_file, 'wb') as f:
+                f.write(self.MAGIC)
+                f.write(self._to_bytes(self._sorted))
+            os.replace(tmp_file, index_file)
+            if journal_file.exists():
+                journal_file.unlink()
+            self._journal_count = 0
+        elif self._unsaved:
+            with open(journal_file, 'ab') as f:
+                f.write(self._to_bytes(self._unsaved))
+            self._journal_count += len(self._unsaved)
+        self._unsaved = []
+
+    @classmethod
+    def load(cls, folder):
+        """Load the index and replay the journal from a backup folder"""
+        folder = Path(folder)
+        index = cls()
+        index_file = folder / cls.INDEX_NAME
+        journal_file = folder / cls.JOURNAL_NAME
+
+        if index_file.exists():
+            with open(index_file, 'rb') as f:
+                raw = f.read()
+            if raw[:len(cls.MAGIC)] == cls.MAGIC:
+                index._sorted = cls._from_bytes(raw[len(cls.MAGIC):])
+        if journal_file.exists():
+            with open(journal_file, 'rb') as f:
+                # A torn trailing record from a crash is dropped by _from_bytes
+                journal = cls._from_bytes(f.read())
+            for key in journal:
+                index._add_key(key, journal=False)
+            index._journal_count = len(journal)
+        index._compact()
+        return index
+
+    @classmethod
+    def remove_files(cls, folder):
+        """Delete the index files from a backup folder"""
+        for name in (cls.INDEX_NAME, cls.JOURNAL_NAME):
+            path = Path(folder) / name
+            if path.exists():
+                path.unlink()
+
+
+QUICKXOR_WIDTH = 160
+QUICKXOR_BLOCK = QUICKXOR_WIDTH * 8192
+
+def quickxor_hash(path):
+    """Compute the OneDrive quickXorHash of a backed-up file (base64, as Graph reports it)"""
+    # The byte at offset i is XORed into a 160-bit circular register at bit
+    # (i * 11) % 160, which only depends on i % 160. XOR-folding each block
+    # down to 160 bytes collapses it to one byte per register position, so the
+    # per-byte work happens in big-integer operations instead of a Python loop.
+    lanes = 0
+    length = 0
+    with path.open('rb') as f:
+        while True:
+            block = f.read(QUICKXOR_BLOCK)
+            if not block:
+                break
+            length += len(block)
+            if len(block) < QUICKXOR_BLOCK:
+                # Zero padding leaves the XOR unchanged
+                block = block + bytes(QUICKXOR_BLOCK - len(block))
+            value = int.from_bytes(block, 'little')
+            width = QUICKXOR_BLOCK * 8
+            while width > QUICKXOR_WIDTH * 8:
+                width //= 2
+                value = (value >> width) ^ (value & ((1 << width) - 1))
+            lanes ^= value
+    
+    register = 0
+    mask = (1 << QUICKXOR_WIDTH) - 1
+    for index, byte in enumerate(lanes.to_bytes(QUICKXOR_WIDTH, 'little')):
+        if byte:
+            shift = (index * 11) % QUICKXOR_WIDTH
+            register ^= ((byte << shift) | (byte >> (QUICKXOR_WIDTH - shift))) & mask
+    
+    digest = bytearray(register.to_bytes(20, 'little'))
+    for index, byte in enumerate(length.to_bytes(8, 'little')):
+        digest[12 + index] ^= byte
+    return base64.b64encode(bytes(digest)).decode('ascii')
+
+
+def sha1_hash(path):
+    """Compute the hex SHA-1 of a backed-up file"""
+    sha1 = hashlib.sha1()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_backup_file(task):
+    """Process-pool worker: check one (rel_path, source, algorithm, expected) task"""
+    rel_path, source, algorithm, expected = task
+    try:
+        if algorithm == 'quickXorHash':
+            return rel_path, quickxor_hash(source) == expected
+        return rel_path, sha1_hash(source) == expected.lower()
+    except (OSError, ValueError):  # ValueError: encrypted chunk failed authentication
+        return rel_path, False
+
+
+class GraphThrottle:
+    """
+    Throttling control shared by every Graph request of a run.
+    
+    Caps the number of requests in flight and, when Graph answers 429 or 503,
+    makes all workers wait out the Retry-After interval together instead of
+    each one retrying into the throttle.
+    """
+    RETRY_STATUSES = (429, 503)
+    
+    def __init__(self, max_concurrent=4, max_retries=5):
+        self.max_retries = max_retries
+        self.throttled_count = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+    
+    def wait(self):
+        """Block until any active back-off period is over"""
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+    
+    def back_off(self, response, attempt):
+        """Start a shared back-off period from a throttled response"""
+        try:
+            delay = float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            delay = min(60, 2 ** (attempt + 1))
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.time() + delay)
+            self.throttled_count += 1
+        return delay
+    
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying throttled responses after the shared back-off"""
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            with self._slots:
+                response = requests.request(method, url, **kwargs)
+            if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            delay = self.back_off(response, attempt)
+            print(f"\n⏳ Throttled by OneDrive ({response.status_code}), waiting {delay:.0f}s...")
+        return response
+    
+    @contextmanager
+    def stream(self, method, url, **kwargs):
+        """
+        Send a streamed request for use in a with block.
+        
+        The request slot is held until the block has read the body, so the
+        cap also limits concurrent downloads. Throttled responses are closed
+        before retrying, and the final response is closed when the block
+        exits, so its pooled connection is always returned.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            with self._slots:
+                response = requests.request(method, url, stream=True, **kwargs)
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                    try:
+                        yield response
+                    finally:
+                        response.close()
+                    return
+                response.close()
+            delay = self.back_off(response, attempt)
+            print(f"\n⏳ Throttled by OneDrive ({response.status_code}), waiting {delay:.0f}s...")
+
+
+class UploadSessions:
+    """
+    Upload URLs of a restore's unfinished upload sessions, by remote path.
+    
+    Restore workers add and finish sessions while the main thread saves
+    them for a later resume, so every access goes through one lock.
+    """
+    
+    def __init__(self, sessions=None):
+        self._sessions = dict(sessions or {})
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+    
+    def get(self, remote_path):
+        with self._lock:
+            return self._sessions.get(remote_path)
+    
+    def start(self, remote_path, upload_url):
+        with self._lock:
+            self._sessions[remote_path] = upload_url
+    
+    def finish(self, remote_path):
+        with self._lock:
+            self._sessions.pop(remote_path, None)
+    
+    def snapshot(self):
+        """Copy of the sessions, for saving"""
+        with self._lock:
+            return dict(self._sessions)
+
+
+class PackedFile:
+    """A small file stored inside a pack, readable like a Path via open() and stat()"""
+    
+    def __init__(self, pack_path, offset, size):
+        self.pack_path = pack_path
+        self.offset = offset
+        self.size = size
+    
+    def read_bytes(self):
+        with open(self.pack_path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.size)
+    
+    def open(self, mode='rb'):
+        # Packed files are below the pack threshold, so holding one in memory is cheap
+        return io.BytesIO(self.read_bytes())
+    
+    def stat(self):
+        return os.stat_result((0, 0, 0, 1, 0, 0, self.size, 0, 0, 0))
+
+
+class PackStore:
+    """
+    Append-only pack files for small backup files.
+    
+    Writing hundreds of thousands of small files to exFAT or NAS targets is
+    dominated by per-file metadata operations. Files below the threshold are
+    appended to large pack files instead, with one index line per file
+    recording where its bytes live. Later index lines win, so a file packed
+    again on resume simply replaces the earlier copy.
+    """
+    PACK_DIR = "_packs"
+    INDEX_NAME = "index.jsonl"
+    DEFAULT_THRESHOLD = 1024 * 1024
+    PACK_SIZE = 512 * 1024 * 1024  # Well below the FAT32 4 GB file limit
+    
+    def __init__(self, backup_root, threshold=DEFAULT_THRESHOLD):
+        self.backup_root = Path(backup_root)
+        self.threshold = threshold
+        self.pack_dir = self.backup_root / self.PACK_DIR
+        self._lock = threading.Lock()
+        self._pack = None
+        self._pack_number = 0
+        self._index = None
+    
+    def wants(self, size):
+        """Check whether a file of this size belongs in a pack"""
+        return size < self.threshold
+    
+    def _open_pack(self):
+        self.pack_dir.mkdir(exist_ok=True)
+        if self._index is None:
+            self._index = open(self.pack_dir / self.INDEX_NAME, 'a', encoding='utf-8')
+            existing = sorted(self.pack_dir.glob("pack_*.dat"))
+            self._pack_number = int(existing[-1].stem[5:]) if existing else 1
+        while True:
+            pack_path = self.pack_dir / f"pack_{self._pack_number:05d}.dat"
+            if not pack_path.exists() or pack_path.stat().st_size < self.PACK_SIZE:
+                break
+            self._pack_number += 1
+        self._pack = open(pack_path, 'ab')
+    
+    def add(self, file_path, data):
+        """Append a file's bytes to the current pack; file_path is where it would live loose"""
+        rel_path = Path(file_path).relative_to(self.backup_root).as_posix()
+        with self._lock:
+            if self._pack is None or self._pack.tell() >= self.PACK_SIZE:
+                if self._pack is not None:
+                    self._pack.close()
+                    self._pack_number += 1
+                self._open_pack()
+            offset = self._pack.tell()
+            self._pack.write(data)
+            self._index.write(json.dumps({
+                'path': rel_path,
+                'pack': Path(self._pack.name).name,
+                'offset': offset,
+                'size': len(data)
+            }) + "\n")
+    
+    def flush(self):
+        """Push buffered pack data and index lines to disk"""
+        with self._lock:
+            if self._pack is not None:
+                # Data before index, so an indexed entry always has its bytes
+                self._pack.flush()
+                self._index.flush()
+    
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._pack is not None:
+                self._pack.close()
+                self._index.close()
+                self._pack = None
+                self._index = None
+    
+    @classmethod
+    def read_index(cls, backup_root):
+        """Return {relative path: PackedFile} for a backup folder (empty if it has no packs)"""
+        pack_dir = Path(backup_root) / cls.PACK_DIR
+        index_file = pack_dir / cls.INDEX_NAME
+        entries = {}
+        if index_file.exists():
+            with open(index_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from an interrupted run
+                    entries[entry['path']] = PackedFile(pack_dir / entry['pack'],
+                                                        entry['offset'], entry['size'])
+        return entries
+
+
+class ChunkCipher:
+    """
+    Streaming AES-GCM encryption for backup files.
+    
+    Each file is sealed in fixed-size chunks, each with its own tag, so any
+    chunk decrypts without reading the rest of the file and a truncated or
+    reordered file fails authentication. Chunks are sealed on a thread pool
+    while the file is still streaming in. The drive key comes from a
+    passphrase via scrypt; the salt is kept on the destination drive and
+    shared by all of its backups, so unchanged files can still be hardlinked
+    from one backup to the next.
+    
+    Every file gets a random 32-byte salt in its header and is sealed with
+    its own HKDF subkey of the drive key, so the chunk number alone is a
+    unique nonce and no nonce is ever shared between files.
+    """
+    CONFIG_FILE = ".backup_encryption.json"
+    MAGIC = b"ODBENC01"
+    CHUNK_SIZE = 1024 * 1024
+    TAG_SIZE = 16
+    SALT_SIZE = 32
+    HEADER_SIZE = len(MAGIC) + SALT_SIZE + 4  # magic, file salt, chunk size
+    CHECK_TEXT = b"onedrive-backup"
+    FILE_KEY_INFO = b"onedrive-backup file key"
+    
+    def __init__(self, key, workers=None):
+        self.key = key
+        self._workers = workers or os.cpu_count() or 2
+        self._pool = ThreadPoolExecutor(max_workers=self._workers)
+    
+    @staticmethod
+    def derive_key(passphrase, salt):
+        # scrypt makes guessing the passphrase from a stolen drive expensive
+        return hashlib.scrypt(passphrase.encode('utf-8'), salt=salt, n=2**16, r=8, p=1,
+                              maxmem=128 * 1024 * 1024, dklen=32)
+    
+    @classmethod
+    def from_passphrase(cls, destination, passphrase):
+        """Unlock a drive's encryption key, setting it up on first use; ValueError if wrong"""
+        config_file = Path(destination) / cls.CONFIG_FILE
+        if config_file.exists():
+            with open(config_file, 'r') as f:
+                config = json.load(f)
+            key = cls.derive_key(passphrase, base64.b64decode(config['salt']))
+            check = base64.b64decode(config['check'])
+            try:
+                AESGCM(key).decrypt(check[:12], check[12:], None)
+            except InvalidTag:
+                raise ValueError("Wrong passphrase for the backups on this drive")
+            return cls(key)
+        
+        salt = os.urandom(16)
+        key = cls.derive_key(passphrase, salt)
+        nonce = os.urandom(12)
+        check = nonce + AESGCM(key).encrypt(nonce, cls.CHECK_TEXT, None)
+        with open(config_file, 'w') as f:
+            json.dump({'cipher': 'AES-256-GCM', 'kdf': 'scrypt', 'chunk_size': cls.CHUNK_SIZE,
+                       'salt': base64.b64encode(salt).decode('ascii'),
+                       'check': base64.b64encode(check).decode('ascii')}, f, indent=2)
+        return cls(key)
+    
+    @classmethod
+    def stored_size(cls, size):
+        """Size on disk of an encrypted file holding size plaintext bytes"""
+        chunks = max(1, -(-size // cls.CHUNK_SIZE))
+        return cls.HEADER_SIZE + size + chunks * cls.TAG_SIZE
+    
+    @classmethod
+    def is_encrypted(cls, source):
+        """Check whether a backed-up file (Path or PackedFile) is encrypted"""
+        with source.open('rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+    
+    @classmethod
+    def file_aead(cls, key, salt):
+        """AES-GCM under the per-file subkey for a file salt"""
+        subkey = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=cls.FILE_KEY_INFO).derive(key)
+        return AESGCM(subkey)
+    
+    @staticmethod
+    def chunk_nonce(index):
+        # The subkey is unique to the file, so the chunk number is a unique nonce
+        return index.to_bytes(12, 'big')
+    
+    @staticmethod
+    def chunk_aad(index, final):
+        # Binding the final flag makes cutting a file at a chunk boundary detectable
+        return index.to_bytes(8, 'big') + (b'\x01' if final else b'\x00')
+    
+    def _seal(self, aead, index, data, final):
+        return aead.encrypt(self.chunk_nonce(index), data, self.chunk_aad(index, final))
+    
+    def _pieces(self, chunks):
+        """Re-cut a byte stream into CHUNK_SIZE pieces, flagging the last one"""
+        buffer = bytearray()
+        previous = None
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= self.CHUNK_SIZE:
+                if previous is not None:
+                    yield previous, False
+                previous = bytes(buffer[:self.CHUNK_SIZE])
+                del buffer[:self.CHUNK_SIZE]
+        if buffer or previous is None:
+            if previous is not None:
+                yield previous, False
+            previous = bytes(buffer)
+        yield previous, True
+    
+    def encrypt_stream(self, chunks, out):
+        """Encrypt an iterable of byte strings into the open file out; returns plaintext bytes"""
+        salt = os.urandom(self.SALT_SIZE)
+        aead = self.file_aead(self.key, salt)
+        out.write(self.MAGIC + salt + self.CHUNK_SIZE.to_bytes(4, 'big'))
+        sealing = deque()
+        total = 0
+        for index, (piece, final) in enumerate(self._pieces(chunks)):
+            sealing.append(self._pool.submit(self._seal, aead, index, piece, final))
+            total += len(piece)
+            # Keep a few chunks in flight so sealing overlaps the download or disk read
+            while len(sealing) > self._workers:
+                out.write(sealing.popleft().result())
+        while sealing:
+            out.write(sealing.popleft().result())
+        return total
+    
+    def encrypt_bytes(self, data):
+        out = io.BytesIO()
+        self.encrypt_stream([data], out)
+        return out.getvalue()
+
+
+class DecryptedReader(io.RawIOBase):
+    """Seekable plaintext view of an encrypted file; only the chunks read are decrypted"""
+    
+    def __init__(self, raw, key):
+        self._raw = raw
+        if raw.read(len(ChunkCipher.MAGIC)) != ChunkCipher.MAGIC:
+            raise ValueError("Not an encrypted backup file")
+        self._aead = ChunkCipher.file_aead(key, raw.read(ChunkCipher.SALT_SIZE))
+        self._chunk_size = int.from_bytes(raw.read(4), 'big')
+        stored = raw.seek(0, io.SEEK_END) - ChunkCipher.HEADER_SIZE
+        sealed_size = self._chunk_size + ChunkCipher.TAG_SIZE
+        self._chunks = max(1, -(-stored // sealed_size))
+        self.size = stored - self._chunks * ChunkCipher.TAG_SIZE
+        self._pos = 0
+        self._cached = (None, b'')
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+    
+    def _chunk(self, index):
+        if self._cached[0] != index:
+            sealed_size = self._chunk_size + ChunkCipher.TAG_SIZE
+            self._raw.seek(ChunkCipher.HEADER_SIZE + index * sealed_size)
+            sealed = self._raw.read(sealed_size)
+            final = index == self._chunks - 1
+            try:
+                plain = self._aead.decrypt(ChunkCipher.chunk_nonce(index), sealed,
+                                           ChunkCipher.chunk_aad(index, final))
+            except InvalidTag:
+                raise ValueError(f"Encrypted chunk {index} failed authentication (wrong key or damaged file)")
+            self._cached = (index, plain)
+        return self._cached[1]
+    
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        index, skip = divmod(self._pos, self._chunk_size)
+        data = self._chunk(index)[skip:skip + len(buffer)]
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+    
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+class EncryptedFile:
+    """An encrypted backup file (loose or packed), readable like a Path via open() and stat()"""
+    
+    def __init__(self, source, key):
+        self.source = source
+        self.key = key
+    
+    def open(self, mode='rb'):
+        return io.BufferedReader(DecryptedReader(self.source.open('rb'), self.key),
+                                 buffer_size=ChunkCipher.CHUNK_SIZE)
+    
+    def read_bytes(self):
+        with self.open('rb') as f:
+            return f.read()
+    
+    def stat(self):
+        with DecryptedReader(self.source.open('rb'), self.key) as reader:
+            return os.stat_result((0, 0, 0, 1, 0, 0, reader.size, 0, 0, 0))
+
+
+class TokenManager:
+    """
+    OAuth token holder shared by every worker of a run.
+    
+    Tracks expires_in and refreshes a few minutes early on a background timer,
+    so requests rarely see a 401 at all. When several workers do hit a 401 at
+    once, only the first one calls the token endpoint and the rest wait for
+    its result. The refresh token can be cached on disk, encrypted with a key
+    derived from the client secret, so a restart skips the browser login.
+    The cache records the scopes granted with the token, and is only used
+    when they cover the scopes the current command needs.
+    """
+    REFRESH_MARGIN = 300  # Seconds before expiry to refresh in the background
+    CACHE_DIR = Path.home() / ".onedrive_backup"
+    # Scopes every token carries; they say nothing about what the token can access
+    BASIC_SCOPES = {'offline_access', 'openid', 'profile', 'email'}
+    
+    def __init__(self):
+        self.tenant_id = None
+        self.client_id = None
+        self.client_secret = None
+        self.scope = None
+        self.granted_scopes = set()
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = None
+        self._lock = threading.Lock()
+        self._refresh_done = None  # Event set when the in-flight refresh finishes; .ok holds its result
+        self._timer = None
+    
+    def configure(self, tenant_id, client_id, client_secret=None, scope=None):
+        """Set the app registration and the scope (space-separated) used for token requests"""
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope
+    
+    @classmethod
+    def scope_names(cls, scope):
+        """Permission names in a scope string, without the Graph URL prefix"""
+        names = {name.rsplit('/', 1)[-1].lower() for name in (scope or '').split()}
+        return names - cls.BASIC_SCOPES
+    
+    def covers(self, granted):
+        """True if the granted permission names include everything self.scope asks for"""
+        # Files.ReadWrite.All also grants Files.Read.All
+        granted = set(granted) | {name.replace('.readwrite', '.read') for name in granted}
+        return self.scope_names(self.scope) <= granted
+    
+    def update(self, result):
+        """Store the tokens from a token endpoint response and schedule the next refresh"""
+        with self._lock:
+            self.access_token = result['access_token']
+            self.refresh_token = result.get('refresh_token', self.refresh_token)
+            self.granted_scopes = self.scope_names(result.get('scope') or self.scope)
+            expires_in = int(result.get('expires_in', 3600))
+            self.expires_at = time.time() + expires_in
+            if self._timer:
+                self._timer.cancel()
+            if self.refresh_token:
+                self._timer = threading.Timer(max(expires_in - self.REFRESH_MARGIN, 30), self.refresh)
+                self._timer.daemon = True
+                self._timer.start()
+        self.save_cache()
+    
+    def get_token(self):
+        """Return a usable access token, refreshing first if it is about to expire"""
+        if (self.refresh_token and self.expires_at
+                and time.time() > self.expires_at - self.REFRESH_MARGIN / 5):
+            self.refresh(self.access_token)
+        return self.access_token
+    
+    def refresh(self, stale_token=None):
+        """
+        Refresh the access token, merging concurrent calls into one request.
+        
+        Args:
+            stale_token: The token the caller saw fail; if it has already been
+                replaced, the caller simply retries with the new one
+        
+        Returns:
+            True if a valid access token is available afterwards
+        """
+        with self._lock:
+            if not self.refresh_token:
+                return False
+            if stale_token and stale_token != self.access_token:
+                return True
+            if self._refresh_done is not None:
+                waiter = self._refresh_done
+            else:
+                waiter = None
+                self._refresh_done = threading.Event()
+                self._refresh_done.ok = False
+        
+        if waiter is not None:
+            waiter.wait()
+            return waiter.ok
+        
+        print("🔄 Refreshing access token...")
+        token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
+        data = {
+            'client_id': self.client_id,
+            'refresh_token': self.refresh_token,
+            'grant_type': 'refresh_token'
+        }
+        if self.client_secret:
+            data['client_secret'] = self.client_secret
+        if self.scope:
+            data['scope'] = self.scope
+        
+        ok = False
+        try:
+            response = requests.post(token_url, data=data, timeout=60)
+            result = response.json()
+            
+            if 'access_token' in result:
+                self.update(result)
+                ok = True
+                print("✅ Token refreshed!")
+            else:
+                print(f"❌ Token refresh failed: {result.get('error_description', 'Unknown error')}")
+        except Exception as e:
+            print(f"❌ Token refresh error: {e}")
+        finally:
+            with self._lock:
+                done, self._refresh_done = self._refresh_done, None
+                done.ok = ok
+            done.set()
+        return ok
+    
+    def stop(self):
+        """Cancel the background refresh timer"""
+        if self._timer:
+            self._timer.cancel()
+    
+    def cache_file(self):
+        digest = hashlib.sha256(f"{self.tenant_id}:{self.client_id}".encode('utf-8')).hexdigest()
+        return self.CACHE_DIR / f"token_{digest[:16]}.json"
+    
+    def _cipher(self, salt):
+        # scrypt makes guessing the client secret from a stolen cache file expensive
+        key = hashlib.scrypt(self.client_secret.encode('utf-8'), salt=salt, n=2**14, r=8, p=1, dklen=32)
+        return Fernet(base64.urlsafe_b64encode(key))
+    
+    def save_cache(self):
+        """Write the refresh token to disk, encrypted; does nothing without cryptography"""
+        if Fernet is None or not self.client_secret or not self.refresh_token:
+            return
+        try:
+            self.CACHE_DIR.mkdir(mode=0o700, exist_ok=True)
+            salt = os.urandom(16)
+            token = self._cipher(salt).encrypt(self.refresh_token.encode('utf-8'))
+            cache_file = self.cache_file()
+            with open(cache_file, 'w') as f:
+                json.dump({'salt': base64.b64encode(salt).decode('ascii'),
+                           'refresh_token': token.decode('ascii'),
+                           'scopes': sorted(self.granted_scopes)}, f)
+            os.chmod(cache_file, 0o600)
+        except OSError as e:
+            print(f"⚠️  Could not cache login: {e}")
+    
+    def load_cache(self):
+        """Sign in with a cached refresh token; returns True on success"""
+        if Fernet is None or not self.client_secret:
+            return False
+        cache_file = self.cache_file()
+        if not cache_file.exists():
+            return False
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            # Caches from before scopes were recorded count as granting nothing
+            granted = set(cached.get('scopes', []))
+            if not self.covers(granted):
+                print("ℹ️  This command needs permissions the saved login does not have; signing in again.")
+                return False
+            cipher = self._cipher(base64.b64decode(cached['salt']))
+            self.refresh_token = cipher.decrypt(cached['refresh_token'].encode('ascii')).decode('utf-8')
+        except (OSError, ValueError, KeyError, InvalidToken):
+            # Wrong client secret or a damaged file: fall back to a normal login
+            return False
+        self.granted_scopes = granted
+        return self.refresh()
+    
+    def clear_cache(self):
+        cache_file = self.cache_file()
+        if cache_file.exists():
+            cache_file.unlink()
+
+
+class BackupCatalog:
+    """
+    SQLite catalog of every file in every backup on a destination drive.
+    
+    Keyed by OneDrive item ID and content hash, so a file that was moved or
+    renamed since an earlier backup can be found there and linked into the
+    new backup instead of being downloaded again. An FTS5 index over path
+    and file name answers "which backups hold this file" without opening
+    any backup folder; SQLite builds without FTS5 fall back to LIKE.
+    """
+    FILE_NAME = ".backup_catalog.sqlite"
+    COMMIT_EVERY = 500
+    
+    def __init__(self, destination):
+        self.destination = Path(destination)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._packed = {}
+        self.db = sqlite3.connect(str(self.destination / self.FILE_NAME), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                snapshot TEXT NOT NULL,
+                path TEXT NOT NULL,
+                item_id TEXT,
+                content_hash TEXT,
+                size INTEGER,
+                modified TEXT,
+                PRIMARY KEY (snapshot, path)
+            );
+            CREATE INDEX IF NOT EXISTS files_item ON files (item_id);
+            CREATE INDEX IF NOT EXISTS files_hash ON files (content_hash);
+            CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY);
+        """)
+        self.fts = self._create_fts()
+    
+    def _create_fts(self):
+        """Create the full-text index, backfilling it for catalogs made before it existed"""
+        try:
+            exists = self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'").fetchone()
+            if exists:
+                return True
+            self.db.execute("CREATE VIRTUAL TABLE files_fts USING fts5(path, name)")
+        except sqlite3.OperationalError:
+            return False
+        rows = self.db.execute("SELECT rowid, path FROM files").fetchall()
+        self.db.executemany("INSERT INTO files_fts (rowid, path, name) VALUES (?, ?, ?)",
+                            [(rowid, path, path.rsplit('/', 1)[-1]) for rowid, path in rows])
+        self.db.commit()
+        return True
+    
+    @staticmethod
+    def content_hash(hashes):
+        """Pick one comparable hash from a Graph hashes facet"""
+        if hashes.get('quickXorHash'):
+            return f"qx:{hashes['quickXorHash']}"
+        if hashes.get('sha1Hash'):
+            return f"sha1:{hashes['sha1Hash'].lower()}"
+        return None
+    
+    def record(self, snapshot, path, item_id, content_hash, size, modified=None):
+        """Add or replace one file of a snapshot"""
+        with self._lock:
+            self.db.execute("INSERT OR IGNORE INTO snapshots (name) VALUES (?)", (snapshot,))
+            if self.fts:
+                # REPLACE gives the row a new rowid, so drop the old index entry first
+                old = self.db.execute("SELECT rowid FROM files WHERE snapshot = ? AND path = ?",
+                                      (snapshot, path)).fetchone()
+                if old:
+                    self.db.execute("DELETE FROM files_fts WHERE rowid = ?", old)
+            cursor = self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                     (snapshot, path, item_id, content_hash, size, modified))
+            if self.fts:
+                self.db.execute("INSERT INTO files_fts (rowid, path, name) VALUES (?, ?, ?)",
+                                (cursor.lastrowid, path, path.rsplit('/', 1)[-1]))
+            self._uncommitted += 1
+            if self._uncommitted >= self.COMMIT_EVERY:
+                self.db.commit()
+                self._uncommitted = 0
+    
+    def commit(self):
+        with self._lock:
+            self.db.commit()
+            self._uncommitted = 0
+    
+    def close(self):
+        self.commit()
+        self.db.close()
+    
+    def import_manifests(self):
+        """Add backups made before the catalog existed, from their manifest or backup log"""
+        with self._lock:
+            known = {row[0] for row in self.db.execute("SELECT name FROM snapshots")}
+        for snapshot in sorted(self.destination.glob("OneDrive_Backup_*")):
+            if snapshot.name in known or not snapshot.is_dir():
+                continue
+            manifest_file = snapshot / OneDriveBackup.MANIFEST_FILE
+            log_file = snapshot / "backup_log.json"
+            if manifest_file.exists():
+                with open(manifest_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        self.record(snapshot.name, entry['path'], entry.get('id'),
+                                    self.content_hash(entry.get('hashes', {})),
+                                    entry.get('size'), entry.get('modified'))
+            elif log_file.exists():
+                # Older local backups only have a log of absolute destination paths
+                try:
+                    with open(log_file, 'r') as f:
+                        log = json.load(f)
+                except ValueError:
+                    continue
+                for entry in log.get('files', []):
+                    if entry.get('status') != 'success':
+                        continue
+                    try:
+                        rel_path = Path(entry['destination']).relative_to(snapshot).as_posix()
+                    except ValueError:
+                        continue  # Drive was mounted somewhere else back then
+                    self.record(snapshot.name, rel_path, None, None, None)
+        self.commit()
+    
+    def forget_snapshots(self, snapshots):
+        """Remove deleted backups from the catalog in one transaction"""
+        names = [(snapshot,) for snapshot in snapshots]
+        with self._lock:
+            if self.fts:
+                self.db.executemany("DELETE FROM files_fts WHERE rowid IN "
+                                    "(SELECT rowid FROM files WHERE snapshot = ?)", names)
+            self.db.executemany("DELETE FROM files WHERE snapshot = ?", names)
+            self.db.executemany("DELETE FROM snapshots WHERE name = ?", names)
+            self.db.commit()
+    
+    def search(self, query, limit=200):
+        """
+        Find files whose path or name matches every word of query.
+        
+        Returns:
+            Rows of (path, snapshot, size, modified, content_hash), grouped by
+            path with the newest backup first
+        """
+        words = [word for word in re.split(r'[\s/\\]+', query) if word]
+        if not words:
+            return []
+        with self._lock:
+            if self.fts:
+                # Quote each word so FTS syntax characters are taken literally; * makes it a prefix match
+                match = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+                return self.db.execute(
+                    "SELECT f.path, f.snapshot, f.size, f.modified, f.content_hash "
+                    "FROM files_fts JOIN files f ON f.rowid = files_fts.rowid "
+                    "WHERE files_fts MATCH ? ORDER BY f.path, f.snapshot DESC LIMIT ?",
+                    (match, limit)).fetchall()
+            where = ' AND '.join("path LIKE ?" for _ in words)
+            return self.db.execute(
+                f"SELECT path, snapshot, size, modified, content_hash FROM files WHERE {where} "
+                f"ORDER BY path, snapshot DESC LIMIT ?",
+                [f"%{word}%" for word in words] + [limit]).fetchall()
+    
+    def find_copies(self, item_id, content_hash, size, exclude_snapshot):
+        """Return (snapshot, path) of earlier copies with the same content, newest first"""
+        if not content_hash:
+            return []
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT snapshot, path FROM files WHERE content_hash = ? AND size = ? "
+                "AND snapshot != ? ORDER BY (item_id = ?) DESC, snapshot DESC LIMIT 5",
+                (content_hash, size, exclude_snapshot, item_id)).fetchall()
+        return rows
+    
+    def open_copy(self, snapshot, path, size):
+        """Locate an earlier copy on disk: a Path, a PackedFile, or None if it is gone"""
+        loose = self.destination / snapshot / path
+        if loose.is_file() and loose.stat().st_size == size:
+            return loose
+        with self._lock:
+            if snapshot not in self._packed:
+                self._packed[snapshot] = PackStore.read_index(self.destination / snapshot)
+            packed = self._packed[snapshot].get(path)
+        if packed is not None and packed.size == size and packed.pack_path.exists():
+            return packed
+        return None
+
+
+class RunProfiler:
+    """
+    Low-overhead profiling for one run, enabled with --profile.
+    
+    A background thread samples every thread's stack through
+    sys._current_frames() every 10 ms. A sample only collects the code
+    objects on the stack; they are turned into folded stacks (one
+    'frame;frame;frame count' line each, the input format of flamegraph.pl
+    and speedscope) once, when the profile is written. Samples are
+    wall-clock, so time spent waiting on the network or the disk shows up as
+    well as CPU time. Each sample is prefixed with the phase its thread is
+    in; pool workers that never enter a phase are counted under the main
+    thread's phase.
+    
+    RunProfiler.phase() marks a pipeline phase and records its call count
+    and wall time. It is a no-op when no profiler is running, so phases cost
+    nothing normally. With memory=True tracemalloc runs as well and the
+    run's peak is reported. tracemalloc has one process-wide peak, so only
+    main-thread phases, which nest but never overlap, reset it and get a
+    peak of their own; phases in worker threads report none.
+    """
+    active = None
+    
+    def __init__(self, name, output_dir='.', interval=0.01, memory=False):
+        self.name = name
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.memory = memory
+        self.samples = {}
+        self.sample_count = 0
+        self.phases = {}
+        self.peak_bytes = 0
+        self._stacks = {}
+        self._local = threading.local()
+        self._thread_phase = {}
+        self._main_ident = threading.main_thread().ident
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+    
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        """Time a pipeline phase of the active profiler (does nothing when profiling is off)"""
+        profiler = cls.active
+        if profiler is None:
+            yield
+            return
+        stack = getattr(profiler._local, 'stack', None)
+        if stack is None:
+            stack = profiler._local.stack = []
+        ident = threading.get_ident()
+        track_peak = profiler.memory and ident == profiler._main_ident
+        if track_peak:
+            # Fold the parent's peak so far into its record before resetting it
+            peak = profiler._take_peak()
+            if stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+        path = f"{stack[-1][0]}/{name}" if stack else name
+        stack.append([path, time.perf_counter(), 0])
+        with profiler._lock:
+            profiler._thread_phase[ident] = path
+        try:
+            yield
+        finally:
+            path, started, child_peak = stack.pop()
+            seconds = time.perf_counter() - started
+            peak = max(profiler._take_peak(), child_peak) if track_peak else None
+            with profiler._lock:
+                record = profiler.phases.setdefault(path, {'calls': 0, 'seconds': 0.0})
+                record['calls'] += 1
+                record['seconds'] += seconds
+                if peak is not None:
+                    record['peak_bytes'] = max(record.get('peak_bytes', 0), peak)
+            if peak is not None and stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+            with profiler._lock:
+                if stack:
+                    profiler._thread_phase[ident] = stack[-1][0]
+                else:
+                    profiler._thread_phase.pop(ident, None)
+    
+    def _take_peak(self):
+        """Return the traced peak since the last call and start a new one (main thread only)"""
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        return peak
+    
+    def start(self):
+        if self.memory:
+            # One frame per allocation keeps tracemalloc's own overhead small
+            tracemalloc.start(1)
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+        RunProfiler.active = self
+        return self
+    
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            # Worker threads enter and leave phases while the sample is taken
+            with self._lock:
+                thread_phase = dict(self._thread_phase)
+            main_phase = thread_phase.get(self._main_ident, 'idle')
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or self._idle_worker(frame):
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                phase = thread_phase.get(ident, main_phase)
+                # Keyed by identity; _stacks keeps the code objects alive so ids stay unique
+                key = (phase, *map(id, codes))
+                count = self.samples.get(key)
+                if count is None:
+                    self._stacks[key] = (phase, codes)
+                    count = 0
+                self.samples[key] = count + 1
+            self.sample_count += 1
+    
+    @staticmethod
+    def _idle_worker(frame):
+        """Check whether a thread is a pool worker waiting for work, which would swamp the samples"""
+        for _ in range(4):
+            if frame is None:
+                return False
+            if frame.f_code.co_name == '_worker' and frame.f_code.co_filename.endswith('thread.py'):
+                return True
+            if frame.f_code.co_name not in ('get', 'wait'):
+                return False
+            frame = frame.f_back
+        return False
+    
+    def folded_stacks(self):
+        """Name the sampled stacks as folded 'phase;frame;frame' keys with their counts"""
+        labels = {}
+        folded = {}
+        for key, count in self.samples.items():
+            phase, codes = self._stacks[key]
+            names = [phase]
+            for code in reversed(codes):
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                names.append(label)
+            stack = ';'.join(names)
+            folded[stack] = folded.get(stack, 0) + count
+        return folded
+    
+    def stop(self):
+        """Stop sampling, write <name>_<time>.folded and .json, and print the hot spots"""
+        RunProfiler.active = None
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        elapsed = time.perf_counter() - self._started
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak_bytes = max(self.peak_bytes, peak)
+            tracemalloc.stop()
+        
+        folded = self.folded_stacks()
+        self_samples = {}
+        for key, count in folded.items():
+            leaf = key.rsplit(';', 1)[-1]
+            self_samples[leaf] = self_samples.get(leaf, 0) + count
+        total = max(sum(folded.values()), 1)
+        hot_spots = sorted(self_samples.items(), key=lambda kv: kv[1], reverse=True)[:15]
+        
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        prefix = self.output_dir / f"profile_{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        with open(f"{prefix}.folded", 'w', encoding='utf-8') as f:
+            for key, count in sorted(folded.items()):
+                f.write(f"{key} {count}\n")
+        with open(f"{prefix}.json", 'w', encoding='utf-8') as f:
+            json.dump({
+                'seconds': elapsed,
+                'sample_interval': self.interval,
+                'samples': self.sample_count,
+                'peak_bytes': self.peak_bytes if self.memory else None,
+                'phases': self.phases,
+                'hot_spots': [{'frame': leaf, 'share': count / total} for leaf, count in hot_spots]
+            }, f, indent=2)
+        
+        print("\n" + "="*50)
+        print("⏱️  PROFILE")
+        print("="*50)
+        for path, record in sorted(self.phases.items(), key=lambda kv: kv[1]['seconds'], reverse=True):
+            peak = f"peak {record['peak_bytes'] / (1024**2):.1f} MB" if 'peak_bytes' in record else ""
+            print(f"{path:<32} {record['seconds']:8.2f}s  x{record['calls']:<6} {peak}".rstrip())
+        if self.memory:
+            print(f"Peak traced memory: {self.peak_bytes / (1024**2):.1f} MB")
+        print("\nHot spots (share of sampled thread time):")
+        for leaf, count in hot_spots[:10]:
+            print(f"  {count / total:6.1%}  {leaf}")
+        print(f"\nFlame graph input: {prefix}.folded (flamegraph.pl or https://speedscope.app)")
+        print(f"Phase summary:     {prefix}.json")
+
+
+class SelectionRules:
+    """
+    Decides which files a backup includes.
+    
+    The document/picture choice is a set of extensions, and include/exclude
+    globs are compiled once: plain '*.ext' patterns into extension sets and
+    the rest into one regex each for names and for paths. Checking a file is
+    then a few lookups. Folders are checked before they are listed or walked,
+    so an excluded folder, or one outside the chosen paths, is skipped with
+    everything below it and costs no API or stat calls.
+    
+    Matching is case-insensitive like OneDrive. Patterns without '/' match a
+    file or folder name anywhere; patterns with '/' match the path from the
+    drive root. Modified dates are compared as ISO text, so 'YYYY-MM-DD'
+    bounds work for Graph timestamps and local ones alike.
+    """
+    DOC_EXTENSIONS = {'.pdf', '.docx', '.doc', '.txt', '.xlsx', '.xls', 
+                      '.pptx', '.ppt', '.odt', '.rtf', '.csv'}
+    PIC_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', 
+                      '.svg', '.webp', '.heic', '.raw'}
+    SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+    
+    def __init__(self, types=None, include=(), exclude=(), min_size=None, max_size=None,
+                 modified_after=None, modified_before=None, paths=()):
+        self.types = set(types) if types is not None else self.DOC_EXTENSIONS | self.PIC_EXTENSIONS
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.paths = [path.strip('/') for path in paths if path.strip('/')]
+        self._paths = [path.casefold() for path in self.paths]
+        self._include = self._compile(self.include)
+        self._exclude = self._compile(self.exclude)
+    
+    @staticmethod
+    def _compile(patterns):
+        """Split globs into (extension set, name regex, path regex)"""
+        extensions = set()
+        names = []
+        paths = []
+        for pattern in patterns:
+            pattern = pattern.strip().strip('/').casefold()
+            if not pattern:
+                continue
+            if '/' in pattern:
+                paths.append(fnmatch.translate(pattern))
+            elif re.fullmatch(r'\*\.[^.*?\[\]]+', pattern):
+                extensions.add(pattern[1:])
+            else:
+                names.append(fnmatch.translate(pattern))
+        names = re.compile('|'.join(names)) if names else None
+        paths = re.compile('|'.join(paths)) if paths else None
+        return extensions, names, paths
+    
+    @staticmethod
+    def parse_size(text):
+        """Parse sizes like '500', '10MB' or '1.5 GB' into bytes"""
+        match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', text.upper())
+        if not match:
+            raise ValueError(f"Invalid size: {text}")
+        return int(float(match.group(1)) * SelectionRules.SIZE_UNITS[match.group(2)])
+    
+    def with_types(self, include_docs=True, include_pics=True):
+        """Copy of these rules selecting documents and/or pictures"""
+        rules = copy.copy(self)
+        rules.types = ((self.DOC_EXTENSIONS if include_docs else set()) |
+                       (self.PIC_EXTENSIONS if include_pics else set()))
+        return rules
+    
+    @property
+    def uses_dates(self):
+        return bool(self.modified_after or self.modified_before)
+    
+    @staticmethod
+    def _matches(compiled, name, path, ext):
+        extensions, names, paths = compiled
+        return (ext in extensions
+                or (names is not None and names.match(name) is not None)
+                or (paths is not None and paths.match(path) is not None))
+    
+    def skips_folder(self, rel_path):
+        """Check whether a folder (path from the drive root) and everything below it can be skipped"""
+        path = rel_path.casefold()
+        name = path.rsplit('/', 1)[-1]
+        if self._matches(self._exclude, name, path, None):
+            return True
+        # Keep folders inside a chosen path and the folders leading down to one
+        return bool(self._paths) and not any(
+            path == prefix or path.startswith(prefix + '/') or prefix.startswith(path + '/')
+            for prefix in self._paths)
+    
+    def matches(self, rel_path):
+        """Check a file's path against the type, glob and path rules (no size or date needed)"""
+        path = rel_path.casefold()
+        name = path.rsplit('/', 1)[-1]
+        dot = name.rfind('.')
+        ext = name[dot:] if dot > 0 else ''
+        if ext not in self.types and not self._matches(self._include, name, path, ext):
+            return False
+        if self._matches(self._exclude, name, path, ext):
+            return False
+        return not self._paths or any(path.startswith(prefix + '/') for prefix in self._paths)
+    
+    def within_bounds(self, size=None, modified=None):
+        """Check a file's size and ISO modified time against the bounds"""
+        if size is not None:
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if modified:
+            if self.modified_after and modified < self.modified_after:
+                return False
+            if self.modified_before and modified >= self.modified_before:
+                return False
+        return True
+    
+    def wants_file(self, rel_path, size=None, modified=None):
+        """Check whether a file belongs in the backup"""
+        return self.matches(rel_path) and self.within_bounds(size, modified)
+    
+    def describe(self):
+        """Short summary of the active filters (empty when only the file types apply)"""
+        parts = []
+        if self.include:
+            parts.append(f"also including {', '.join(self.include)}")
+        if self.exclude:
+            parts.append(f"excluding {', '.join(self.exclude)}")
+        if self.paths:
+            parts.append(f"only under {', '.join(self.paths)}")
+        if self.min_size is not None:
+            parts.append(f"at least {self.min_size / (1024**2):.2f} MB")
+        if self.max_size is not None:
+            parts.append(f"at most {self.max_size / (1024**2):.2f} MB")
+        if self.modified_after:
+            parts.append(f"modified on or after {self.modified_after}")
+        if self.modified_before:
+            parts.append(f"modified before {self.modified_before}")
+        return "; ".join(parts)
+
 
 class OneDriveBackup:
+    THROUGHPUT_FILE = ".onedrive_backup_throughput.json"
+    MANIFEST_FILE = "manifest.jsonl"
+    RESTORE_STATE_FILE = ".restore_progress.json"
+    # Bookkeeping files kept at the top of a backup folder, not user data
+    METADATA_FILES = {".progress.json", CompactIdIndex.INDEX_NAME, CompactIdIndex.JOURNAL_NAME,
+                      "backup_log.json", MANIFEST_FILE, RESTORE_STATE_FILE}
+    # Note left in place of a shared folder that could not be a symlink
+    LINK_NOTE_SUFFIX = ".onedrive-link.txt"
+    # Upload session chunks must be a multiple of 320 KiB
+    UPLOAD_CHUNK_SIZE = 320 * 1024 * 32
+    # Per-drive progress stores of an all-drives backup
+    DRIVE_PROGRESS_DIR = ".drive_progress"
+    # Cap on Graph requests in flight across all drives of a run
+    GLOBAL_MAX_REQUESTS = 16
+    DOWNLOAD_ORDERS = {
+        'folder': "folder order",
+        'recent': "most recently modified first",
+        'smallest': "smallest files first",
+        'recent-smallest': "newest day first, small files first within a day",
+    }
+    READ_SCOPE = "Files.Read.All offline_access"
+    SITES_SCOPE = "Files.Read.All Sites.Read.All offline_access"
+    WRITE_SCOPE = "Files.ReadWrite.All offline_access"
+    
     def __init__(self):
         self.onedrive_path = self.find_onedrive_path()
         self.backup_log = []
-        self.access_token = None
-        self.refresh_token = None
+        self.tokens = TokenManager()
         self.client_id = None
         self.client_secret = None
         self.tenant_id = None
         self.use_api = False
-        self.downloaded_files = set()
-        self.progress_file = None
+        self.api_call_count = 0
+        self.consecutive_refresh_failures = 0
+        self.counter_lock = threading.Lock()  # drive and download threads share the counters above
+        self.scope = self.READ_SCOPE
+        self.throttle = GraphThrottle()
+        self.manifest_lock = threading.Lock()
+        self.pack_threshold = None
+        self.pack_store = None
+        self.catalog = None
+        self.cipher = None
+        self.rules = SelectionRules()
+        self.download_order = 'folder'
+        self.download_workers = 4
+        self.parallel_drives = 3
+        self.stop_event = threading.Event()
         
+    @property
+    def access_token(self):
+        return self.tokens.access_token
+    
+    @property
+    def refresh_token(self):
+        return self.tokens.refresh_token
+    
     def find_onedrive_path(self):
         """Automatically locate OneDrive folder"""
         possible_paths = [
@@ -88,7 +1534,8 @@ class OneDriveBackup:
         device_code_url = f"{authority}/oauth2/v2.0/devicecode"
         data = {
             'client_id': client_id,
-            'scope': 'https://graph.microsoft.com/Files.Read.All offline_access'
+            'scope': ' '.join(s if s == 'offline_access' else f'https://graph.microsoft.com/{s}'
+                              for s in self.scope.split())
         }
         
         try:
@@ -116,7 +1563,6 @@ class OneDriveBackup:
                 'device_code': device_code_data['device_code']
             }
             
-            import time
             interval = device_code_data.get('interval', 5)
             expires_at = time.time() + device_code_data['expires_in']
             
@@ -126,7 +1572,9 @@ class OneDriveBackup:
                 token_result = token_response.json()
                 
                 if 'access_token' in token_result:
-                    self.access_token = token_result['access_token']
+                    self.tenant_id = "common"
+                    self.tokens.configure("common", client_id, scope=data['scope'])
+                    self.tokens.update(token_result)
                     self.use_api = True
                     print("✅ Successfully authenticated!\n")
                     return True
@@ -177,7 +1625,9 @@ class OneDriveBackup:
             result = response.json()
             
             if 'access_token' in result:
-                self.access_token = result['access_token']
+                self.tokens.configure(self.tenant_id, self.client_id, self.client_secret,
+                                      scope='https://graph.microsoft.com/.default')
+                self.tokens.update(result)
                 self.use_api = True
                 print("✅ Successfully authenticated!\n")
                 return True
@@ -190,12 +1640,18 @@ class OneDriveBackup:
     
     def delegated_auth_flow(self):
         """Interactive auth flow for personal accounts"""
+        self.tokens.configure(self.tenant_id, self.client_id, self.client_secret, self.scope)
+        if self.tokens.load_cache():
+            self.use_api = True
+            print("✅ Signed in with saved login - no browser needed!\n")
+            return True
+        
         print("\n🔐 Starting interactive authentication...")
         print("A browser window will open for you to sign in.")
         
         # Generate auth URL
         redirect_uri = "http://localhost:8080"
-        scope = "Files.Read.All offline_access"
+        scope = self.scope
         auth_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/authorize"
         auth_url += f"?client_id={self.client_id}"
         auth_url += f"&response_type=code"
@@ -207,392 +1663,1261 @@ class OneDriveBackup:
         print(f"3. After approving, you'll be redirected to localhost")
         print(f"4. Copy the 'code=' value from the URL\n")
         
-        webbrowser.open(auth_url)
+        webbrowser.open(auth_url)
+        
+        print("After signing in, your browser will show an error page.")
+        print("That's normal! Just copy the URL from your browser.")
+        redirect_response = input("\nPaste the full redirect URL here: ").strip()
+        
+        # Extract code from URL
+        try:
+            from urllib.parse import urlparse, parse_qs
+            parsed = urlparse(redirect_response)
+            code = parse_qs(parsed.query)['code'][0]
+        except:
+            print("❌ Could not extract authorization code from URL")
+            return False
+        
+        # Exchange code for tokens
+        token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
+        data = {
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'code': code,
+            'redirect_uri': redirect_uri,
+            'grant_type': 'authorization_code'
+        }
+        
+        try:
+            response = requests.post(token_url, data=data)
+            result = response.json()
+            
+            if 'access_token' in result:
+                self.tokens.update(result)
+                self.use_api = True
+                if Fernet is None:
+                    print("ℹ️  Install 'cryptography' to stay signed in between runs.")
+                print("✅ Successfully authenticated!\n")
+                return True
+            else:
+                print(f"❌ Token exchange failed: {result.get('error_description', 'Unknown error')}")
+                return False
+        except Exception as e:
+            print(f"❌ Authentication error: {e}")
+            return False
+    
+    def refresh_access_token(self, stale_token=None):
+        """Refresh the access token using refresh token (one request even if many workers ask)"""
+        return self.tokens.refresh(stale_token)
+    
+    def choose_backup_root(self, destination, create=True):
+        """Offer to resume an existing backup on the destination, or start a new one"""
+        existing_backups = sorted([d for d in destination.glob("OneDrive_Backup_*") if d.is_dir()], 
+                                 key=lambda x: x.stat().st_mtime, reverse=True)
+        
+        backup_root = None
+        if existing_backups:
+            print("\n📂 Found existing backup(s):")
+            for i, backup in enumerate(existing_backups[:5], 1):  # Show up to 5 most recent
+                progress_file = backup / ".progress.json"
+                if progress_file.exists():
+                    with open(progress_file, 'r') as f:
+                        progress_data = json.load(f)
+                        file_count = progress_data.get('downloaded_count',
+                                                       len(progress_data.get('downloaded_files', [])))
+                    print(f"  {i}. {backup.name} ({file_count} files already downloaded)")
+                else:
+                    print(f"  {i}. {backup.name} (complete)")
+            
+            print(f"  {len(existing_backups) + 1}. Start a new backup")
+            
+            choice = input(f"\nResume which backup? (1-{len(existing_backups) + 1}): ").strip()
+            try:
+                choice_num = int(choice)
+                if 1 <= choice_num <= len(existing_backups):
+                    backup_root = existing_backups[choice_num - 1]
+                    print(f"\n✓ Resuming: {backup_root.name}")
+            except (ValueError, IndexError):
+                pass
+        
+        # Create new backup if no existing one selected
+        if backup_root is None:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_root = destination / f"OneDrive_Backup_{timestamp}"
+            if create:
+                backup_root.mkdir(exist_ok=True)
+                print(f"\n✓ Starting new backup: {backup_root.name}")
+        
+        return backup_root
+    
+    def load_progress(self, progress_dir, read_only=False):
+        """
+        Return the downloaded-item index kept in progress_dir (empty if it has none).
+        
+        Legacy progress files are converted to the index on disk unless
+        read_only is set.
+        """
+        progress_file = progress_dir / ".progress.json"
+        downloaded_files = CompactIdIndex()
+        if progress_file.exists():
+            with open(progress_file, 'r') as f:
+                progress_data = json.load(f)
+            downloaded_files = CompactIdIndex.load(progress_dir)
+            # Progress files from older versions list the raw item IDs
+            legacy_ids = progress_data.get('downloaded_files', [])
+            if legacy_ids:
+                downloaded_files.update(legacy_ids)
+                if not read_only:
+                    downloaded_files.save(progress_dir, full=True)
+            print(f"📂 Resuming - {len(downloaded_files)} files already downloaded\n")
+        return downloaded_files
+    
+    def api_get(self, url):
+        """Make a Graph API GET request with automatic token refresh"""
+        return self.api_request('GET', url)
+    
+    def api_request(self, method, url, json_body=None):
+        """Make a Graph API request with automatic token refresh and shared throttling"""
+        token = self.tokens.get_token()
+        headers = {'Authorization': f'Bearer {token}'}
+        with self.counter_lock:
+            self.api_call_count += 1
+        
+        try:
+            response = self.throttle.request(method, url, headers=headers, json=json_body, timeout=30)
+            
+            # If unauthorized, try to refresh token
+            if response.status_code == 401 and self.refresh_token:
+                print("\n⚠️  Token expired, refreshing...")
+                response.close()
+                if self.refresh_access_token(token):
+                    headers['Authorization'] = f'Bearer {self.access_token}'
+                    response = self.throttle.request(method, url, headers=headers, json=json_body, timeout=30)
+                    with self.counter_lock:
+                        self.consecutive_refresh_failures = 0
+                else:
+                    with self.counter_lock:
+                        self.consecutive_refresh_failures += 1
+                        failures = self.consecutive_refresh_failures
+                    if failures >= 3:
+                        print("❌ Failed to refresh token 3 times. Exiting.")
+                        return None
+            
+            # If forbidden, might be a permissions issue with shared folder
+            if response.status_code == 403:
+                print(f"\n⚠️  Access denied (403) - might lack permissions for this item")
+                return response
+            
+            # Success - reset failure counter
+            if response.status_code == 200:
+                with self.counter_lock:
+                    self.consecutive_refresh_failures = 0
+            
+            return response
+            
+        except requests.exceptions.Timeout:
+            print(f"\n⏱️  Request timeout for {url[:50]}... Retrying...")
+            time.sleep(2)
+            try:
+                # Longer timeout on retry
+                return self.throttle.request(method, url, headers=headers, json=json_body, timeout=60)
+            except:
+                return None
+        except requests.exceptions.RequestException as e:
+            print(f"\n❌ Network error: {e}")
+            return None
+    
+    def item_url(self, drive_id, item_id):
+        """Graph URL of an item, addressed through its own drive when known"""
+        if drive_id:
+            return f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item_id}"
+        return f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}"
+    
+    def link_duplicate_folder(self, link_path, target_path):
+        """
+        Point a second path to an already backed-up folder (symlink, or a note file).
+        
+        A shortcut to a folder that contains it always gets a note file: a
+        symlink there would be a loop for anything that walks the backup.
+        """
+        if link_path.exists() or link_path.is_symlink():
+            return
+        relative_target = os.path.relpath(target_path, link_path.parent)
+        if Path(os.path.abspath(target_path)) not in Path(os.path.abspath(link_path)).parents:
+            try:
+                os.symlink(relative_target, link_path, target_is_directory=True)
+                return
+            except (OSError, NotImplementedError):
+                pass  # exFAT/FAT32 drives and unprivileged Windows users cannot create symlinks
+        note = link_path.with_name(link_path.name + self.LINK_NOTE_SUFFIX)
+        with open(note, 'w', encoding='utf-8') as f:
+            f.write(f"This shared folder is backed up at: {relative_target}\n")
+    
+    def iter_drive_files(self, url, local_path, depth=0, make_dirs=True, visited=None, root=None):
+        """
+        Walk a drive folder depth-first and yield (item, local_folder, depth) for every file.
+        
+        Follows @odata.nextLink so folders with more than one page of children
+        are listed completely, and descends into shared (remoteItem) folders.
+        Local folders are created as they are visited unless make_dirs is False.
+        
+        visited maps (driveId, itemId) to the local path of every folder walked
+        so far. A shared folder reachable through several shortcuts is listed
+        and downloaded once; the other paths become links to it, and shortcut
+        cycles end at the first repeat. Folders the selection rules exclude
+        are never listed.
+        """
+        if visited is None:
+            visited = {}
+        if root is None:
+            root = local_path
+        if make_dirs:
+            local_path.mkdir(exist_ok=True, parents=True)
+        print(f"{'  ' * depth}📂 Scanning folder: {local_path.name or 'root'}...")
+        
+        items = []
+        while url:
+            if self.stop_event.is_set():
+                raise KeyboardInterrupt
+            response = self.api_get(url)
+            if response is None or response.status_code != 200:
+                print(f"❌ Error accessing folder: {response.status_code if response else 'No response'}")
+                break
+            page = response.json()
+            items.extend(page.get('value', []))
+            url = page.get('@odata.nextLink')
+        print(f"{'  ' * depth}   Found {len(items)} items")
+        
+        for item in items:
+            name = item['name']
+            item_id = item['id']
+            
+            if ('folder' in item or 'folder' in item.get('remoteItem', {})) and \
+                    self.rules.skips_folder((local_path / name).relative_to(root).as_posix()):
+                print(f"{'  ' * depth}⏭️  Skipping excluded folder: {name}")
+                continue
+            
+            # Check if this is a shared item (has remoteItem facet)
+            if 'remoteItem' in item and 'folder' in item.get('remoteItem', {}):
+                # It's a shared folder
+                remote_item = item['remoteItem']
+                
+                # Check if we have the necessary IDs
+                if 'parentReference' not in remote_item or 'driveId' not in remote_item['parentReference']:
+                    print(f"{'  ' * depth}⚠️  Skipping shared folder (missing driveId): {name}")
+                    continue
+                
+                remote_drive_id = remote_item['parentReference']['driveId']
+                remote_item_id = remote_item.get('id')
+                
+                if not remote_item_id:
+                    print(f"{'  ' * depth}⚠️  Skipping shared folder (missing itemId): {name}")
+                    continue
+                
+                folder_key = (remote_drive_id, remote_item_id)
+                if folder_key in visited:
+                    first_path = visited[folder_key]
+                    print(f"{'  ' * depth}🔗 Shared folder '{name}' already backed up at: {first_path.name}")
+                    if make_dirs:
+                        self.link_duplicate_folder(local_path / name, first_path)
+                    continue
+                visited[folder_key] = local_path / name
+                
+                # Access shared folder using its remote drive/item IDs
+                children_url = f"{self.item_url(remote_drive_id, remote_item_id)}/children"
+                print(f"{'  ' * depth}🔗 Accessing shared folder: {name}")
+                
+                # Try accessing, but don't fail the whole backup if it doesn't work
+                try:
+                    yield from self.iter_drive_files(children_url, local_path / name, depth + 1,
+                                                     make_dirs, visited, root)
+                except Exception as e:
+                    print(f"{'  ' * depth}⚠️  Could not access shared folder '{name}': {e}")
+                    continue
+            
+            elif 'folder' in item:
+                # It's a regular folder, recurse and preserve structure
+                drive_id = item.get('parentReference', {}).get('driveId')
+                folder_key = (drive_id, item_id)
+                if folder_key in visited:
+                    continue
+                visited[folder_key] = local_path / name
+                # Folders inside a shared folder live on the sharer's drive
+                children_url = f"{self.item_url(drive_id, item_id)}/children"
+                yield from self.iter_drive_files(children_url, local_path / name, depth + 1,
+                                                 make_dirs, visited, root)
+            else:
+                yield item, local_path, depth
+    
+    def download_item(self, item, file_path, depth=0):
+        """Download one drive item to file_path; returns the number of bytes written or None"""
+        name = item['name']
+        download_url = item.get('@microsoft.graph.downloadUrl')
+        if not download_url:
+            return None
+        
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        for attempt in range(2):
+            with self.throttle.stream('GET', download_url, timeout=300) as file_response:
+                status = file_response.status_code
+                if status == 200:
+                    return self.save_download(item, file_path, file_response)
+            
+            # If 401, the download URL expired - get a fresh one (after releasing the connection)
+            if status != 401 or attempt:
+                break
+            print(f"  {'  ' * depth}🔄 {name}: URL expired, refreshing...")
+            item_url = self.item_url(item.get('parentReference', {}).get('driveId'), item['id'])
+            fresh_response = self.api_get(item_url)
+            if not fresh_response or fresh_response.status_code != 200:
+                break
+            download_url = fresh_response.json().get('@microsoft.graph.downloadUrl') or download_url
+        
+        print(f"  {'  ' * depth}✗ {name}: Download failed (status {status})")
+        return None
+    
+    def save_download(self, item, file_path, file_response):
+        """Write a streamed download to file_path or the pack store; returns the bytes written"""
+        if self.pack_store and self.pack_store.wants(item.get('size', 0)):
+            data = file_response.content
+            self.pack_store.add(file_path, self.cipher.encrypt_bytes(data) if self.cipher else data)
+            return len(data)
+        
+        # Stream to disk so large files never sit in memory, encrypting on the way when enabled
+        chunks = file_response.iter_content(ChunkCipher.CHUNK_SIZE)
+        with open(file_path, 'wb') as f:
+            if self.cipher:
+                return self.cipher.encrypt_stream(chunks, f)
+            written = 0
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+            return written
+    
+    def open_catalog(self, destination):
+        """Open the destination's backup catalog, or continue without one if SQLite fails"""
+        try:
+            self.catalog = BackupCatalog(destination)
+            self.catalog.import_manifests()
+        except sqlite3.Error as e:
+            print(f"⚠️  Backup catalog unavailable ({e}); every file will be downloaded")
+            self.catalog = None
+        return self.catalog
+    
+    def reuse_previous_copy(self, item, file_path, backup_root):
+        """
+        Fill file_path from an earlier backup holding the same content.
+        
+        Moved, renamed and unchanged files are hardlinked (or copied, on
+        filesystems without hardlinks) instead of being downloaded again.
+        
+        Returns:
+            Number of bytes reused, or None if no earlier copy is available
+        """
+        if not self.catalog:
+            return None
+        size = item.get('size')
+        content_hash = BackupCatalog.content_hash(item.get('file', {}).get('hashes', {}))
+        stored_size = ChunkCipher.stored_size(size) if self.cipher and size is not None else size
+        for snapshot, path in self.catalog.find_copies(item['id'], content_hash, size, backup_root.name):
+            source = self.catalog.open_copy(snapshot, path, stored_size)
+            # Copies are reused byte for byte, so they must be stored the same way as this backup
+            if source is None or ChunkCipher.is_encrypted(source) != (self.cipher is not None):
+                continue
+            
+            if self.pack_store and self.pack_store.wants(size):
+                with source.open('rb') as f:
+                    self.pack_store.add(file_path, f.read())
+                return size
+            
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            if file_path.exists():
+                file_path.unlink()  # Partial file from an interrupted run
+            if isinstance(source, PackedFile):
+                file_path.write_bytes(source.read_bytes())
+                return size
+            try:
+                os.link(source, file_path)
+            except OSError:
+                shutil.copy2(source, file_path)
+            return size
+        return None
+    
+    def load_throughput(self, destination):
+        """Return the throughput observed by the last API backup to this destination"""
+        stats_file = Path(destination) / self.THROUGHPUT_FILE
+        try:
+            with open(stats_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def save_throughput(self, destination, bytes_done, files_done, elapsed):
+        """Record the throughput of this run for future time estimates"""
+        # Tiny runs give meaningless rates
+        if files_done < 10 or elapsed < 30:
+            return
+        with open(Path(destination) / self.THROUGHPUT_FILE, 'w') as f:
+            json.dump({
+                'bytes_per_second': bytes_done / elapsed,
+                'files_per_second': files_done / elapsed,
+                'timestamp': datetime.now().isoformat()
+            }, f, indent=2)
+    
+    def discover_drives(self):
+        """
+        List every drive the account can back up.
+        
+        Covers the account's own drives (/me/drives) and the document libraries
+        of followed SharePoint sites. Sites need the Sites.Read.All permission;
+        without it only the account's own drives are returned.
+        
+        Returns:
+            List of dicts with 'id', 'name' and 'url' (the drive's root children)
+        """
+        drives = {}
+        
+        def add_drives(url, prefix=''):
+            while url:
+                response = self.api_get(url)
+                if response is None or response.status_code != 200:
+                    return False
+                page = response.json()
+                for drive in page.get('value', []):
+                    name = drive.get('name') or drive.get('driveType') or drive['id']
+                    drives.setdefault(drive['id'], {
+                        'id': drive['id'],
+                        'name': f"{prefix}{name}",
+                        'url': f"https://graph.microsoft.com/v1.0/drives/{drive['id']}/root/children"
+                    })
+                url = page.get('@odata.nextLink')
+            return True
+        
+        if not add_drives("https://graph.microsoft.com/v1.0/me/drives"):
+            print("⚠️  Could not list your drives")
+        
+        url = "https://graph.microsoft.com/v1.0/me/followedSites"
+        sites = []
+        while url:
+            response = self.api_get(url)
+            if response is None or response.status_code != 200:
+                if not sites:
+                    print("ℹ️  SharePoint sites skipped (needs the Sites.Read.All permission)")
+                break
+            page = response.json()
+            sites.extend(page.get('value', []))
+            url = page.get('@odata.nextLink')
+        for site in sites:
+            site_name = site.get('displayName') or site.get('name') or site['id']
+            if not add_drives(f"https://graph.microsoft.com/v1.0/sites/{site['id']}/drives", f"{site_name} - "):
+                print(f"⚠️  Could not list the libraries of site '{site_name}'")
+        
+        return sorted(drives.values(), key=lambda drive: (drive['name'].lower(), drive['id']))
+    
+    def drive_folders(self, drives, backup_root):
+        """Give each drive a stable folder name and its own progress folder inside the backup"""
+        used = set()
+        for drive in drives:
+            name = "".join('_' if c in '<>:"/\\|?*' else c for c in drive['name']).strip(' .') or 'Drive'
+            if name.lower() in used:
+                name = f"{name} ({drive['id'][-8:]})"
+            used.add(name.lower())
+            drive['folder'] = backup_root / name
+            key = hashlib.sha256(drive['id'].encode('utf-8')).hexdigest()[:16]
+            drive['progress_dir'] = backup_root / self.DRIVE_PROGRESS_DIR / key
+        return drives
+    
+    def download_from_api(self, destination_drive, include_docs=True, include_pics=True, all_drives=False):
+        """
+        Download files using Microsoft Graph API.
+        
+        By default the signed-in user's OneDrive is backed up into the backup
+        folder itself. With all_drives=True every drive from discover_drives()
+        is backed up into its own subfolder, several drives at a time. Each
+        drive has its own progress store and worker pool, and all of them
+        share one throttle, so a 429 on any drive pauses them all.
+        """
+        if not self.access_token:
+            print("❌ Not authenticated")
+            return False
+        
+        destination = Path(destination_drive)
+        if not destination.exists():
+            print(f"❌ Destination drive '{destination_drive}' not found!")
+            return False
+        
+        self.rules = self.rules.with_types(include_docs, include_pics)
+        if self.rules.describe():
+            print(f"🎯 Selection: {self.rules.describe()}")
+        backup_root = self.choose_backup_root(destination)
+        if all_drives:
+            with RunProfiler.phase("discover drives"):
+                drives = self.drive_folders(self.discover_drives(), backup_root)
+            if not drives:
+                print("❌ No drives found")
+                return False
+            print(f"\n💽 Backing up {len(drives)} drive(s), {self.parallel_drives} at a time:")
+            for drive in drives:
+                print(f"   • {drive['name']} → {drive['folder'].name}/")
+        else:
+            drives = [{'id': None, 'name': 'OneDrive', 'folder': backup_root, 'progress_dir': backup_root,
+                       'url': "https://graph.microsoft.com/v1.0/me/drive/root/children"}]
+        if self.pack_threshold:
+            self.pack_store = PackStore(backup_root, self.pack_threshold)
+        with RunProfiler.phase("open catalog"):
+            self.open_catalog(destination)
+        
+        print(f"💾 Backup destination: {backup_root}\n")
+        print("📥 Downloading files from OneDrive (preserving folder structure)...\n")
+        if self.download_order != 'folder':
+            print(f"   Order: {self.DOWNLOAD_ORDERS[self.download_order]} "
+                  f"(the whole drive is listed before downloads start)\n")
+        
+        # One request budget for the whole run; each drive gets its own worker pool within it
+        parallel = min(self.parallel_drives, len(drives))
+        self.throttle = GraphThrottle(max_concurrent=min(self.GLOBAL_MAX_REQUESTS, self.download_workers * parallel))
+        self.stop_event.clear()
+        started = time.time()
+        results = []
+        
+        if len(drives) == 1:
+            results.append(self.backup_drive(drives[0], backup_root))
+        else:
+            progress_file = backup_root / ".progress.json"
+            with open(progress_file, 'w') as f:
+                # Marks the whole backup as in progress for resume and prune
+                json.dump({'drives': len(drives), 'timestamp': datetime.now().isoformat()}, f)
+            with ThreadPoolExecutor(max_workers=parallel) as drive_pool:
+                futures = [drive_pool.submit(self.backup_drive, drive, backup_root) for drive in drives]
+                try:
+                    for future in futures:
+                        results.append(future.result())
+                except KeyboardInterrupt:
+                    # Worker threads never see Ctrl+C; ask them to stop and save their progress
+                    print("\n\n⏸️  Stopping - letting every drive save its progress...")
+                    self.stop_event.set()
+                    results = [future.result() for future in futures]
+        
+        if self.pack_store:
+            self.pack_store.close()
+        if self.catalog:
+            self.catalog.close()
+        bytes_downloaded = sum(r['bytes_downloaded'] for r in results)
+        files_downloaded = sum(r['files_downloaded'] for r in results)
+        self.save_throughput(destination, bytes_downloaded, files_downloaded, time.time() - started)
+        complete = all(r['status'] == 'complete' for r in results)
+        
+        if not complete:
+            if len(drives) > 1:
+                with open(backup_root / ".progress.json", 'w') as f:
+                    json.dump({'drives': len(drives),
+                               'downloaded_count': sum(r['copied_files'] for r in results),
+                               'timestamp': datetime.now().isoformat()}, f)
+            print(f"\nProgress saved! Run the script again and resume {backup_root.name} to continue.")
+            print(f"Downloaded so far: {sum(r['copied_files'] for r in results)} files")
+            return False
+        
+        # Print summary
+        print("\n" + "="*50)
+        print("📊 BACKUP SUMMARY")
+        print("="*50)
+        if len(drives) > 1:
+            for drive, r in zip(drives, results):
+                print(f"{drive['name']}: {r['copied_files']} files")
+        print(f"Total files found: {sum(r['total_files'] for r in results)}")
+        print(f"Successfully downloaded: {sum(r['copied_files'] for r in results)}")
+        reused_files = sum(r['reused_files'] for r in results)
+        if reused_files:
+            print(f"Reused from earlier backups (no download): {reused_files}")
+        if self.throttle.throttled_count:
+            print(f"Throttled responses: {self.throttle.throttled_count}")
+        print(f"Backup location: {backup_root}")
+        print(f"\n✅ Folder structure preserved exactly as in OneDrive!")
+        
+        if len(drives) > 1:
+            (backup_root / ".progress.json").unlink(missing_ok=True)
+            shutil.rmtree(backup_root / self.DRIVE_PROGRESS_DIR, ignore_errors=True)
+        return True
+    
+    def backup_drive(self, drive, backup_root):
+        """
+        Back up the files of one drive selected by self.rules into drive['folder'],
+        with its own progress store and worker pool.
+        
+        Returns:
+            Stats dict; 'status' is 'complete', 'interrupted' or 'failed'
+        """
+        progress_dir = drive['progress_dir']
+        progress_dir.mkdir(parents=True, exist_ok=True)
+        progress_file = progress_dir / ".progress.json"
+        downloaded_files = self.load_progress(progress_dir)
+        stats = {'total_files': 0, 'copied_files': len(downloaded_files), 'reused_files': 0,
+                 'files_downloaded': 0, 'bytes_downloaded': 0, 'status': 'complete'}
+        scanned_files = 0
+        # Drives of an all-drives backup keep their progress until every drive is done
+        shared_backup = progress_dir != backup_root
+        if shared_backup and progress_file.exists():
+            with open(progress_file, 'r') as f:
+                if json.load(f).get('complete'):
+                    print(f"✓ {drive['name']} already finished in this backup")
+                    return stats
+        
+        def save_progress(complete=False):
+            """Save current progress to file"""
+            # The index already holds everything loaded on resume, so only new
+            # keys are appended; the JSON file just carries the summary
+            with RunProfiler.phase("save progress"):
+                if self.pack_store:
+                    # Packed bytes must be on disk before the items count as done
+                    self.pack_store.flush()
+                if self.catalog:
+                    self.catalog.commit()
+                downloaded_files.save(progress_dir)
+                with open(progress_file, 'w') as f:
+                    json.dump({
+                        'downloaded_count': len(downloaded_files),
+                        'complete': complete,
+                        'timestamp': datetime.now().isoformat()
+                    }, f)
+        
+        def find_jobs():
+            """Yield the selected files that still need backing up"""
+            nonlocal scanned_files
+            for item, local_path, depth in self.iter_drive_files(drive['url'], drive['folder']):
+                if self.stop_event.is_set():
+                    raise KeyboardInterrupt
+                # Check the selection rules
+                rel_path = (local_path / item['name']).relative_to(drive['folder']).as_posix()
+                if not self.rules.wants_file(rel_path, item.get('size'), item.get('lastModifiedDateTime')):
+                    continue
+                
+                scanned_files += 1
+                
+                # Show scan progress every 100 files
+                if scanned_files % 100 == 0:
+                    print(f"  ⏳ Scanned {scanned_files} files, found {stats['total_files']} to download...", end='\r')
+                
+                # Skip if already downloaded
+                if item['id'] in downloaded_files:
+                    # Silent skip - don't count or print
+                    continue
+                
+                stats['total_files'] += 1
+                yield item, local_path, depth
+        
+        def fetch(item, file_path, depth):
+            """Worker: fill one file from an earlier backup or download it"""
+            size = self.reuse_previous_copy(item, file_path, backup_root)
+            if size is not None:
+                return size, True
+            return self.download_item(item, file_path, depth), False
+        
+        def finish(job, future):
+            """Drive thread: record a finished job and report it"""
+            item, local_path, depth = job
+            name = item['name']
+            item_id = item['id']
+            # Preserve exact folder structure
+            file_path = local_path / name
+            try:
+                size, reused = future.result()
+            except Exception as e:
+                print(f"  {'  ' * depth}✗ {name}: {e}")
+                return
+            if size is None:
+                return
+            
+            stats['copied_files'] += 1
+            if reused:
+                stats['reused_files'] += 1
+            else:
+                stats['files_downloaded'] += 1
+                stats['bytes_downloaded'] += size
+            downloaded_files.add(item_id)
+            rel_path = file_path.relative_to(backup_root)
+            hashes = item.get('file', {}).get('hashes', {})
+            entry = {
+                'id': item_id,
+                'size': size,
+                'modified': item.get('lastModifiedDateTime'),
+                'hashes': hashes
+            }
+            if self.cipher:
+                entry['encrypted'] = True
+            self.record_manifest(backup_root, rel_path, entry)
+            if self.catalog:
+                self.catalog.record(backup_root.name, rel_path.as_posix(), item_id,
+                                    BackupCatalog.content_hash(hashes), size,
+                                    item.get('lastModifiedDateTime'))
+            
+            # Save progress every 10 files
+            if stats['copied_files'] % 10 == 0:
+                save_progress()
+            
+            # Show relative path from backup root
+            mark = '↪' if reused else '✓'
+            print(f"  [{'  ' * depth}{stats['copied_files']}/{stats['total_files']}] {mark} {rel_path}")
+        
+        pool = ThreadPoolExecutor(max_workers=self.download_workers)
+        in_flight = {}
+        
+        def finish_some():
+            """Drive thread: record the next finished jobs, or give up if asked to stop"""
+            if self.stop_event.is_set():
+                raise KeyboardInterrupt
+            # The timeout keeps a stop request from waiting on a long download
+            done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                finish(in_flight.pop(future), future)
+        
+        def stop_downloads():
+            """Cancel queued jobs, let running ones end and keep what they finished"""
+            for future in in_flight:
+                future.cancel()
+            pool.shutdown()
+            for future, job in list(in_flight.items()):
+                if not future.cancelled():
+                    finish(job, future)
+            in_flight.clear()
+        
+        try:
+            with RunProfiler.phase("download"):
+                for job in self.schedule_jobs(find_jobs(), self.download_order):
+                    if self.stop_event.is_set():
+                        raise KeyboardInterrupt
+                    # Bound the queue so a streamed listing never runs far ahead of the downloads
+                    while len(in_flight) >= self.download_workers * 4:
+                        finish_some()
+                    item, local_path, depth = job
+                    in_flight[pool.submit(fetch, item, local_path / item['name'], depth)] = job
+                
+                while in_flight:
+                    finish_some()
+            pool.shutdown()
+            
+            # Final progress save, then clean up the progress files on successful completion
+            save_progress(complete=shared_backup)
+            if not shared_backup:
+                progress_file.unlink()
+                CompactIdIndex.remove_files(progress_dir)
+            
+        except KeyboardInterrupt:
+            if not self.stop_event.is_set():
+                print("\n\n⏸️  Backup interrupted by user.")
+            stop_downloads()
+            save_progress()
+            stats['status'] = 'interrupted'
+        except Exception as e:
+            print(f"❌ Download error ({drive['name']}): {e}")
+            stop_downloads()
+            save_progress()
+            stats['status'] = 'failed'
+        return stats
+    
+    def schedule_jobs(self, jobs, order='folder'):
+        """
+        Order download jobs (item, local_folder, depth) by a scheduling policy.
+        
+        'folder' streams jobs in traversal order. The other policies list the
+        whole drive first so the files most at risk are protected first:
+        'recent' by lastModifiedDateTime descending, 'smallest' by size to
+        maximise files protected per minute, and 'recent-smallest' by day
+        modified (newest first) with small files first within each day.
+        """
+        if order == 'folder':
+            return jobs
+        
+        def modified(job):
+            return job[0].get('lastModifiedDateTime') or ''
+        
+        def size(job):
+            return job[0].get('size', 0)
+        
+        jobs = list(jobs)
+        if order == 'recent':
+            jobs.sort(key=modified, reverse=True)
+        elif order == 'smallest':
+            jobs.sort(key=size)
+        elif order == 'recent-smallest':
+            # ISO timestamps sort correctly as text; the first 10 characters are the day
+            jobs.sort(key=size)
+            jobs.sort(key=lambda job: modified(job)[:10], reverse=True)
+        return jobs
+    
+    def plan_from_api(self, destination_drive, include_docs=True, include_pics=True, all_drives=False):
+        """
+        Preview an API backup without downloading anything or changing any file.
+        
+        Lists the drive (every drive from discover_drives() with all_drives),
+        applies the selection rules and the resume state of the chosen
+        backup, and estimates the run time from the throughput observed by
+        the last backup to the same destination.
+        
+        Returns:
+            Dict with file counts, byte totals and the estimated seconds (or None)
+        """
+        if not self.access_token:
+            print("❌ Not authenticated")
+            return None
+        
+        destination = Path(destination_drive)
+        if not destination.exists():
+            print(f"❌ Destination drive '{destination_drive}' not found!")
+            return None
+        
+        self.rules = self.rules.with_types(include_docs, include_pics)
+        if self.rules.describe():
+            print(f"🎯 Selection: {self.rules.describe()}")
+        backup_root = self.choose_backup_root(destination, create=False)
+        if all_drives:
+            drives = self.drive_folders(self.discover_drives(), backup_root)
+            if not drives:
+                print("❌ No drives found")
+                return None
+        else:
+            drives = [{'id': None, 'name': 'OneDrive', 'folder': backup_root, 'progress_dir': backup_root,
+                       'url': "https://graph.microsoft.com/v1.0/me/drive/root/children"}]
+        
+        plan = {'files': 0, 'bytes': 0, 'files_left': 0, 'bytes_left': 0, 'estimated_seconds': None}
+        
+        print("🧮 Planning backup (nothing will be downloaded)...\n")
+        for drive in drives:
+            if len(drives) > 1:
+                print(f"💽 {drive['name']}")
+            progress_dir = drive['progress_dir']
+            downloaded_files = CompactIdIndex()
+            if progress_dir.exists():
+                downloaded_files = self.load_progress(progress_dir, read_only=True)
+            for item, local_path, _ in self.iter_drive_files(drive['url'], drive['folder'], make_dirs=False):
+                rel_path = (local_path / item['name']).relative_to(drive['folder']).as_posix()
+                if not self.rules.wants_file(rel_path, item.get('size'), item.get('lastModifiedDateTime')):
+                    continue
+                size = item.get('size', 0)
+                plan['files'] += 1
+                plan['bytes'] += size
+                if item['id'] not in downloaded_files:
+                    plan['files_left'] += 1
+                    plan['bytes_left'] += size
+        
+        # Small files are bound by request latency, large ones by bandwidth,
+        # so take whichever observed rate predicts the longer run
+        throughput = self.load_throughput(destination)
+        if throughput:
+            plan['estimated_seconds'] = max(
+                plan['bytes_left'] / max(throughput['bytes_per_second'], 1),
+                plan['files_left'] / max(throughput['files_per_second'], 1e-6))
+        
+        print("\n" + "="*50)
+        print("🧮 BACKUP PLAN")
+        print("="*50)
+        print(f"Files selected:    {plan['files']} ({plan['bytes'] / (1024**3):.2f} GB)")
+        print(f"Already backed up: {plan['files'] - plan['files_left']}")
+        print(f"Files left:        {plan['files_left']} ({plan['bytes_left'] / (1024**3):.2f} GB)")
+        if plan['estimated_seconds'] is not None:
+            hours, rest = divmod(int(plan['estimated_seconds']), 3600)
+            print(f"Estimated time:    {hours}h {rest // 60:02d}m "
+                  f"(at {throughput['bytes_per_second'] / (1024**2):.1f} MB/s observed)")
+        else:
+            print("Estimated time:    unknown (no previous online backup to this drive)")
+        print(f"API calls made:    {self.api_call_count}")
+        
+        return plan
+    
+
+    def record_manifest(self, backup_root, rel_path, entry):
+        """Append one file's record to the backup manifest"""
+        entry = dict(entry, path=Path(rel_path).as_posix())
+        with self.manifest_lock:
+            with open(Path(backup_root) / self.MANIFEST_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+    
+    def load_manifest(self, backup_root):
+        """Read the backup manifest into a dict keyed by relative path (latest record wins)"""
+        manifest = {}
+        manifest_file = Path(backup_root) / self.MANIFEST_FILE
+        if manifest_file.exists():
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from an interrupted run
+                    manifest[entry['path']] = entry
+        return manifest
+    
+    def iter_backup_files(self, backup_root):
+        """
+        Yield (relative posix path, source) for every user file in a backup folder.
         
-        print("After signing in, your browser will show an error page.")
-        print("That's normal! Just copy the URL from your browser.")
-        redirect_response = input("\nPaste the full redirect URL here: ").strip()
+        Notes written for shared-folder links are not user files and are left
+        out. Loose files come back as Paths and packed small files as PackedFile
+        objects; both support open('rb') and stat(). Once the drive's
+        encryption is unlocked, encrypted files are wrapped to read as
+        plaintext.
+        """
+        backup_root = Path(backup_root)
+        for root, dirs, files in os.walk(backup_root):
+            if Path(root) == backup_root:
+                for skip in (PackStore.PACK_DIR, self.DRIVE_PROGRESS_DIR):
+                    if skip in dirs:
+                        dirs.remove(skip)
+            dirs.sort()
+            for name in sorted(files):
+                path = Path(root) / name
+                rel_path = path.relative_to(backup_root).as_posix()
+                if rel_path in self.METADATA_FILES or name.endswith(self.LINK_NOTE_SUFFIX):
+                    continue
+                yield rel_path, self.plaintext_source(path)
+        for rel_path, packed in sorted(PackStore.read_index(backup_root).items()):
+            yield rel_path, self.plaintext_source(packed)
+    
+    def plaintext_source(self, source):
+        """Wrap an encrypted backup file so it reads as plaintext (needs the unlocked key)"""
+        if self.cipher and ChunkCipher.is_encrypted(source):
+            return EncryptedFile(source, self.cipher.key)
+        return source
+    
+    def locate_backup_file(self, backup_root, rel_path):
+        """Find one file of a backup by its manifest path without walking the folder"""
+        loose = Path(backup_root) / rel_path
+        if loose.is_file():
+            return self.plaintext_source(loose)
+        packed = PackStore.read_index(backup_root).get(rel_path)
+        return self.plaintext_source(packed) if packed is not None else None
+    
+    def extract_files(self, backup_folder, path, output_folder):
+        """
+        Copy one file, or every file under a folder, out of a backup to local disk.
         
-        # Extract code from URL
-        try:
-            from urllib.parse import urlparse, parse_qs
-            parsed = urlparse(redirect_response)
-            code = parse_qs(parsed.query)['code'][0]
-        except:
-            print("❌ Could not extract authorization code from URL")
+        Files are found through the manifest, and encrypted ones are decrypted
+        on the way out, so nothing else in the backup is read.
+        """
+        backup_root = Path(backup_folder)
+        manifest = self.load_manifest(backup_root)
+        path = path.strip('/')
+        wanted = [rel_path for rel_path in sorted(manifest)
+                  if rel_path == path or rel_path.startswith(path + '/') or not path]
+        if not wanted:
+            print(f"❌ '{path}' is not in the manifest of {backup_root.name}")
             return False
         
-        # Exchange code for tokens
-        token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
-        data = {
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'code': code,
-            'redirect_uri': redirect_uri,
-            'grant_type': 'authorization_code'
-        }
+        output = Path(output_folder)
+        failed = 0
+        for rel_path in wanted:
+            source = self.locate_backup_file(backup_root, rel_path)
+            if source is None:
+                print(f"  ✗ {rel_path}: missing from the backup")
+                failed += 1
+                continue
+            if manifest[rel_path].get('encrypted') and not isinstance(source, EncryptedFile):
+                print(f"  ✗ {rel_path}: encrypted - unlock the drive's passphrase first")
+                failed += 1
+                continue
+            dest = output / rel_path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with source.open('rb') as src, open(dest, 'wb') as out:
+                    shutil.copyfileobj(src, out, ChunkCipher.CHUNK_SIZE)
+            except (OSError, ValueError) as e:
+                print(f"  ✗ {rel_path}: {e}")
+                failed += 1
+                continue
+            print(f"  ✓ {rel_path}")
         
-        try:
-            response = requests.post(token_url, data=data)
-            result = response.json()
-            
-            if 'access_token' in result:
-                self.access_token = result['access_token']
-                self.refresh_token = result.get('refresh_token')
-                self.use_api = True
-                print("✅ Successfully authenticated!\n")
-                return True
-            else:
-                print(f"❌ Token exchange failed: {result.get('error_description', 'Unknown error')}")
+        print(f"\n📦 Extracted {len(wanted) - failed} of {len(wanted)} file(s) to {output}")
+        return not failed
+    
+    def unlock_encryption(self, destination, create=False):
+        """
+        Ask for the passphrase of a drive's encrypted backups.
+        
+        Does nothing (and succeeds) when the drive has no encrypted backups and
+        create is False. With create=True a new passphrase is set up on first use.
+        """
+        config_file = Path(destination) / ChunkCipher.CONFIG_FILE
+        if not create and not config_file.exists():
+            return True
+        if AESGCM is None:
+            print("❌ Encrypted backups need the cryptography package: pip install cryptography")
+            return False
+        if not Path(destination).exists():
+            print(f"❌ Destination drive '{destination}' not found!")
+            return False
+        
+        if config_file.exists():
+            passphrase = getpass.getpass("🔒 Backup passphrase: ")
+        else:
+            print("\n🔒 Choose a passphrase for the backups on this drive.")
+            print("   Without it the backups cannot be read - there is no recovery.")
+            passphrase = getpass.getpass("Passphrase: ")
+            if not passphrase or passphrase != getpass.getpass("Repeat passphrase: "):
+                print("❌ Passphrases are empty or do not match")
                 return False
-        except Exception as e:
-            print(f"❌ Authentication error: {e}")
+        try:
+            self.cipher = ChunkCipher.from_passphrase(destination, passphrase)
+        except ValueError as e:
+            print(f"❌ {e}")
             return False
+        return True
     
-    def refresh_access_token(self):
-        """Refresh the access token using refresh token"""
-        if not self.refresh_token:
+    def remote_matches(self, remote_item, local_path, manifest_entry):
+        """Check whether a OneDrive item already holds the same content as a local file"""
+        remote_hashes = remote_item.get('file', {}).get('hashes', {})
+        if remote_item.get('size') != local_path.stat().st_size:
             return False
         
-        print("🔄 Refreshing access token...")
-        token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
-        data = {
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'refresh_token': self.refresh_token,
-            'grant_type': 'refresh_token'
-        }
+        local_hashes = {}
+        if manifest_entry and manifest_entry.get('size') == remote_item.get('size'):
+            local_hashes = manifest_entry.get('hashes', {})
         
-        try:
-            response = requests.post(token_url, data=data)
-            result = response.json()
-            
-            if 'access_token' in result:
-                self.access_token = result['access_token']
-                self.refresh_token = result.get('refresh_token', self.refresh_token)
-                print("✅ Token refreshed!")
-                return True
+        if 'quickXorHash' in remote_hashes:
+            local_hash = local_hashes.get('quickXorHash') or quickxor_hash(local_path)
+            return remote_hashes['quickXorHash'] == local_hash
+        if 'sha1Hash' in remote_hashes:
+            local_hash = local_hashes.get('sha1Hash') or sha1_hash(local_path)
+            return remote_hashes['sha1Hash'].lower() == local_hash.lower()
+        return False
+    
+    def upload_file(self, local_path, remote_path, sessions):
+        """
+        Upload one file through a resumable Graph upload session.
+        
+        sessions (UploadSessions) holds the upload URLs of unfinished sessions,
+        so an interrupted restore continues from the last byte OneDrive confirmed.
+        """
+        size = local_path.stat().st_size
+        item_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{quote(remote_path)}"
+        
+        if size == 0:
+            # Upload sessions cannot carry an empty body
+            response = self.api_request('PUT', f"{item_url}:/content")
+            return response is not None and response.status_code in (200, 201)
+        
+        offset = 0
+        upload_url = sessions.get(remote_path)
+        if upload_url:
+            # Ask OneDrive which bytes it still needs from the earlier session
+            status = self.throttle.request('GET', upload_url, timeout=30)
+            if status.status_code == 200:
+                ranges = status.json().get('nextExpectedRanges', ['0-'])
+                offset = int(ranges[0].split('-')[0]) if ranges else 0
             else:
-                print(f"❌ Token refresh failed: {result.get('error_description', 'Unknown error')}")
+                upload_url = None
+        
+        if not upload_url:
+            response = self.api_request('POST', f"{item_url}:/createUploadSession",
+                                        {'item': {'@microsoft.graph.conflictBehavior': 'replace'}})
+            if response is None or response.status_code != 200:
                 return False
-        except Exception as e:
-            print(f"❌ Token refresh error: {e}")
-            return False
+            upload_url = response.json()['uploadUrl']
+            sessions.start(remote_path, upload_url)
+        
+        with local_path.open('rb') as f:
+            while offset < size:
+                f.seek(offset)
+                chunk = f.read(self.UPLOAD_CHUNK_SIZE)
+                # The upload URL is pre-authenticated; sending a bearer token is rejected
+                response = self.throttle.request('PUT', upload_url, data=chunk, timeout=300, headers={
+                    'Content-Length': str(len(chunk)),
+                    'Content-Range': f"bytes {offset}-{offset + len(chunk) - 1}/{size}",
+                })
+                if response.status_code in (200, 201):
+                    sessions.finish(remote_path)
+                    return True
+                if response.status_code != 202:
+                    return False
+                ranges = response.json().get('nextExpectedRanges') or [f"{offset + len(chunk)}-"]
+                offset = int(ranges[0].split('-')[0])
+        
+        sessions.finish(remote_path)
+        return True
+    
+    def restore_file(self, local_path, remote_path, manifest_entry, sessions):
+        """Restore one backed-up file; returns 'uploaded', 'skipped' or 'failed'"""
+        item_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{quote(remote_path)}"
+        existing = self.api_get(item_url)
+        if existing is not None and existing.status_code == 200:
+            if self.remote_matches(existing.json(), local_path, manifest_entry):
+                return 'skipped'
+        return 'uploaded' if self.upload_file(local_path, remote_path, sessions) else 'failed'
     
-    def download_from_api(self, destination_drive, include_docs=True, include_pics=True):
-        """Download files using Microsoft Graph API"""
+    def restore_to_onedrive(self, backup_folder, target_path, workers=4):
+        """
+        Upload a backup folder back into OneDrive under target_path.
+        
+        Files are uploaded in parallel through resumable upload sessions, and
+        files already present with the same hash are skipped. Unfinished
+        sessions are remembered in the backup folder, so running the same
+        restore again continues where it stopped.
+        """
         if not self.access_token:
             print("❌ Not authenticated")
             return False
         
-        destination = Path(destination_drive)
-        if not destination.exists():
-            print(f"❌ Destination drive '{destination_drive}' not found!")
+        backup_root = Path(backup_folder)
+        if not backup_root.is_dir():
+            print(f"❌ Backup folder '{backup_folder}' not found!")
             return False
         
-        # Check for existing backups
-        existing_backups = sorted([d for d in destination.glob("OneDrive_Backup_*") if d.is_dir()], 
-                                 key=lambda x: x.stat().st_mtime, reverse=True)
+        target_path = target_path.strip('/')
+        manifest = self.load_manifest(backup_root)
+        state_file = backup_root / self.RESTORE_STATE_FILE
+        sessions = UploadSessions()
+        if state_file.exists():
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state.get('target') == target_path:
+                sessions = UploadSessions(state.get('sessions'))
+                print(f"📂 Resuming {len(sessions)} unfinished upload(s)")
         
-        backup_root = None
-        if existing_backups:
-            print("\n📂 Found existing backup(s):")
-            for i, backup in enumerate(existing_backups[:5], 1):  # Show up to 5 most recent
-                progress_file = backup / ".progress.json"
-                if progress_file.exists():
-                    with open(progress_file, 'r') as f:
-                        progress_data = json.load(f)
-                        file_count = len(progress_data.get('downloaded_files', []))
-                    print(f"  {i}. {backup.name} ({file_count} files already downloaded)")
-                else:
-                    print(f"  {i}. {backup.name} (complete)")
-            
-            print(f"  {len(existing_backups) + 1}. Start a new backup")
-            
-            choice = input(f"\nResume which backup? (1-{len(existing_backups) + 1}): ").strip()
-            try:
-                choice_num = int(choice)
-                if 1 <= choice_num <= len(existing_backups):
-                    backup_root = existing_backups[choice_num - 1]
-                    print(f"\n✓ Resuming: {backup_root.name}")
-            except (ValueError, IndexError):
-                pass
+        state_lock = threading.Lock()
         
-        # Create new backup if no existing one selected
-        if backup_root is None:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_root = destination / f"OneDrive_Backup_{timestamp}"
-            backup_root.mkdir(exist_ok=True)
-            print(f"\n✓ Starting new backup: {backup_root.name}")
+        def save_state():
+            with state_lock:
+                with open(state_file, 'w') as f:
+                    json.dump({'target': target_path, 'sessions': sessions.snapshot()}, f)
         
-        # Progress tracking
-        self.progress_file = backup_root / ".progress.json"
-        if self.progress_file.exists():
-            with open(self.progress_file, 'r') as f:
-                progress_data = json.load(f)
-                self.downloaded_files = set(progress_data.get('downloaded_files', []))
-            print(f"📂 Resuming - {len(self.downloaded_files)} files already downloaded\n")
+        with RunProfiler.phase("scan"):
+            files = list(self.iter_backup_files(backup_root))
+        self.throttle = GraphThrottle(max_concurrent=workers)
+        counts = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+        failed_files = []
         
-        print(f"💾 Backup destination: {backup_root}\n")
+        print(f"\n📤 Restoring {len(files)} files to OneDrive:/{target_path} with {workers} workers...\n")
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {}
+                for rel_path, local_path in files:
+                    remote_path = f"{target_path}/{rel_path}" if target_path else rel_path
+                    futures[pool.submit(self.restore_file, local_path, remote_path,
+                                        manifest.get(rel_path), sessions)] = rel_path
+                
+                for done, future in enumerate(as_completed(futures), 1):
+                    rel_path = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"  ✗ {rel_path}: {e}")
+                        result = 'failed'
+                    counts[result] += 1
+                    if result == 'failed':
+                        failed_files.append(rel_path)
+                    else:
+                        mark = '✓' if result == 'uploaded' else '='
+                        print(f"  [{done}/{len(files)}] {mark} {rel_path}")
+                    if done % 10 == 0:
+                        save_state()
+        except KeyboardInterrupt:
+            save_state()
+            print("\n\n⏸️  Restore interrupted. Run the same restore again to resume.")
+            return False
         
-        headers = {'Authorization': f'Bearer {self.access_token}'}
-        graph_url = "https://graph.microsoft.com/v1.0/me/drive/root/children"
+        if len(sessions) or failed_files:
+            save_state()
+        elif state_file.exists():
+            state_file.unlink()
         
-        doc_extensions = {'.pdf', '.docx', '.doc', '.txt', '.xlsx', '.xls', 
-                         '.pptx', '.ppt', '.odt', '.rtf', '.csv'}
-        pic_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', 
-                         '.svg', '.webp', '.heic', '.raw'}
+        print("\n" + "="*50)
+        print("📊 RESTORE SUMMARY")
+        print("="*50)
+        print(f"Uploaded: {counts['uploaded']}")
+        print(f"Skipped (already in OneDrive): {counts['skipped']}")
+        print(f"Failed: {counts['failed']}")
+        if self.throttle.throttled_count:
+            print(f"Throttled responses: {self.throttle.throttled_count}")
+        for rel_path in failed_files[:10]:
+            print(f"  - {rel_path}")
+        if len(failed_files) > 10:
+            print(f"  ... and {len(failed_files) - 10} more")
         
-        total_files = 0
-        copied_files = len(self.downloaded_files)
-        api_call_count = 0
-        consecutive_refresh_failures = 0
-        scanned_files = 0
+        return not failed_files
+    
+    def verify_backup(self, backup_folder, workers=None):
+        """
+        Re-hash a finished backup and compare it with its manifest.
         
-        def save_progress():
-            """Save current progress to file"""
-            # If progress file exists, merge with existing data
-            existing_files = set()
-            if self.progress_file.exists():
-                try:
-                    with open(self.progress_file, 'r') as f:
-                        existing_data = json.load(f)
-                        existing_files = set(existing_data.get('downloaded_files', []))
-                except:
-                    pass
-            
-            # Merge existing and new downloaded files
-            all_downloaded = existing_files | self.downloaded_files
-            
-            with open(self.progress_file, 'w') as f:
-                json.dump({
-                    'downloaded_files': list(all_downloaded),
-                    'timestamp': datetime.now().isoformat()
-                }, f)
+        Files are hashed on a process pool, so verification runs at disk speed
+        instead of being limited to one core. Reports files that are missing,
+        not in the manifest (extra), or whose size or hash differs (corrupt).
         
-        def make_api_request(url):
-            """Make API request with automatic token refresh"""
-            nonlocal api_call_count, consecutive_refresh_failures
-            api_call_count += 1
-            
-            try:
-                response = requests.get(url, headers=headers, timeout=30)
-                
-                # If unauthorized, try to refresh token
-                if response.status_code == 401 and self.refresh_token:
-                    print("\n⚠️  Token expired, refreshing...")
-                    if self.refresh_access_token():
-                        headers['Authorization'] = f'Bearer {self.access_token}'
-                        response = requests.get(url, headers=headers, timeout=30)
-                        consecutive_refresh_failures = 0
-                    else:
-                        consecutive_refresh_failures += 1
-                        if consecutive_refresh_failures >= 3:
-                            print("❌ Failed to refresh token 3 times. Exiting.")
-                            return None
-                
-                # If forbidden, might be a permissions issue with shared folder
-                if response.status_code == 403:
-                    print(f"\n⚠️  Access denied (403) - might lack permissions for this item")
-                    return response
-                
-                # Success - reset failure counter
-                if response.status_code == 200:
-                    consecutive_refresh_failures = 0
-                
-                return response
-                
-            except requests.exceptions.Timeout:
-                print(f"\n⏱️  Request timeout for {url[:50]}... Retrying...")
-                import time
-                time.sleep(2)
-                try:
-                    return requests.get(url, headers=headers, timeout=60)  # Longer timeout on retry
-                except:
-                    return None
-            except requests.exceptions.RequestException as e:
-                print(f"\n❌ Network error: {e}")
-                return None
+        Returns:
+            Dict with 'verified', 'missing', 'extra' and 'corrupt' lists
+        """
+        backup_root = Path(backup_folder)
+        manifest = self.load_manifest(backup_root)
+        if not manifest:
+            print(f"❌ No {self.MANIFEST_FILE} in '{backup_folder}' - nothing to verify against")
+            return None
         
-        try:
-            def download_folder(url, local_path, depth=0):
-                nonlocal total_files, copied_files, scanned_files
-                
-                print(f"{'  ' * depth}📂 Scanning folder: {local_path.name or 'root'}...")
-                
-                response = make_api_request(url)
-                if response is None or response.status_code != 200:
-                    print(f"❌ Error accessing folder: {response.status_code if response else 'No response'}")
-                    return
-                
-                items = response.json().get('value', [])
-                print(f"{'  ' * depth}   Found {len(items)} items")
-                
-                for item in items:
-                    name = item['name']
-                    item_id = item['id']
-                    
-                    # Check if this is a shared item (has remoteItem facet)
-                    if 'remoteItem' in item and 'folder' in item.get('remoteItem', {}):
-                        # It's a shared folder
-                        remote_item = item['remoteItem']
-                        
-                        # Check if we have the necessary IDs
-                        if 'parentReference' not in remote_item or 'driveId' not in remote_item['parentReference']:
-                            print(f"{'  ' * depth}⚠️  Skipping shared folder (missing driveId): {name}")
-                            continue
-                        
-                        remote_drive_id = remote_item['parentReference']['driveId']
-                        remote_item_id = remote_item.get('id')
-                        
-                        if not remote_item_id:
-                            print(f"{'  ' * depth}⚠️  Skipping shared folder (missing itemId): {name}")
-                            continue
-                        
-                        new_local_path = local_path / name
-                        new_local_path.mkdir(exist_ok=True, parents=True)
-                        
-                        # Access shared folder using its remote drive/item IDs
-                        children_url = f"https://graph.microsoft.com/v1.0/drives/{remote_drive_id}/items/{remote_item_id}/children"
-                        print(f"{'  ' * depth}🔗 Accessing shared folder: {name}")
-                        
-                        # Try accessing, but don't fail the whole backup if it doesn't work
-                        try:
-                            download_folder(children_url, new_local_path, depth + 1)
-                        except Exception as e:
-                            print(f"{'  ' * depth}⚠️  Could not access shared folder '{name}': {e}")
-                            continue
-                    
-                    elif 'folder' in item:
-                        # It's a regular folder, recurse and preserve structure
-                        new_local_path = local_path / name
-                        new_local_path.mkdir(exist_ok=True, parents=True)
-                        children_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}/children"
-                        download_folder(children_url, new_local_path, depth + 1)
-                    else:
-                        # It's a file
-                        ext = Path(name).suffix.lower()
-                        should_download = False
-                        
-                        # Check if we should download this file type
-                        if include_docs and ext in doc_extensions:
-                            should_download = True
-                        elif include_pics and ext in pic_extensions:
-                            should_download = True
-                        
-                        if should_download:
-                            scanned_files += 1
-                            
-                            # Show scan progress every 100 files
-                            if scanned_files % 100 == 0:
-                                print(f"  ⏳ Scanned {scanned_files} files, found {total_files} to download...", end='\r')
-                            
-                            # Skip if already downloaded
-                            if item_id in self.downloaded_files:
-                                # Silent skip - don't count or print
-                                continue
-                            
-                            total_files += 1
-                            download_url = item.get('@microsoft.graph.downloadUrl')
-                            
-                            if download_url:
-                                try:
-                                    # Preserve exact folder structure
-                                    file_path = local_path / name
-                                    file_path.parent.mkdir(parents=True, exist_ok=True)
-                                    
-                                    file_response = requests.get(download_url, timeout=300)
-                                    
-                                    # If 401, the download URL expired - get a fresh one
-                                    if file_response.status_code == 401:
-                                        print(f"  {'  ' * depth}🔄 {name}: URL expired, refreshing...")
-                                        # Get fresh item data with new download URL
-                                        item_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}"
-                                        fresh_response = make_api_request(item_url)
-                                        if fresh_response and fresh_response.status_code == 200:
-                                            fresh_item = fresh_response.json()
-                                            fresh_download_url = fresh_item.get('@microsoft.graph.downloadUrl')
-                                            if fresh_download_url:
-                                                file_response = requests.get(fresh_download_url, timeout=300)
-                                    
-                                    if file_response.status_code == 200:
-                                        with open(file_path, 'wb') as f:
-                                            f.write(file_response.content)
-                                        copied_files += 1
-                                        self.downloaded_files.add(item_id)
-                                        
-                                        # Save progress every 10 files
-                                        if copied_files % 10 == 0:
-                                            save_progress()
-                                        
-                                        # Show relative path from backup root
-                                        rel_path = file_path.relative_to(backup_root)
-                                        print(f"  [{'  ' * depth}{copied_files}/{total_files}] ✓ {rel_path}")
-                                    elif file_response.status_code == 503:
-                                        # Service unavailable - retry after delay
-                                        print(f"  {'  ' * depth}⏳ {name}: Service busy, retrying in 5s...")
-                                        import time
-                                        time.sleep(5)
-                                        retry_response = requests.get(download_url, timeout=300)
-                                        if retry_response.status_code == 200:
-                                            with open(file_path, 'wb') as f:
-                                                f.write(retry_response.content)
-                                            copied_files += 1
-                                            self.downloaded_files.add(item_id)
-                                            if copied_files % 10 == 0:
-                                                save_progress()
-                                            rel_path = file_path.relative_to(backup_root)
-                                            print(f"  [{'  ' * depth}{copied_files}/{total_files}] ✓ {rel_path}")
-                                        else:
-                                            print(f"  {'  ' * depth}✗ {name}: Download failed (status {retry_response.status_code})")
-                                    else:
-                                        print(f"  {'  ' * depth}✗ {name}: Download failed (status {file_response.status_code})")
-                                except Exception as e:
-                                    print(f"  {'  ' * depth}✗ {name}: {e}")
-            
-            print("📥 Downloading files from OneDrive (preserving folder structure)...\n")
-            download_folder(graph_url, backup_root)
-            
-            # Final progress save
-            save_progress()
-            
-            # Print summary
-            print("\n" + "="*50)
-            print("📊 BACKUP SUMMARY")
-            print("="*50)
-            print(f"Total files found: {total_files}")
-            print(f"Successfully downloaded: {copied_files}")
-            print(f"Backup location: {backup_root}")
-            print(f"\n✅ Folder structure preserved exactly as in OneDrive!")
-            
-            # Clean up progress file on successful completion
-            if self.progress_file.exists():
-                self.progress_file.unlink()
-            
-            return True
-            
-        except KeyboardInterrupt:
-            print("\n\n⏸️  Backup interrupted by user.")
-            save_progress()
-            print(f"Progress saved! Run the script again to resume from where you left off.")
-            print(f"Downloaded so far: {copied_files} files")
-            return False
-        except Exception as e:
-            print(f"❌ Download error: {e}")
-            save_progress()
-            print(f"Progress saved. You can resume by running the script again.")
-            return False
+        with RunProfiler.phase("scan"):
+            present = dict(self.iter_backup_files(backup_root))
+        result = {
+            'verified': [],
+            'missing': sorted(set(manifest) - set(present)),
+            'extra': sorted(set(present) - set(manifest)),
+            'corrupt': []
+        }
+        
+        tasks = []
+        total_bytes = 0
+        for rel_path, entry in manifest.items():
+            source = present.get(rel_path)
+            if source is None:
+                continue
+            # Encrypted files read their header to stat, so do it once per file
+            size = source.stat().st_size
+            if size != entry.get('size'):
+                result['corrupt'].append(rel_path)
+                continue
+            hashes = entry.get('hashes', {})
+            algorithm = 'quickXorHash' if 'quickXorHash' in hashes else 'sha1Hash'
+            if algorithm not in hashes:
+                result['verified'].append(rel_path)  # Size is all there is to check
+                continue
+            tasks.append((rel_path, source, algorithm, hashes[algorithm]))
+            total_bytes += size
+        
+        print(f"\n🔍 Verifying {len(tasks)} files ({total_bytes / (1024**3):.2f} GB) "
+              f"with {workers or os.cpu_count()} processes...")
+        
+        started = time.time()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(hash_backup_file, tasks, chunksize=16)
+            for done, (rel_path, matches) in enumerate(results, 1):
+                result['verified' if matches else 'corrupt'].append(rel_path)
+                if done % 100 == 0:
+                    print(f"  ⏳ {done}/{len(tasks)} files checked...", end='\r')
+        elapsed = max(time.time() - started, 1e-6)
+        
+        print("\n" + "="*50)
+        print("🔍 VERIFY SUMMARY")
+        print("="*50)
+        print(f"Verified OK: {len(result['verified'])}")
+        print(f"Missing:     {len(result['missing'])}")
+        print(f"Extra:       {len(result['extra'])}")
+        print(f"Corrupt:     {len(result['corrupt'])}")
+        print(f"Speed:       {total_bytes / (1024**2) / elapsed:.1f} MB/s")
+        for label in ('missing', 'extra', 'corrupt'):
+            for rel_path in result[label][:10]:
+                print(f"  {label}: {rel_path}")
+            if len(result[label]) > 10:
+                print(f"  ... and {len(result[label]) - 10} more {label}")
+        if not (result['missing'] or result['corrupt']):
+            print("\n✅ Backup is complete and intact!")
+        
+        return result
     
     def get_documents_and_pictures(self):
-        """Find all documents and pictures in OneDrive"""
+        """
+        Find the files in the local OneDrive folder selected by self.rules.
+        
+        Returns:
+            (documents, pictures); documents holds every selected file that is
+            not a picture
+        """
         if not self.onedrive_path:
             return [], []
         
-        doc_extensions = {'.pdf', '.docx', '.doc', '.txt', '.xlsx', '.xls', 
-                         '.pptx', '.ppt', '.odt', '.rtf', '.csv'}
-        pic_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', 
-                         '.svg', '.webp', '.heic', '.raw'}
-        
         documents = []
         pictures = []
         
@@ -605,22 +2930,34 @@ class OneDriveBackup:
             if folder_count % 10 == 0:
                 print(f"   Scanned {folder_count} folders, found {len(documents)} docs, {len(pictures)} pics...", end='\r')
             
+            rel_root = Path(root).relative_to(self.onedrive_path).as_posix()
+            rel_root = '' if rel_root == '.' else rel_root + '/'
+            # Pruning dirs in place stops os.walk from descending into excluded folders
+            dirs[:] = [d for d in dirs if not self.rules.skips_folder(rel_root + d)]
+            
             for file in files:
+                # Name and path rules first, so excluded files cost no stat call
+                if not self.rules.matches(rel_root + file):
+                    continue
                 file_path = Path(root) / file
-                ext = file_path.suffix.lower()
                 
                 # Skip files that are online-only (0 bytes or have cloud icon attributes)
                 try:
-                    if file_path.stat().st_size == 0:
+                    info = file_path.stat()
+                    if info.st_size == 0:
                         skipped_online_only += 1
                         continue
                 except:
                     continue
                 
-                if ext in doc_extensions:
-                    documents.append(file_path)
-                elif ext in pic_extensions:
+                modified = datetime.fromtimestamp(info.st_mtime).isoformat() if self.rules.uses_dates else None
+                if not self.rules.within_bounds(info.st_size, modified):
+                    continue
+                
+                if file_path.suffix.lower() in SelectionRules.PIC_EXTENSIONS:
                     pictures.append(file_path)
+                else:
+                    documents.append(file_path)
         
         print(f"\n✓ Scan complete! Found {len(documents)} documents and {len(pictures)} pictures")
         if skipped_online_only > 0:
@@ -632,6 +2969,36 @@ class OneDriveBackup:
             print()
         return documents, pictures
     
+    def copy_local_file(self, source, dest_file, backup_root):
+        """Copy a local file into the backup (packing it when small) and add it to the manifest"""
+        with RunProfiler.phase("copy"):
+            info = source.stat()
+            if self.pack_store and self.pack_store.wants(info.st_size):
+                data = source.read_bytes()
+                self.pack_store.add(dest_file, self.cipher.encrypt_bytes(data) if self.cipher else data)
+            elif self.cipher:
+                dest_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(source, 'rb') as src, open(dest_file, 'wb') as out:
+                    self.cipher.encrypt_stream(iter(lambda: src.read(ChunkCipher.CHUNK_SIZE), b''), out)
+                shutil.copystat(source, dest_file)
+            else:
+                dest_file.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(source, dest_file)
+            # Hash the source, which is still in the page cache, rather than re-reading the slow destination
+            rel_path = dest_file.relative_to(backup_root)
+            entry = {
+                'size': info.st_size,
+                'modified': datetime.fromtimestamp(info.st_mtime).isoformat(),
+                'hashes': {'quickXorHash': quickxor_hash(source)}
+            }
+            if self.cipher:
+                entry['encrypted'] = True
+            self.record_manifest(backup_root, rel_path, entry)
+            if self.catalog:
+                self.catalog.record(backup_root.name, rel_path.as_posix(), None,
+                                    BackupCatalog.content_hash(entry['hashes']),
+                                    entry['size'], entry['modified'])
+    
     def backup_files(self, destination_drive, include_docs=True, include_pics=True):
         """Backup files to external drive"""
         if not self.onedrive_path:
@@ -651,15 +3018,22 @@ class OneDriveBackup:
         
         print(f"\n📁 OneDrive location: {self.onedrive_path}")
         print(f"💾 Backup destination: {backup_root}\n")
+        self.rules = self.rules.with_types(include_docs, include_pics)
+        if self.rules.describe():
+            print(f"🎯 Selection: {self.rules.describe()}")
         
-        documents, pictures = self.get_documents_and_pictures()
+        with RunProfiler.phase("scan"):
+            documents, pictures = self.get_documents_and_pictures()
+        if self.pack_threshold:
+            self.pack_store = PackStore(backup_root, self.pack_threshold)
+        self.open_catalog(destination)
         
         total_files = 0
         copied_files = 0
         failed_files = []
         
-        # Backup documents
-        if include_docs and documents:
+        # Backup documents (everything selected that is not a picture)
+        if documents:
             print(f"📄 Backing up {len(documents)} documents...")
             docs_folder = backup_root / "Documents"
             docs_folder.mkdir(exist_ok=True)
@@ -669,9 +3043,7 @@ class OneDriveBackup:
                 try:
                     relative_path = doc.relative_to(self.onedrive_path)
                     dest_file = docs_folder / relative_path
-                    dest_file.parent.mkdir(parents=True, exist_ok=True)
-                    
-                    shutil.copy2(doc, dest_file)
+                    self.copy_local_file(doc, dest_file, backup_root)
                     copied_files += 1
                     self.backup_log.append({
                         'file': str(doc),
@@ -691,7 +3063,7 @@ class OneDriveBackup:
             print()  # New line after progress
         
         # Backup pictures
-        if include_pics and pictures:
+        if pictures:
             print(f"\n🖼️  Backing up {len(pictures)} pictures...")
             pics_folder = backup_root / "Pictures"
             pics_folder.mkdir(exist_ok=True)
@@ -701,9 +3073,7 @@ class OneDriveBackup:
                 try:
                     relative_path = pic.relative_to(self.onedrive_path)
                     dest_file = pics_folder / relative_path
-                    dest_file.parent.mkdir(parents=True, exist_ok=True)
-                    
-                    shutil.copy2(pic, dest_file)
+                    self.copy_local_file(pic, dest_file, backup_root)
                     copied_files += 1
                     self.backup_log.append({
                         'file': str(pic),
@@ -722,6 +3092,12 @@ class OneDriveBackup:
                     print(f"  [{idx}/{len(pictures)}] ✗ {pic.name}: {e}")
             print()  # New line after progress
         
+        if self.pack_store:
+            self.pack_store.close()
+        if self.catalog:
+            self.catalog.close()
+            self.catalog = None
+        
         # Save backup log
         log_file = backup_root / "backup_log.json"
         with open(log_file, 'w') as f:
@@ -751,13 +3127,325 @@ class OneDriveBackup:
                 print(f"  ... and {len(failed_files) - 10} more")
         
         return True
+    
+    def list_snapshots(self, destination):
+        """Return (timestamp, path) for every backup folder on the destination, newest first"""
+        snapshots = []
+        for entry in os.scandir(destination):
+            if not entry.is_dir() or not entry.name.startswith("OneDrive_Backup_"):
+                continue
+            try:
+                taken = datetime.strptime(entry.name[len("OneDrive_Backup_"):], "%Y%m%d_%H%M%S")
+            except ValueError:
+                continue
+            snapshots.append((taken, Path(entry.path)))
+        snapshots.sort(reverse=True)
+        return snapshots
+    
+    def select_snapshots_to_keep(self, snapshots, keep_daily=7, keep_weekly=4, keep_monthly=12):
+        """Apply a daily/weekly/monthly retention policy to snapshots sorted newest first"""
+        keep = set()
+        if snapshots:
+            keep.add(snapshots[0][1])  # Never delete the most recent backup
+        
+        # Each rule keeps the newest snapshot of its first N distinct periods
+        rules = [
+            (keep_daily, lambda t: t.date()),
+            (keep_weekly, lambda t: t.isocalendar()[:2]),
+            (keep_monthly, lambda t: (t.year, t.month)),
+        ]
+        for count, period_of in rules:
+            seen_periods = set()
+            for taken, path in snapshots:
+                if len(seen_periods) >= count:
+                    break
+                period = period_of(taken)
+                if period not in seen_periods:
+                    seen_periods.add(period)
+                    keep.add(path)
+        return keep
+    
+    def scan_snapshot_usage(self, snapshot, link_counts):
+        """Walk a snapshot and record how many of each inode's links it holds"""
+        total_bytes = 0
+        stack = [snapshot]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    info = entry.stat(follow_symlinks=False)
+                    if info.st_nlink == 0:
+                        # os.scandir leaves st_nlink empty on Windows
+                        info = os.lstat(entry.path)
+                except OSError:
+                    continue
+                key = (info.st_dev, info.st_ino)
+                seen, nlink, size = link_counts.get(key, (0, info.st_nlink, info.st_size))
+                link_counts[key] = (seen + 1, nlink, size)
+                total_bytes += info.st_size
+        return total_bytes
+    
+    def find_in_backups(self, destination_drive, query, limit=200):
+        """Search the backup catalog and show every backed-up version of matching files"""
+        destination = Path(destination_drive)
+        if not destination.exists():
+            print(f"❌ Destination drive '{destination_drive}' not found!")
+            return False
+        catalog = self.open_catalog(destination)
+        if not catalog:
+            return False
+        try:
+            rows = catalog.search(query, limit)
+        finally:
+            catalog.close()
+            self.catalog = None
+        
+        if not rows:
+            print(f"🔍 No backed-up files match '{query}'")
+            return True
+        
+        versions = {}
+        for path, snapshot, size, modified, content_hash in rows:
+            versions.setdefault(path, []).append((snapshot, size, modified, content_hash))
+        print(f"\n🔍 {len(versions)} file(s) match '{query}':")
+        for path, copies in versions.items():
+            print(f"\n  📄 {path}")
+            # Newest first; flag the backups where the content differs from the one before it
+            for i, (snapshot, size, modified, content_hash) in enumerate(copies):
+                older = copies[i + 1][3] if i + 1 < len(copies) else None
+                changed = " ✎ changed" if content_hash and older and content_hash != older else ""
+                size_text = f"{size / (1024**2):.2f} MB" if size is not None else "size unknown"
+                print(f"     {snapshot}  {size_text}  {(modified or '')[:19]}{changed}")
+        if len(rows) >= limit:
+            print(f"\n(Showing the first {limit} matches - narrow the search or raise --limit)")
+        return True
+    
+    def prune_backups(self, destination_drive, keep_daily=7, keep_weekly=4, keep_monthly=12, dry_run=False):
+        """
+        Delete old backup folders according to a retention policy.
+        
+        Backups that are still in progress (have a .progress.json file) are never
+        deleted. Files hardlinked into other backups only count as freed space
+        once every link to them is inside the backups being deleted.
+        """
+        destination = Path(destination_drive)
+        if not destination.exists():
+            print(f"❌ Destination drive '{destination_drive}' not found!")
+            return False
+        
+        # Finish deletions interrupted by an earlier run
+        for leftover in destination.glob(".deleting_OneDrive_Backup_*"):
+            shutil.rmtree(leftover, ignore_errors=True)
+        
+        snapshots = self.list_snapshots(destination)
+        keep = self.select_snapshots_to_keep(snapshots, keep_daily, keep_weekly, keep_monthly)
+        to_delete = [path for _, path in snapshots
+                     if path not in keep and not (path / ".progress.json").exists()]
+        
+        print(f"\n🗂️  Found {len(snapshots)} backup(s): keeping {len(snapshots) - len(to_delete)}, "
+              f"pruning {len(to_delete)}")
+        if not to_delete:
+            return True
+        
+        link_counts = {}
+        logical_bytes = 0
+        for path in to_delete:
+            logical_bytes += self.scan_snapshot_usage(path, link_counts)
+        # An inode is freed only when every one of its links is being deleted
+        freed_bytes = sum(size for seen, nlink, size in link_counts.values() if seen >= nlink)
+        
+        for path in to_delete:
+            print(f"  🗑️  {path.name}")
+        print(f"\nLogical size: {logical_bytes / (1024**3):.2f} GB, "
+              f"space freed: {freed_bytes / (1024**3):.2f} GB "
+              f"(the rest is shared with kept backups)")
+        
+        if dry_run:
+            print("Dry run - nothing deleted.")
+            return True
+        
+        catalog = None
+        if (destination / BackupCatalog.FILE_NAME).exists():
+            catalog = BackupCatalog(destination)
+        deleted = []
+        try:
+            for path in to_delete:
+                # Rename first so a half-deleted folder never looks like a usable backup
+                trash = path.with_name(f".deleting_{path.name}")
+                try:
+                    path.rename(trash)
+                    shutil.rmtree(trash)
+                except OSError as e:
+                    print(f"  ⚠️  Could not delete {path.name}: {e}")
+                    continue
+                deleted.append(path.name)
+        finally:
+            if catalog:
+                catalog.forget_snapshots(deleted)
+                catalog.close()
+        
+        print("✅ Pruning complete!")
+        return True
+
+def date_arg(text):
+    """argparse type for YYYY-MM-DD dates, kept as ISO text for comparison"""
+    try:
+        return datetime.strptime(text, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date like 2024-01-31, got '{text}'")
+
+def size_arg(text):
+    try:
+        return SelectionRules.parse_size(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_args(argv=None):
+    """Parse command line options; no command runs the interactive backup"""
+    parser = argparse.ArgumentParser(
+        description="Backup OneDrive to an external drive. Run without a command for the interactive backup.")
+    parser.add_argument('--order', choices=sorted(OneDriveBackup.DOWNLOAD_ORDERS), default='folder',
+                        help="Online backup download order (default: folder)")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Parallel downloads for online backups (default: 4, per drive)")
+    parser.add_argument('--all-drives', action='store_true',
+                        help="Online backups: back up every drive you can access, including "
+                             "followed SharePoint sites, each in its own folder")
+    parser.add_argument('--parallel-drives', type=int, default=3,
+                        help="With --all-drives, drives backed up at the same time (default: 3)")
+    parser.add_argument('--profile', nargs='?', const='.', metavar='DIR',
+                        help="Profile the run: write flame graph stacks and per-phase timings "
+                             "to DIR (default: current folder)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="With --profile, also trace memory and report peaks (slows the run)")
+    selection = parser.add_argument_group(
+        'file selection', "Narrow or widen the documents/pictures choice. Patterns without '/' match "
+        "a file or folder name anywhere; patterns with '/' match the path from the OneDrive root.")
+    selection.add_argument('--include', action='append', default=[], metavar='GLOB',
+                           help="Also back up matching files, e.g. '*.zip' (repeatable)")
+    selection.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                           help="Skip matching files and whole folders, e.g. node_modules (repeatable)")
+    selection.add_argument('--path', action='append', default=[], metavar='FOLDER',
+                           help="Only back up this folder, e.g. Work/Projects (repeatable)")
+    selection.add_argument('--min-size', type=size_arg, metavar='SIZE', help="Skip files smaller than this, e.g. 10KB")
+    selection.add_argument('--max-size', type=size_arg, metavar='SIZE', help="Skip files larger than this, e.g. 2GB")
+    selection.add_argument('--modified-after', type=date_arg, metavar='DATE',
+                           help="Only files modified on or after this date (YYYY-MM-DD)")
+    selection.add_argument('--modified-before', type=date_arg, metavar='DATE',
+                           help="Only files modified before this date (YYYY-MM-DD)")
+    subparsers = parser.add_subparsers(dest='command')
+    
+    prune = subparsers.add_parser('prune', help="Delete old backups using a retention policy")
+    prune.add_argument('destination', help="Drive or folder holding the OneDrive_Backup_* folders")
+    prune.add_argument('--daily', type=int, default=7, help="Daily backups to keep (default: 7)")
+    prune.add_argument('--weekly', type=int, default=4, help="Weekly backups to keep (default: 4)")
+    prune.add_argument('--monthly', type=int, default=12, help="Monthly backups to keep (default: 12)")
+    prune.add_argument('--dry-run', action='store_true', help="Show what would be deleted")
+    
+    plan = subparsers.add_parser('plan', help="Preview an online backup: file counts, sizes and time estimate")
+    plan.add_argument('destination', help="Drive the backup would be written to")
+    plan.add_argument('--only', choices=['docs', 'pics'], help="Plan documents or pictures only")
+    
+    restore = subparsers.add_parser('restore', help="Upload a backup folder back into OneDrive")
+    restore.add_argument('backup_folder', help="OneDrive_Backup_* folder to restore from")
+    restore.add_argument('target', nargs='?', default='Restored',
+                         help="OneDrive folder to restore into (default: Restored)")
+    restore.add_argument('--workers', type=int, default=4, help="Parallel uploads (default: 4)")
+    
+    verify = subparsers.add_parser('verify', help="Check a backup folder against its manifest")
+    verify.add_argument('backup_folder', help="OneDrive_Backup_* folder to verify")
+    verify.add_argument('--workers', type=int, default=None,
+                        help="Hashing processes (default: one per CPU)")
+    
+    extract = subparsers.add_parser('extract', help="Copy single files or folders out of a backup (decrypting them)")
+    extract.add_argument('backup_folder', help="OneDrive_Backup_* folder to extract from")
+    extract.add_argument('path', help="File or folder inside the backup, as listed by 'find'")
+    extract.add_argument('output', nargs='?', default='.', help="Local folder to write to (default: current folder)")
+    
+    find = subparsers.add_parser('find', help="Search every backup on a drive for a file name or path")
+    find.add_argument('destination', help="Drive or folder holding the OneDrive_Backup_* folders")
+    find.add_argument('query', help="Words from the file name or folder path, e.g. \"tax 2023 pdf\"")
+    find.add_argument('--limit', type=int, default=200, help="Maximum matches to show (default: 200)")
+    
+    return parser.parse_args(argv)
 
 def main():
+    args = parse_args()
+    profiler = RunProfiler('onedrive_backup', args.profile,
+                           memory=args.profile_memory).start() if args.profile else None
+    try:
+        with RunProfiler.phase(args.command or 'backup'):
+            run(args)
+    finally:
+        if profiler:
+            profiler.stop()
+
+def run(args):
+    """Run the chosen command, or the interactive backup when there is none"""
+    rules = SelectionRules(include=args.include, exclude=args.exclude, paths=args.path,
+                           min_size=args.min_size, max_size=args.max_size,
+                           modified_after=args.modified_after, modified_before=args.modified_before)
+    
+    if args.command == 'prune':
+        OneDriveBackup().prune_backups(args.destination, args.daily, args.weekly,
+                                       args.monthly, args.dry_run)
+        return
+    
+    if args.command == 'verify':
+        backup = OneDriveBackup()
+        if backup.unlock_encryption(Path(args.backup_folder).parent):
+            backup.verify_backup(args.backup_folder, args.workers)
+        return
+    
+    if args.command == 'extract':
+        backup = OneDriveBackup()
+        if backup.unlock_encryption(Path(args.backup_folder).parent):
+            backup.extract_files(args.backup_folder, args.path, args.output)
+        return
+    
+    if args.command == 'find':
+        OneDriveBackup().find_in_backups(args.destination, args.query, args.limit)
+        return
+    
+    if args.command == 'plan':
+        backup = OneDriveBackup()
+        backup.rules = rules
+        if args.all_drives:
+            backup.scope = backup.SITES_SCOPE
+        if not backup.login_to_onedrive_api():
+            print("❌ Login failed. Exiting.")
+            return
+        backup.plan_from_api(args.destination, args.only != 'pics', args.only != 'docs', args.all_drives)
+        return
+    
+    if args.command == 'restore':
+        backup = OneDriveBackup()
+        backup.scope = backup.WRITE_SCOPE
+        if not backup.unlock_encryption(Path(args.backup_folder).parent):
+            return
+        if not backup.login_to_onedrive_api():
+            print("❌ Login failed. Exiting.")
+            return
+        backup.restore_to_onedrive(args.backup_folder, args.target, args.workers)
+        return
+    
     print("="*50)
     print("OneDrive Backup Tool")
     print("="*50)
     
     backup = OneDriveBackup()
+    backup.rules = rules
+    backup.download_order = args.order
+    backup.download_workers = max(1, args.workers)
+    backup.parallel_drives = max(1, args.parallel_drives)
+    if args.all_drives:
+        backup.scope = backup.SITES_SCOPE
     
     # Always give user the choice
     if backup.onedrive_path:
@@ -815,10 +3503,23 @@ def main():
     include_docs = choice in ['1', '3']
     include_pics = choice in ['2', '3']
     
+    # Slow filesystems spend more time creating small files than writing bytes
+    print("\nPack small files (under 1 MB) into large pack files?")
+    print("Recommended for USB (exFAT) and network drives with many small photos/documents.")
+    if input("Pack small files? (y/n): ").strip().lower() == 'y':
+        backup.pack_threshold = PackStore.DEFAULT_THRESHOLD
+    
+    # Encrypting while copying avoids a second full pass over the drive
+    if (Path(destination) / ChunkCipher.CONFIG_FILE).exists():
+        print("\n🔒 This drive already holds encrypted backups.")
+    if input("\nEncrypt the backup with a passphrase? (y/n): ").strip().lower() == 'y':
+        if not backup.unlock_encryption(destination, create=True):
+            return
+    
     print("\n🚀 Starting backup...")
     
     if backup.use_api:
-        backup.download_from_api(destination, include_docs, include_pics)
+        backup.download_from_api(destination, include_docs, include_pics, args.all_drives)
     else:
         backup.backup_files(destination, include_docs, include_pics)
     
@@ -0,0 +1,257 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import tempfile
+import unittest
+from pathlib import Path
+
+from onedrive_backup import (AESGCM, BackupCatalog, ChunkCipher, CompactIdIndex, EncryptedFile, OneDriveBackup,
+                             PackStore, QUICKXOR_BLOCK, SelectionRules, quickxor_hash)
+
+
+class CompactIdIndexTest(unittest.TestCase):
+    def test_compact_merges_into_existing_index(self):
+        index = CompactIdIndex()
+        first = [f"item-{n}" for n in range(70000)]
+        index.update(first)
+        index._compact()
+        self.assertTrue(index._sorted)
+
+        second = [f"item-{n}" for n in range(60000, 140000)]
+        random.shuffle(second)
+        index.update(second)
+        index._compact()
+
+        keys = index._sorted.tolist()
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(len(index), 140000)
+        self.assertFalse(index._pending)
+        for item_id in ("item-0", "item-69999", "item-70000", "item-139999"):
+            self.assertIn(item_id, index)
+        self.assertNotIn("item-140000", index)
+
+    def test_resume_replays_journal_into_saved_index(self):
+        with tempfile.TemporaryDirectory() as folder:
+            index = CompactIdIndex()
+            index.update(f"a-{n}" for n in range(1000))
+            index.save(folder, full=True)
+            index.update(f"b-{n}" for n in range(500))
+            index.save(folder)
+
+            loaded = CompactIdIndex.load(folder)
+            self.assertEqual(len(loaded), 1500)
+            self.assertEqual(loaded._sorted.tolist(), sorted(loaded._sorted.tolist()))
+            self.assertIn("a-999", loaded)
+            self.assertIn("b-0", loaded)
+            self.assertNotIn("c-0", loaded)
+
+
+class PruneBackupsTest(unittest.TestCase):
+    def test_retention_keeps_newest_of_each_period(self):
+        with tempfile.TemporaryDirectory() as folder:
+            names = ["20260310_120000", "20260310_080000", "20260309_120000", "20260302_120000",
+                     "20260215_120000", "20260120_120000", "20260105_120000"]
+            for name in names:
+                (Path(folder) / f"OneDrive_Backup_{name}").mkdir()
+            # An unfinished backup is never pruned
+            (Path(folder) / "OneDrive_Backup_20260105_120000" / ".progress.json").write_text("{}")
+
+            backup = OneDriveBackup()
+            self.assertTrue(backup.prune_backups(folder, keep_daily=2, keep_weekly=2, keep_monthly=2, dry_run=True))
+            self.assertEqual(len(list(Path(folder).iterdir())), len(names))
+
+            backup.prune_backups(folder, keep_daily=2, keep_weekly=2, keep_monthly=2)
+            left = sorted(path.name[len("OneDrive_Backup_"):] for path in Path(folder).iterdir())
+            self.assertEqual(left, ["20260105_120000", "20260215_120000", "20260302_120000",
+                                    "20260309_120000", "20260310_120000"])
+
+
+class QuickXorHashTest(unittest.TestCase):
+    def quickxor_reference(self, data):
+        # The byte-at-a-time algorithm from the OneDrive documentation
+        register = 0
+        mask = (1 << 160) - 1
+        for index, byte in enumerate(data):
+            shift = (index * 11) % 160
+            register ^= ((byte << shift) | (byte >> (160 - shift))) & mask
+        digest = bytearray(register.to_bytes(20, 'little'))
+        for index, byte in enumerate(len(data).to_bytes(8, 'little')):
+            digest[12 + index] ^= byte
+        return base64.b64encode(bytes(digest)).decode('ascii')
+
+    def hash_of(self, data):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "file.bin"
+            path.write_bytes(data)
+            return quickxor_hash(path)
+
+    def test_known_vectors(self):
+        self.assertEqual(self.hash_of(b""), "AAAAAAAAAAAAAAAAAAAAAAAAAAA=")
+        self.assertEqual(self.hash_of(b"J"), "SgAAAAAAAAAAAAAAAQAAAAAAAAA=")
+
+    def test_matches_reference_across_blocks(self):
+        data = os.urandom(QUICKXOR_BLOCK + 1234)
+        self.assertEqual(self.hash_of(data), self.quickxor_reference(data))
+
+
+class PackStoreTest(unittest.TestCase):
+    def test_write_read_and_reload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            root = Path(folder)
+            store = PackStore(root)
+            store.add(root / "a.txt", b"first")
+            store.add(root / "docs" / "b.txt", b"second")
+            store.close()
+
+            # A later run packs a.txt again and its entry replaces the first one
+            store = PackStore(root)
+            store.add(root / "a.txt", b"rewritten")
+            store.close()
+            with open(root / PackStore.PACK_DIR / PackStore.INDEX_NAME, 'a', encoding='utf-8') as f:
+                f.write('{"path": "torn')
+
+            index = PackStore.read_index(root)
+            self.assertEqual(sorted(index), ["a.txt", "docs/b.txt"])
+            self.assertEqual(index["a.txt"].read_bytes(), b"rewritten")
+            self.assertEqual(index["docs/b.txt"].open().read(), b"second")
+            self.assertEqual(index["docs/b.txt"].stat().st_size, 6)
+
+    def test_full_pack_rolls_over(self):
+        with tempfile.TemporaryDirectory() as folder:
+            root = Path(folder)
+            store = PackStore(root)
+            store.PACK_SIZE = 10
+            for n in range(4):
+                store.add(root / f"{n}.bin", bytes([n]) * 8)
+            store.close()
+
+            index = PackStore.read_index(root)
+            # A pack takes files until it reaches PACK_SIZE, so two fit in each
+            self.assertEqual(sorted({entry.pack_path.name for entry in index.values()}),
+                             ["pack_00001.dat", "pack_00002.dat"])
+            self.assertEqual([index[f"{n}.bin"].read_bytes() for n in range(4)],
+                             [bytes([n]) * 8 for n in range(4)])
+
+
+class VerifyBackupTest(unittest.TestCase):
+    def test_reports_missing_and_altered_files(self):
+        with tempfile.TemporaryDirectory() as folder:
+            root = Path(folder)
+            contents = {"kept.txt": b"unchanged", "docs/gone.txt": b"deleted later", "docs/edited.txt": b"original"}
+            with open(root / OneDriveBackup.MANIFEST_FILE, 'w', encoding='utf-8') as f:
+                for rel_path, data in contents.items():
+                    (root / rel_path).parent.mkdir(exist_ok=True)
+                    (root / rel_path).write_bytes(data)
+                    f.write(json.dumps({'path': rel_path, 'size': len(data),
+                                        'hashes': {'sha1Hash': hashlib.sha1(data).hexdigest().upper()}}) + "\n")
+            (root / "docs" / "gone.txt").unlink()
+            (root / "docs" / "edited.txt").write_bytes(b"0riginal")  # Same size, different bytes
+
+            result = OneDriveBackup().verify_backup(folder, workers=1)
+            self.assertEqual(result['verified'], ["kept.txt"])
+            self.assertEqual(result['missing'], ["docs/gone.txt"])
+            self.assertEqual(result['corrupt'], ["docs/edited.txt"])
+            self.assertEqual(result['extra'], [])
+
+
+class BackupCatalogTest(unittest.TestCase):
+    def test_search_matches_every_word(self):
+        with tempfile.TemporaryDirectory() as folder:
+            catalog = BackupCatalog(folder)
+            catalog.record("OneDrive_Backup_20260301_120000", "Documents/Taxes/return 2025.pdf", "id-1", None, 10)
+            catalog.record("OneDrive_Backup_20260308_120000", "Documents/Taxes/return 2025.pdf", "id-1", None, 10)
+            catalog.record("OneDrive_Backup_20260308_120000", "Documents/Letters/return address.txt", "id-2", None, 5)
+            rows = catalog.search("taxes return")
+            catalog.close()
+            self.assertEqual([(row[0], row[1]) for row in rows],
+                             [("Documents/Taxes/return 2025.pdf", "OneDrive_Backup_20260308_120000"),
+                              ("Documents/Taxes/return 2025.pdf", "OneDrive_Backup_20260301_120000")])
+
+    def test_moved_file_is_reused_from_earlier_backup(self):
+        with tempfile.TemporaryDirectory() as folder:
+            destination = Path(folder)
+            old = destination / "OneDrive_Backup_20260301_120000"
+            new = destination / "OneDrive_Backup_20260308_120000"
+            (old / "Old Folder").mkdir(parents=True)
+            (old / "Old Folder" / "report.docx").write_bytes(b"report body")
+            new.mkdir()
+
+            item = {'id': 'id-1', 'size': 11, 'file': {'hashes': {'sha1Hash': 'ABC123'}}}
+            catalog = BackupCatalog(destination)
+            catalog.record(old.name, "Old Folder/report.docx", "id-1",
+                           BackupCatalog.content_hash(item['file']['hashes']), 11)
+            backup = OneDriveBackup()
+            backup.catalog = catalog
+            target = new / "New Folder" / "report.docx"
+            try:
+                self.assertEqual(backup.reuse_previous_copy(item, target, new), 11)
+                self.assertEqual(target.read_bytes(), b"report body")
+                # Different content under the same ID is not reused
+                item['file']['hashes']['sha1Hash'] = 'DEF456'
+                self.assertIsNone(backup.reuse_previous_copy(item, new / "other.docx", new))
+            finally:
+                catalog.close()
+
+
+@unittest.skipUnless(AESGCM, "cryptography is not installed")
+class ChunkCipherTest(unittest.TestCase):
+    def setUp(self):
+        self.key = os.urandom(32)
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def write(self, name, data):
+        path = Path(self.folder.name) / name
+        path.write_bytes(data)
+        return path
+
+    def test_roundtrip_and_seek(self):
+        data = os.urandom(2 * ChunkCipher.CHUNK_SIZE + 123)
+        sealed = ChunkCipher(self.key).encrypt_bytes(data)
+        self.assertEqual(len(sealed), ChunkCipher.stored_size(len(data)))
+        path = self.write("file", sealed)
+        self.assertEqual(EncryptedFile(path, self.key).read_bytes(), data)
+        with EncryptedFile(path, self.key).open("rb") as f:
+            f.seek(ChunkCipher.CHUNK_SIZE - 10)
+            self.assertEqual(f.read(30), data[ChunkCipher.CHUNK_SIZE - 10:ChunkCipher.CHUNK_SIZE + 20])
+
+    def test_files_get_their_own_salt(self):
+        cipher = ChunkCipher(self.key)
+        first, second = cipher.encrypt_bytes(b"same"), cipher.encrypt_bytes(b"same")
+        header = slice(len(ChunkCipher.MAGIC), len(ChunkCipher.MAGIC) + ChunkCipher.SALT_SIZE)
+        self.assertNotEqual(first[header], second[header])
+        self.assertNotEqual(first[ChunkCipher.HEADER_SIZE:], second[ChunkCipher.HEADER_SIZE:])
+
+
+class SelectionRulesTest(unittest.TestCase):
+    def test_include_and_exclude_globs(self):
+        rules = SelectionRules(include=["*.MD", "notes-*"], exclude=["*.tmp", "Archive", "Work/Drafts/*"])
+        self.assertTrue(rules.matches("Documents/report.PDF"))
+        self.assertTrue(rules.matches("readme.md"))
+        self.assertTrue(rules.matches("Documents/notes-monday"))
+        self.assertFalse(rules.matches("Documents/tool.exe"))
+        self.assertFalse(rules.matches("Documents/report.tmp"))
+        self.assertFalse(rules.matches("Work/Drafts/plan.docx"))
+        self.assertTrue(rules.matches("Work/plan.docx"))
+        self.assertTrue(rules.skips_folder("Photos/archive"))
+        self.assertFalse(rules.skips_folder("Photos"))
+
+    def test_paths_limit_folders_and_files(self):
+        rules = SelectionRules(paths=["/Documents/Taxes/"])
+        self.assertTrue(rules.matches("documents/taxes/2025/return.pdf"))
+        self.assertFalse(rules.matches("Documents/letter.pdf"))
+        self.assertFalse(rules.skips_folder("Documents"))
+        self.assertFalse(rules.skips_folder("Documents/Taxes/2025"))
+        self.assertTrue(rules.skips_folder("Pictures"))
+
+    def test_size_and_date_bounds(self):
+        rules = SelectionRules(min_size=SelectionRules.parse_size("1KB"), modified_before="2026-01-01")
+        self.assertTrue(rules.wants_file("a.txt", 2048, "2025-12-31T23:59:59Z"))
+        self.assertFalse(rules.wants_file("a.txt", 100, "2025-06-01T00:00:00Z"))
+        self.assertFalse(rules.wants_file("a.txt", 2048, "2026-01-01T00:00:00Z"))
+
+
+if __name__ == "__main__":
+    unittest.main()
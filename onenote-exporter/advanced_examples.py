@@ -4,7 +4,7 @@ Advanced OneNote Export Examples
 Demonstrates custom export scenarios and advanced features
 """
 
-from onenote_exporter import OneNoteExporter
+from onenote_exporter import OneNoteExporter, PageCache
 from pathlib import Path
 import json
 
@@ -51,11 +51,28 @@ def export_with_filters(exporter, destination, min_date=None, file_types=None):
 
 
 # Example 3: Export to custom format
-def export_to_obsidian(exporter, destination):
-    """Export in Obsidian-compatible format"""
+def export_to_obsidian(exporter, destination, offline=False):
+    """
+    Export in Obsidian-compatible format
+    
+    Pages already in the page cache of earlier exports to destination are
+    not fetched again. With offline set, everything comes from the cache
+    and no sign-in is needed.
+    """
     print("\n📝 Exporting for Obsidian...")
     
-    notebooks = exporter.get_notebooks()
+    exporter.cache = PageCache(destination)
+    exporter.offline = offline
+    if offline:
+        notebooks = exporter.cache.load_inventory()
+    else:
+        notebooks = exporter.get_inventory()
+        if notebooks and exporter.listing_complete:
+            exporter.cache.save_inventory(notebooks)
+    if not notebooks:
+        print("❌ No notebooks found!")
+        return
+    
     export_root = Path(destination) / "Obsidian_Export"
     export_root.mkdir(exist_ok=True)
     
@@ -63,13 +80,9 @@ def export_to_obsidian(exporter, destination):
         notebook_folder = export_root / exporter.sanitize_filename(notebook['displayName'])
         notebook_folder.mkdir(exist_ok=True)
         
-        sections = exporter.get_sections(notebook['id'])
-        
-        for section in sections:
-            pages = exporter.get_pages(section['id'])
-            
-            for page in pages:
-                page_content = exporter.get_page_content(page['id'])
+        for section in notebook['sections']:
+            for page in section['pages']:
+                page_content = exporter.fetch_page_content(page)
                 if not page_content:
                     continue
                 
@@ -91,6 +104,7 @@ tags: [onenote-import, {notebook['displayName'].lower().replace(' ', '-')}]
                 with open(page_file, 'w', encoding='utf-8') as f:
                     f.write(frontmatter + md_content)
     
+    exporter.cache.save()
     print(f"✅ Exported to: {export_root}")
 
 
@@ -99,7 +113,8 @@ def generate_detailed_report(exporter, destination):
     """Generate a detailed report of OneNote content"""
     print("\n📊 Generating detailed report...")
     
-    notebooks = exporter.get_notebooks()
+    # A few bulk requests for the whole account, section groups included
+    notebooks = exporter.get_inventory()
     report = {
         'total_notebooks': len(notebooks),
         'notebooks': []
@@ -112,17 +127,16 @@ def generate_detailed_report(exporter, destination):
             'sections': []
         }
         
-        sections = exporter.get_sections(notebook['id'])
-        
-        for section in sections:
+        for section in notebook['sections']:
             section_info = {
                 'name': section['displayName'],
                 'id': section['id'],
+                'section_groups': section['groups'],
                 'page_count': 0,
                 'pages': []
             }
             
-            pages = exporter.get_pages(section['id'])
+            pages = section['pages']
             section_info['page_count'] = len(pages)
             
             for page in pages:
@@ -236,35 +250,37 @@ def preview_export(exporter):
 # Example 8: Export only recent notes
 def export_recent_notes(exporter, destination, days=30):
     """Export only notes modified in the last N days"""
-    from datetime import datetime, timedelta
+    from datetime import datetime, timedelta, timezone
     
     print(f"\n📅 Exporting notes from last {days} days...")
     
-    cutoff_date = datetime.now() - timedelta(days=days)
+    cutoff_date = datetime.now(timezone.utc) - timedelta(days=days)
     
-    notebooks = exporter.get_notebooks()
-    exporter.export_root = Path(destination)
+    notebooks = exporter.get_inventory()
+    exporter.export_root = Path(destination) / "OneNote_Recent"
+    exporter.export_root.mkdir(parents=True, exist_ok=True)
     
     recent_count = 0
     
     for notebook in notebooks:
-        sections = exporter.get_sections(notebook['id'])
-        
-        for section in sections:
-            pages = exporter.get_pages(section['id'])
-            
-            for page in pages:
+        for section in notebook['sections']:
+            recent = []
+            for page in section['pages']:
                 # Check modification date
                 modified = page.get('lastModifiedDateTime', '')
                 if modified:
                     modified_date = datetime.fromisoformat(modified.replace('Z', '+00:00'))
-                    
                     if modified_date > cutoff_date:
-                        # Export this page
-                        recent_count += 1
-                        # Export logic here
+                        recent.append(page)
+            section['pages'] = recent
+            recent_count += len(recent)
+        
+        notebook['sections'] = [section for section in notebook['sections'] if section['pages']]
+        if notebook['sections']:
+            exporter.export_notebook(notebook)
     
-    print(f"✅ Found {recent_count} recent pages")
+    print(f"✅ Exported {recent_count} recent pages to: {exporter.export_root}")
+    print("   (For a full export that only fetches what changed, run onenote_exporter.py --incremental)")
 
 
 def main():
@@ -282,9 +298,13 @@ def main():
     
     choice = input("\nSelect example (1-5): ").strip()
     
+    offline = False
+    if choice == '2':
+        offline = input("Use only pages cached by earlier exports (no sign-in)? (y/n): ").strip().lower() == 'y'
+    
     # Create exporter and authenticate
     exporter = OneNoteExporter()
-    if not exporter.authenticate():
+    if not offline and not exporter.authenticate():
         print("❌ Authentication failed")
         return
     
@@ -296,7 +316,7 @@ def main():
         export_specific_notebooks(exporter, notebook_list, destination)
     
     elif choice == '2':
-        export_to_obsidian(exporter, destination)
+        export_to_obsidian(exporter, destination, offline)
     
     elif choice == '3':
         generate_detailed_report(exporter, destination)
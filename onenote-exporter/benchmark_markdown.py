@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the HTML to Markdown conversion.
+
+Compares the MarkdownConverter used by onenote_exporter.py, which walks the
+page's tags once, with the regex cascade it replaced, on synthetic
+OneNote-style pages of growing size. Two kinds of page are measured:
+
+- text: headings, formatting, nested lists, links and a table per block
+- pictures: screenshots and lines separated by <br/>, without italics, like
+  pages of pasted images or ink. `<i...>` in the cascade also matches <img>
+  and `<b...>` matches <br>, so each of them scans ahead for a closing tag
+  that never comes.
+
+No OneNote account or network access is needed.
+
+Usage:
+    python3 benchmark_markdown.py [--sizes 50 200 800] [--repeat 3]
+"""
+
+import re
+import html
+import time
+import argparse
+
+from onenote_exporter import MarkdownConverter
+
+
+def legacy_convert(html_content):
+    """The earlier regex-based conversion, kept here as the baseline"""
+    md = html_content
+    md = re.sub(r'<\?xml[^>]*>', '', md)
+    md = re.sub(r'data-id="[^"]*"', '', md)
+    md = re.sub(r'<h1[^>]*>(.*?)</h1>', r'# \1\n', md, flags=re.DOTALL)
+    md = re.sub(r'<h2[^>]*>(.*?)</h2>', r'## \1\n', md, flags=re.DOTALL)
+    md = re.sub(r'<h3[^>]*>(.*?)</h3>', r'### \1\n', md, flags=re.DOTALL)
+    md = re.sub(r'<ul[^>]*>', '\n', md)
+    md = re.sub(r'</ul>', '\n', md)
+    md = re.sub(r'<li[^>]*>(.*?)</li>', r'- \1\n', md, flags=re.DOTALL)
+    md = re.sub(r'<strong[^>]*>(.*?)</strong>', r'**\1**', md, flags=re.DOTALL)
+    md = re.sub(r'<em[^>]*>(.*?)</em>', r'*\1*', md, flags=re.DOTALL)
+    md = re.sub(r'<b[^>]*>(.*?)</b>', r'**\1**', md, flags=re.DOTALL)
+    md = re.sub(r'<i[^>]*>(.*?)</i>', r'*\1*', md, flags=re.DOTALL)
+    md = re.sub(r'<a[^>]*href="([^"]+)"[^>]*>(.*?)</a>', r'[\2](\1)', md, flags=re.DOTALL)
+    md = re.sub(r'<img[^>]*src="([^"]+)"[^>]*alt="([^"]*)"[^>]*>', r'![\2](\1)', md)
+    md = re.sub(r'<img[^>]*src="([^"]+)"[^>]*>', r'![](\1)', md)
+    md = re.sub(r'<[^>]+>', '', md)
+    md = re.sub(r'\n\s*\n\s*\n', '\n\n', md)
+    md = html.unescape(md)
+    return md.strip()
+
+
+def picture_page(blocks):
+    """A page of pasted pictures and short lines"""
+    parts = ['<html><head><title>Benchmark</title></head><body data-absolute-enabled="true">']
+    for n in range(blocks):
+        parts.append(
+            f'<div data-id="div-{n}"><p>Screenshot {n}<br/>taken during the <b>review</b></p>'
+            f'<img src="https://graph.microsoft.com/v1.0/me/onenote/resources/r-{n}/$value" '
+            f'alt="screenshot {n}" width="640" height="400" /></div>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def text_page(blocks):
+    """A OneNote-like page of formatted text with the given number of content blocks"""
+    parts = ['<?xml version="1.0" encoding="utf-8" ?><html><head><title>Benchmark</title></head>'
+             '<body data-absolute-enabled="true" style="font-family:Calibri">']
+    for n in range(blocks):
+        parts.append(
+            f'<div data-id="div-{n}" style="position:absolute;left:48px;top:{120 + n * 40}px;width:624px">'
+            f'<h2 style="margin:0">Meeting notes {n}</h2>'
+            f'<p style="margin-top:0pt">Discussed the <b>quarterly</b> numbers with <i>finance</i> '
+            f'&amp; agreed on <a href="https://example.com/doc/{n}?a=1&amp;b=2">the plan</a>.</p>'
+            f'<ul><li>Action item {n}<ul><li>owner: <strong>team {n % 7}</strong></li>'
+            f'<li>due <em>next week</em></li></ul></li><li>Follow-up</li></ul>'
+            f'<table border="1"><tr><td>Metric</td><td>Value</td></tr>'
+            f'<tr><td>Revenue</td><td>{n * 1000}</td></tr></table>'
+            f'<img src="https://graph.microsoft.com/v1.0/me/onenote/resources/r-{n}/$value" '
+            f'data-fullres-src="https://graph.microsoft.com/v1.0/me/onenote/resources/r-{n}/$value" '
+            f'alt="chart {n}" width="320" height="200" />'
+            f'</div>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def best_time(function, argument, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HTML to Markdown conversion")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 800, 1600],
+                        help="Content blocks per synthetic page (default: 50 200 800 1600)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per measurement; the fastest is reported (default: 3)")
+    args = parser.parse_args()
+
+    print("="*70)
+    print("HTML to Markdown benchmark")
+    print("="*70)
+
+    for kind, make_page in (('text', text_page), ('pictures', picture_page)):
+        print(f"\n📄 {kind} pages")
+        print(f"{'blocks':>8} {'page size':>10} {'regex cascade':>14} {'converter':>12} {'speed-up':>9}")
+        for blocks in args.sizes:
+            page = make_page(blocks)
+            legacy = best_time(legacy_convert, page, args.repeat)
+            current = best_time(lambda content: MarkdownConverter().convert(content), page, args.repeat)
+            print(f"{blocks:>8} {len(page) / 1024:>8.0f}KB {legacy * 1000:>12.1f}ms "
+                  f"{current * 1000:>10.1f}ms {legacy / current:>8.1f}x")
+
+    print("\n💡 The converter time grows in step with the page size for both kinds of page.")
+
+
+if __name__ == "__main__":
+    main()
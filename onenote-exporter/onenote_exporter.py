@@ -5,20 +5,954 @@ Exports OneNote notebooks with all attachments for import into Evernote, Joplin,
 """
 
 import os
+import sys
+import time
 import json
+import shutil
+import argparse
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import webbrowser
 import getpass
 from pathlib import Path
 from datetime import datetime
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urlencode, quote
 import base64
+import binascii
+import hashlib
 import html
 import re
 from typing import Dict, List, Optional, Tuple
 import mimetypes
 
+class RunProfiler:
+    """
+    Sampling profiler for an export run (--profile).
+    
+    A daemon thread snapshots every thread's stack with
+    sys._current_frames() every 10 ms, keeping only the code objects; the
+    stacks are named once, when the profile is written, in the folded
+    format used by flamegraph.pl and speedscope. Because the samples are
+    wall-clock, page downloads and disk writes show up next to HTML parsing.
+    Stacks are prefixed with the phase their thread is in.
+    
+    RunProfiler.phase() wraps an export step (listing, page download,
+    attachments, conversion) and keeps its call count and total time.
+    Without an active profiler it just yields. With memory=True the peak
+    traced memory of the whole run is reported too; steps run on several
+    threads at once, so there is no per-step peak.
+    """
+    active = None
+    
+    def __init__(self, name, output_dir='.', interval=0.01, memory=False):
+        self.name = name
+        self.output_dir = Path(output_dir)
+        self.interval = interval
+        self.memory = memory
+        self.samples = {}
+        self.sample_count = 0
+        self.phases = {}
+        self._stacks = {}
+        self._local = threading.local()
+        self._thread_phase = {}
+        self._main_ident = threading.main_thread().ident
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+    
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        """Time a pipeline phase of the active profiler (does nothing when profiling is off)"""
+        profiler = cls.active
+        if profiler is None:
+            yield
+            return
+        stack = getattr(profiler._local, 'stack', None)
+        if stack is None:
+            stack = profiler._local.stack = []
+        ident = threading.get_ident()
+        path = f"{stack[-1]}/{name}" if stack else name
+        stack.append(path)
+        with profiler._lock:
+            profiler._thread_phase[ident] = path
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            stack.pop()
+            with profiler._lock:
+                record = profiler.phases.setdefault(path, {'calls': 0, 'seconds': 0.0})
+                record['calls'] += 1
+                record['seconds'] += seconds
+            with profiler._lock:
+                if stack:
+                    profiler._thread_phase[ident] = stack[-1]
+                else:
+                    profiler._thread_phase.pop(ident, None)
+    
+    def start(self):
+        if self.memory:
+            # One frame per allocation keeps tracemalloc's own overhead small
+            tracemalloc.start(1)
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._thread.start()
+        RunProfiler.active = self
+        return self
+    
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            # Worker threads enter and leave phases while the sample is taken
+            with self._lock:
+                thread_phase = dict(self._thread_phase)
+            main_phase = thread_phase.get(self._main_ident, 'idle')
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or self._idle_worker(frame):
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                phase = thread_phase.get(ident, main_phase)
+                # Holding the codes in _stacks keeps their ids from being reused
+                key = (phase, *map(id, codes))
+                count = self.samples.get(key)
+                if count is None:
+                    self._stacks[key] = (phase, codes)
+                    count = 0
+                self.samples[key] = count + 1
+            self.sample_count += 1
+    
+    @staticmethod
+    def _idle_worker(frame):
+        """Check whether a thread is a pool worker waiting for work"""
+        for _ in range(4):
+            if frame is None:
+                return False
+            if frame.f_code.co_name == '_worker' and frame.f_code.co_filename.endswith('thread.py'):
+                return True
+            if frame.f_code.co_name not in ('get', 'wait'):
+                return False
+            frame = frame.f_back
+        return False
+    
+    def stop(self):
+        """Stop sampling, write <name>_<time>.folded and .json, and print the hot spots"""
+        RunProfiler.active = None
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        elapsed = time.perf_counter() - self._started
+        peak = None
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        
+        labels = {}
+        folded = {}
+        self_samples = {}
+        for key, count in self.samples.items():
+            phase, codes = self._stacks[key]
+            names = [phase]
+            for code in reversed(codes):
+                if code not in labels:
+                    labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                names.append(labels[code])
+            stack = ';'.join(names)
+            folded[stack] = folded.get(stack, 0) + count
+            self_samples[names[-1]] = self_samples.get(names[-1], 0) + count
+        total = max(sum(folded.values()), 1)
+        hot_spots = sorted(self_samples.items(), key=lambda kv: kv[1], reverse=True)[:15]
+        
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        prefix = self.output_dir / f"profile_{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        with open(f"{prefix}.folded", 'w', encoding='utf-8') as f:
+            for stack, count in sorted(folded.items()):
+                f.write(f"{stack} {count}\n")
+        with open(f"{prefix}.json", 'w', encoding='utf-8') as f:
+            json.dump({
+                'seconds': elapsed,
+                'sample_interval': self.interval,
+                'samples': self.sample_count,
+                'peak_bytes': peak,
+                'phases': self.phases,
+                'hot_spots': [{'frame': leaf, 'share': count / total} for leaf, count in hot_spots]
+            }, f, indent=2)
+        
+        print("\n" + "="*50)
+        print("⏱️  PROFILE")
+        print("="*50)
+        for path, record in sorted(self.phases.items(), key=lambda kv: kv[1]['seconds'], reverse=True):
+            print(f"{path:<32} {record['seconds']:8.2f}s  x{record['calls']}")
+        if peak is not None:
+            print(f"Peak traced memory: {peak / (1024**2):.1f} MB")
+        print("\nHot spots (share of sampled thread time):")
+        for leaf, count in hot_spots[:10]:
+            print(f"  {count / total:6.1%}  {leaf}")
+        print(f"\nFlame graph input: {prefix}.folded (flamegraph.pl or https://speedscope.app)")
+        print(f"Phase summary:     {prefix}.json")
+
+
+class ExportManifest:
+    """
+    Record of the pages in an export folder and the files written for each.
+    
+    Stored as .export_manifest.json in the export folder: page ID ->
+    lastModifiedDateTime and output paths. A later run can update the same
+    folder: pages whose timestamp and files are unchanged are kept as they
+    are, changed pages have their old files replaced, and pages deleted in
+    OneNote are removed.
+    """
+    FILE_NAME = ".export_manifest.json"
+    # Version 1 exports wrote an ENEX file per page rather than per notebook
+    VERSION = 2
+    
+    def __init__(self, export_root, export_formats):
+        self.export_root = Path(export_root)
+        self.path = self.export_root / self.FILE_NAME
+        self.formats = sorted(export_formats)
+        self.pages = {}
+        self.unchanged = set()
+        self._lock = threading.Lock()
+        self._reusable = False
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.pages = data.get('pages', {})
+            # Pages exported in other formats, or by an older version, are exported again
+            self._reusable = data.get('formats') == self.formats and data.get('version', 1) == self.VERSION
+    
+    @classmethod
+    def find(cls, destination):
+        """Return the newest OneNote_Export_* folder in destination that has a manifest, or None"""
+        exports = sorted(Path(destination).glob("OneNote_Export_*"))
+        for folder in reversed(exports):
+            if (folder / cls.FILE_NAME).exists():
+                return folder
+        return None
+    
+    def plan(self, pages, remove_deleted=True):
+        """
+        Sort the current pages against the manifest before exporting.
+        
+        Files of changed pages are removed now, before any page is written,
+        so a new page can take over a title freed by another one. Pages that
+        are no longer in OneNote are removed when remove_deleted is set.
+        
+        Returns:
+            (number of changed pages, number of removed pages)
+        """
+        current = {page['id']: page for page in pages}
+        changed = removed = 0
+        for page_id in list(self.pages):
+            if page_id not in current:
+                if remove_deleted:
+                    self.remove(page_id)
+                    removed += 1
+                continue
+            entry = self.pages[page_id]
+            if (self._reusable and entry.get('modified') == current[page_id].get('lastModifiedDateTime')
+                    and all((self.export_root / path).exists() for path in entry['outputs'])):
+                self.unchanged.add(page_id)
+            else:
+                self.remove(page_id)
+                changed += 1
+        return changed, removed
+    
+    def kept_paths(self):
+        """Absolute output paths of the pages kept from the previous run"""
+        return [self.export_root / path for page_id in self.unchanged
+                for path in self.pages[page_id]['outputs']]
+    
+    def record(self, page, outputs):
+        """Remember the files written for a page"""
+        with self._lock:
+            self.pages[page['id']] = {
+                'title': page.get('title'),
+                'modified': page.get('lastModifiedDateTime'),
+                'outputs': [Path(path).relative_to(self.export_root).as_posix() for path in outputs]
+            }
+    
+    def remove(self, page_id):
+        """Delete the files of a page and forget it"""
+        entry = self.pages.pop(page_id, None)
+        if entry is None:
+            return
+        for path in entry['outputs']:
+            target = self.export_root / path
+            if target.is_dir():
+                shutil.rmtree(target, ignore_errors=True)
+            elif target.exists():
+                target.unlink()
+            # Drop folders (sections, notebooks) left empty
+            parent = target.parent
+            while parent != self.export_root and parent.is_dir() and not any(parent.iterdir()):
+                parent.rmdir()
+                parent = parent.parent
+    
+    def save(self):
+        with self._lock:
+            data = {'version': self.VERSION, 'formats': self.formats, 'pages': self.pages}
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class ResourceStore:
+    """
+    Content-addressed store for attachments, shared by every export in a destination folder.
+    
+    Each attachment is kept once as .onenote_resources/<sha256><ext>, and an
+    index maps Graph resource IDs to stored files. A resource already in the
+    store is hardlinked into the page's attachment folder instead of being
+    downloaded again, whether it was used by another page, another notebook
+    or an earlier export, and identical files share one copy on disk. Where
+    the filesystem has no hardlinks (FAT/exFAT), stored files are copied
+    instead and the store only saves downloads.
+    """
+    DIR_NAME = ".onenote_resources"
+    INDEX_FILE = "index.json"
+    
+    def __init__(self, destination):
+        self.root = Path(destination) / self.DIR_NAME
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / self.INDEX_FILE
+        self.index = {}
+        self._lock = threading.Lock()
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+    
+    @staticmethod
+    def resource_key(url):
+        """Graph resource ID of an attachment URL (the URL itself if it has none)"""
+        match = re.search(r'/onenote/resources/([^/?]+)', url)
+        return match.group(1) if match else url
+    
+    def lookup(self, key):
+        """Stored file for a resource ID, or None if it was never stored or is gone"""
+        with self._lock:
+            name = self.index.get(key)
+        if name and (self.root / name).exists():
+            return self.root / name
+        return None
+    
+    def adopt(self, path, digest, key=None):
+        """
+        Take a freshly written attachment into the store.
+        
+        If the same content is stored already, the new file is replaced by a
+        link to the stored copy; otherwise it becomes the stored copy.
+        """
+        stored = self.root / f"{digest}{Path(path).suffix.lower()}"
+        with self._lock:
+            if stored.exists():
+                self.link(stored, path)
+            else:
+                try:
+                    os.link(path, stored)
+                except OSError:
+                    shutil.copyfile(path, stored)
+            if key:
+                self.index[key] = stored.name
+    
+    @staticmethod
+    def link(stored, target):
+        """Make target a hardlink of a stored file (a copy where hardlinks are not supported)"""
+        target = Path(target)
+        tmp_path = target.with_name(target.name + '.tmp')
+        try:
+            os.link(stored, tmp_path)
+        except OSError:
+            shutil.copyfile(stored, tmp_path)
+        os.replace(tmp_path, target)
+    
+    def save(self):
+        with self._lock:
+            data = dict(self.index)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.index_path)
+
+
+
+class PageCache:
+    """
+    Page HTML kept between runs, next to the exports in a destination folder.
+    
+    Each page is saved as .onenote_cache/pages/<hash of page ID>.html, and an
+    index records the lastModifiedDateTime it was fetched at. A page is only
+    served from the cache while that timestamp matches OneNote's. The last
+    complete notebook listing is kept as well, so that together with the
+    ResourceStore an export can be redone in any format without going online.
+    """
+    DIR_NAME = ".onenote_cache"
+    INDEX_FILE = "index.json"
+    INVENTORY_FILE = "inventory.json"
+    
+    def __init__(self, destination):
+        self.root = Path(destination) / self.DIR_NAME
+        self.pages_dir = self.root / "pages"
+        self.pages_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / self.INDEX_FILE
+        self.index = {}
+        self._lock = threading.Lock()
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+    
+    def page_path(self, page_id):
+        # Page IDs contain '!' and can be long; a hash is safe on every filesystem
+        return self.pages_dir / f"{hashlib.sha1(page_id.encode('utf-8')).hexdigest()}.html"
+    
+    def get(self, page):
+        """Cached HTML of a page, or None if it is not cached at its current lastModifiedDateTime"""
+        with self._lock:
+            modified = self.index.get(page['id'])
+        if modified is None or modified != page.get('lastModifiedDateTime'):
+            return None
+        try:
+            with open(self.page_path(page['id']), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def put(self, page, content):
+        path = self.page_path(page['id'])
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.index[page['id']] = page.get('lastModifiedDateTime')
+    
+    def save_inventory(self, notebooks):
+        """Keep a complete listing from get_inventory() for offline runs"""
+        tmp_path = self.root / (self.INVENTORY_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(notebooks, f)
+        os.replace(tmp_path, self.root / self.INVENTORY_FILE)
+    
+    def load_inventory(self):
+        """The last saved listing, or None"""
+        try:
+            with open(self.root / self.INVENTORY_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def save(self):
+        with self._lock:
+            data = dict(self.index)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.index_path)
+
+
+class EnexWriter:
+    """
+    Streams the notes of one notebook into ENEX files (Evernote XML).
+    
+    Notes are appended as their pages finish, each carrying its attachments
+    as <resource> elements. Attachment files are read back from disk and
+    base64 encoded a block at a time, so memory use stays flat however big
+    the notebook or its attachments are. Once a file reaches max_bytes it is
+    closed and the next note starts "<name> (2).enex", and so on.
+    
+    Files are written as "<name>.enex.part" and only take the place of the
+    previous run's files in close(); discard() drops them instead.
+    """
+    HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">\n'
+              '<en-export export-date="{date}" application="OneNote Exporter" version="1.0">\n')
+    FOOTER = '</en-export>\n'
+    # XHTML elements ENML accepts; <img> is left out because every picture
+    # is already attached as an <en-media> resource
+    ENML_TAGS = {'a', 'abbr', 'acronym', 'address', 'area', 'b', 'bdo', 'big', 'blockquote', 'br',
+                 'caption', 'center', 'cite', 'code', 'col', 'colgroup', 'dd', 'del', 'dfn', 'div',
+                 'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'ins',
+                 'kbd', 'li', 'map', 'ol', 'p', 'pre', 'q', 's', 'samp', 'small', 'span', 'strike',
+                 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'tt',
+                 'u', 'ul', 'var', 'xmp'}
+    ENML_EMPTY = {'area', 'br', 'col', 'hr'}
+    ENML_REMOVED = re.compile(r"<(head|script|style|title|iframe|noscript)\b.*?</\1\s*>|<!--.*?-->|<[!?][^>]*>",
+                              re.DOTALL | re.IGNORECASE)
+    ENML_TAG = re.compile(r"""<(/?)([A-Za-z][\w:-]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+    ENML_ATTRIBUTE = re.compile(r"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+    # Attributes the ENML DTD rejects
+    ENML_BLOCKED = re.compile(r"id|class|on\w+|accesskey|data(-[\w-]*)?|dynsrc|tabindex", re.IGNORECASE)
+    # 57 bytes of a file become one 76-character base64 line
+    READ_SIZE = 57 * 1024
+    
+    def __init__(self, folder, name, max_bytes):
+        self.folder = Path(folder)
+        self.name = name
+        self.max_bytes = max_bytes
+        self.files = []
+        self.notes = 0
+        self._file = None
+        self._size = 0
+        self._file_notes = 0
+        self._lock = threading.Lock()
+    
+    def add_note(self, title, page_content, metadata, attachment_paths):
+        """Append one page with its attachment files; returns the ENEX file it went into"""
+        # ENML wants each resource's MD5 in the note content, ahead of the resource data
+        resources = []
+        for path in map(Path, attachment_paths):
+            if path.is_file():
+                mime_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+                resources.append((path, self.file_md5(path), mime_type))
+        
+        content = self.enml(page_content)
+        media = ''.join(f'<div><en-media type="{mime_type}" hash="{digest}"/></div>\n'
+                        for _, digest, mime_type in resources)
+        estimate = len(content) + sum(path.stat().st_size for path, _, _ in resources) * 4 // 3
+        
+        with self._lock:
+            if self._file is None or (self._file_notes and self._size + estimate > self.max_bytes):
+                self._next_file()
+            self._write(f"""  <note>
+    <title>{html.escape(title)}</title>
+    <content><![CDATA[<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
+<en-note>
+{content}
+{media}</en-note>]]></content>
+    <created>{self.enex_time(metadata['created'])}</created>
+    <updated>{self.enex_time(metadata['modified'])}</updated>
+""")
+            for path, _, mime_type in resources:
+                self._write('    <resource>\n      <data encoding="base64">\n')
+                with open(path, 'rb') as f:
+                    while True:
+                        block = f.read(self.READ_SIZE)
+                        if not block:
+                            break
+                        self._write(base64.encodebytes(block).decode('ascii'))
+                self._write(f"""      </data>
+      <mime>{mime_type}</mime>
+      <resource-attributes>
+        <file-name>{html.escape(path.name)}</file-name>
+      </resource-attributes>
+    </resource>
+""")
+            self._write('  </note>\n')
+            self._file_notes += 1
+            self.notes += 1
+            return self.files[-1]
+    
+    def close(self):
+        """Finish the open file, put the new files in place and delete the rest from an earlier run"""
+        with self._lock:
+            if self._file:
+                self._write(self.FOOTER)
+                self._file.close()
+                self._file = None
+        for path in self.files:
+            self.part_path(path).replace(path)
+        if self.folder.is_dir():
+            pattern = re.compile(re.escape(self.name) + r'( \(\d+\))?\.enex(\.part)?')
+            for path in self.folder.iterdir():
+                if pattern.fullmatch(path.name) and path not in self.files:
+                    path.unlink()
+    
+    def discard(self):
+        """Drop the files of an unfinished run, keeping those of the earlier run"""
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+        for path in self.files:
+            part = self.part_path(path)
+            if part.exists():
+                part.unlink()
+    
+    @staticmethod
+    def part_path(path):
+        return path.with_name(path.name + '.part')
+    
+    @classmethod
+    def enml(cls, page_content):
+        """
+        Page HTML as the body of an <en-note>.
+        
+        Elements ENML does not allow are dropped, keeping their text, and so
+        are attributes it rejects (id, class, data-*, event handlers). The
+        result goes into a CDATA section, so only ']]>' needs escaping.
+        """
+        def tag(match):
+            closing, name, attributes = match.groups()
+            name = name.lower()
+            if name not in cls.ENML_TAGS:
+                return ''
+            if closing:
+                return '' if name in cls.ENML_EMPTY else f'</{name}>'
+            kept = ''
+            for attribute, quoted, single, bare in cls.ENML_ATTRIBUTE.findall(attributes):
+                if not cls.ENML_BLOCKED.fullmatch(attribute):
+                    value = html.unescape(quoted or single or bare)
+                    kept += f' {attribute.lower()}="{html.escape(value, quote=True)}"'
+            if name in cls.ENML_EMPTY or attributes.rstrip().endswith('/'):
+                return f'<{name}{kept}/>'
+            return f'<{name}{kept}>'
+        
+        content = cls.ENML_REMOVED.sub('', page_content)
+        content = cls.ENML_TAG.sub(tag, content)
+        return content.strip().replace(']]>', ']]&gt;')
+    
+    @classmethod
+    def file_md5(cls, path):
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(cls.READ_SIZE * 16), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def enex_time(value):
+        """Graph timestamp (2024-01-31T12:00:00.123Z) in ENEX form (20240131T120000Z)"""
+        return re.sub(r'[-:]|\.\d+', '', value or '')
+    
+    def _next_file(self):
+        if self._file:
+            self._write(self.FOOTER)
+            self._file.close()
+        suffix = f" ({len(self.files) + 1})" if self.files else ''
+        path = self.folder / f"{self.name}{suffix}.enex"
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.part_path(path), 'wb')
+        self.files.append(path)
+        self._size = 0
+        self._file_notes = 0
+        self._write(self.HEADER.format(date=datetime.now().strftime('%Y%m%dT%H%M%SZ')))
+    
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self._file.write(data)
+        self._size += len(data)
+
+
+class MarkdownConverter:
+    """
+    HTML to Markdown in one walk over the page.
+    
+    A tokenizer regex finds each tag, comment and run of text in order and
+    hands it to the handlers once, so conversion time grows linearly with
+    the page size. Only the attributes of links and images are parsed, and
+    tags without a Markdown form (span, font...) are passed over.
+    
+    Open elements are kept on a stack. A closing tag also closes everything
+    opened after its match, and a new <li>, <tr> or cell closes the one
+    before it, so an unclosed tag cannot swallow the rest of the page. Links
+    and table cells collect their text in a buffer of their own. A table
+    inside a cell has no Markdown form, so its cells are written into that
+    cell as plain text.
+    """
+    ATTRS = r"""[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*"""
+    TOKEN = re.compile(r"<!--.*?(?:-->|\Z)|<[!?][^>]*>|<(/?)([A-Za-z][A-Za-z0-9:-]*)(" + ATTRS + ")>",
+                       re.DOTALL)
+    ATTRIBUTE = re.compile(r"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+    DATA_URL = re.compile(r"""[^\s"'>]*""")
+    HEADINGS = {f'h{level}': '#' * level + ' ' for level in range(1, 7)}
+    BLOCKS = {'p', 'div', 'blockquote', 'section', 'article'}
+    SKIPPED = {'head', 'title', 'script', 'style'}
+    EMPHASIS = {'b': '**', 'strong': '**', 'i': '*', 'em': '*', 'del': '~~', 's': '~~', 'code': '`'}
+    EMPTY = {'br', 'hr', 'img'}
+    # A new element closes an open one of these kinds, up to the list or table it belongs to
+    IMPLIED_END = {'li': ({'li'}, {'ul', 'ol'}),
+                   'tr': ({'tr'}, {'table'}),
+                   'td': ({'td', 'th'}, {'tr', 'table'}),
+                   'th': ({'td', 'th'}, {'tr', 'table'})}
+    HANDLED = (set(HEADINGS) | BLOCKS | SKIPPED | set(EMPHASIS) | EMPTY |
+               {'ul', 'ol', 'li', 'a', 'pre', 'table', 'tr', 'td', 'th'})
+    
+    def __init__(self, data_links=None):
+        # Replacement links for data: URLs, keyed by where the URL starts in the page
+        self.data_links = data_links or {}
+        self.buffers = [[]]
+        self.stack = []   # [tag, state] of each open element
+        self.lists = []   # [tag, items numbered so far] of each open list
+        self.tables = []  # rows of each open table; None for a table inside a cell
+        self.cells = 0
+        self.skip_depth = 0
+        self.pre_depth = 0
+    
+    def convert(self, html_content):
+        if self.data_links:
+            html_content = self.replace_data_urls(html_content)
+        position = 0
+        for match in self.TOKEN.finditer(html_content):
+            if match.start() > position:
+                self.handle_data(html_content[position:match.start()])
+            position = match.end()
+            closing, tag, attributes = match.groups()
+            if tag is None:
+                continue  # comment, doctype or <?xml ...?>
+            tag = tag.lower()
+            if tag not in self.HANDLED:
+                continue
+            if closing:
+                self.close(tag)
+            else:
+                self.open(tag, attributes)
+        if position < len(html_content):
+            self.handle_data(html_content[position:])
+        while self.stack:
+            self.end(*self.stack.pop())
+        
+        md = ''.join(self.buffers[0])
+        md = re.sub(r'[ \t]+\n', '\n', md)
+        md = re.sub(r'\n{3,}', '\n\n', md)
+        return md.strip()
+    
+    def replace_data_urls(self, html_content):
+        """The page with each data: URL in data_links swapped for its link"""
+        parts = []
+        position = 0
+        for start in sorted(self.data_links):
+            if start < position:
+                continue
+            parts += [html_content[position:start], html.escape(self.data_links[start])]
+            # A quoted value runs to its closing quote, even over the line breaks of wrapped base64
+            quote = html_content[start - 1:start]
+            end = html_content.find(quote, start) if quote in ('"', "'") else -1
+            position = end if end >= 0 else self.DATA_URL.match(html_content, start).end()
+        parts.append(html_content[position:])
+        return ''.join(parts)
+    
+    @classmethod
+    def attribute_spans(cls, text, start=0, end=None):
+        """Attribute name -> (start, end) of its value in text, without copying the values"""
+        spans = {}
+        for match in cls.ATTRIBUTE.finditer(text, start, len(text) if end is None else end):
+            group = next((n for n in (2, 3, 4) if match.start(n) >= 0), None)
+            spans[match.group(1).lower()] = match.span(group) if group else (match.end(), match.end())
+        return spans
+    
+    @classmethod
+    def parse_attributes(cls, text):
+        """Attribute values of a tag, decoded"""
+        return {name.lower(): html.unescape(quoted or single or bare)
+                for name, quoted, single, bare in cls.ATTRIBUTE.findall(text)}
+    
+    def open(self, tag, attributes):
+        """Handle a start tag, closing the elements it ends first"""
+        if self.skip_depth and tag not in self.SKIPPED:
+            return
+        if self.pre_depth and tag not in ('br', 'pre'):
+            return  # A code block keeps only its text and line breaks
+        if tag in self.IMPLIED_END:
+            ended, scope = self.IMPLIED_END[tag]
+            for index in range(len(self.stack) - 1, -1, -1):
+                if self.stack[index][0] in scope:
+                    break
+                if self.stack[index][0] in ended:
+                    self.close_to(index)
+                    break
+        state = self.start(tag, attributes)
+        if tag not in self.EMPTY and not attributes.rstrip().endswith('/'):
+            self.stack.append([tag, state])
+        elif tag not in self.EMPTY:
+            self.end(tag, state)
+    
+    def close(self, tag):
+        """Handle an end tag; one without an open element is ignored"""
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                self.close_to(index)
+                return
+    
+    def close_to(self, index):
+        """Close the open element at index of the stack and every element opened after it"""
+        while len(self.stack) > index:
+            self.end(*self.stack.pop())
+    
+    def write(self, text):
+        self.buffers[-1].append(text)
+    
+    def tail(self):
+        """Last two characters written to the current buffer"""
+        return ''.join(self.buffers[-1][-2:])[-2:]
+    
+    def line_break(self, count=1):
+        """End the current line, leaving count newlines (2 = blank line) unless at the start"""
+        buffer = self.buffers[-1]
+        if not buffer:
+            return
+        tail = self.tail()
+        have = len(tail) - len(tail.rstrip('\n'))
+        if have < count:
+            buffer.append('\n' * (count - have))
+    
+    def start(self, tag, attributes):
+        """Write the start of an element; returns the state its end needs"""
+        if tag in self.SKIPPED:
+            self.skip_depth += 1
+        elif tag in self.HEADINGS:
+            self.line_break(2)
+            self.write(self.HEADINGS[tag])
+        elif tag in self.BLOCKS:
+            self.line_break(1 if self.lists else 2)
+        elif tag in ('ul', 'ol'):
+            self.line_break(1 if self.lists else 2)
+            self.lists.append([tag, 0])
+        elif tag == 'li':
+            self.line_break(1)
+            indent = '  ' * max(len(self.lists) - 1, 0)
+            if self.lists and self.lists[-1][0] == 'ol':
+                self.lists[-1][1] += 1
+                self.write(f"{indent}{self.lists[-1][1]}. ")
+            else:
+                self.write(f"{indent}- ")
+        elif tag in self.EMPHASIS:
+            self.write(self.EMPHASIS[tag])
+        elif tag == 'a':
+            self.buffers.append([])
+            return self.parse_attributes(attributes).get('href')
+        elif tag == 'img':
+            attributes = self.parse_attributes(attributes)
+            self.write(f"![{attributes.get('alt', '')}]({attributes.get('src', '')})")
+        elif tag == 'br':
+            self.write('\n')
+        elif tag == 'hr':
+            self.line_break(2)
+            self.write('---')
+            self.line_break(2)
+        elif tag == 'pre':
+            self.line_break(2)
+            self.write('```\n')
+            self.pre_depth += 1
+        elif tag == 'table':
+            if self.cells:
+                self.tables.append(None)
+                self.write(' ')
+            else:
+                self.line_break(2)
+                self.tables.append([])
+        elif tag == 'tr' and self.tables:
+            if self.tables[-1] is None:
+                self.write(' ')
+            else:
+                self.tables[-1].append([])
+        elif tag in ('td', 'th') and self.tables:
+            if self.tables[-1] is None:
+                self.write(' ')
+            else:
+                self.cells += 1
+                self.buffers.append([])
+                return True
+        return None
+    
+    def end(self, tag, state):
+        """Write the end of an element, given the state its start returned"""
+        if tag in self.SKIPPED:
+            self.skip_depth -= 1
+        elif tag in self.HEADINGS:
+            self.line_break(2)
+        elif tag in self.BLOCKS:
+            self.line_break(1 if self.lists else 2)
+        elif tag in ('ul', 'ol'):
+            self.lists.pop()
+            self.line_break(1 if self.lists else 2)
+        elif tag == 'li':
+            self.line_break(1)
+        elif tag in self.EMPHASIS:
+            # Keep a trailing space outside the marker, where Markdown expects it
+            buffer = self.buffers[-1]
+            if buffer and buffer[-1].endswith(' '):
+                buffer[-1] = buffer[-1][:-1]
+                self.write(self.EMPHASIS[tag] + ' ')
+            else:
+                self.write(self.EMPHASIS[tag])
+        elif tag == 'a':
+            text = ' '.join(''.join(self.buffers.pop()).split())
+            self.write(f"[{text or state}]({state})" if state else text)
+        elif tag == 'pre':
+            self.pre_depth -= 1
+            self.line_break(1)
+            self.write('```')
+            self.line_break(2)
+        elif tag == 'table':
+            rows = self.tables.pop()
+            if rows is None:
+                self.write(' ')
+            else:
+                self.write_table(rows)
+        elif tag in ('td', 'th') and state:
+            self.cells -= 1
+            cell = ' '.join(''.join(self.buffers.pop()).split())
+            rows = self.tables[-1]
+            if not rows:
+                rows.append([])
+            rows[-1].append(cell.replace('|', '\\|'))
+    
+    def write_table(self, rows):
+        """A Markdown table, with a header separator after the first row"""
+        rows = [row for row in rows if row]
+        if not rows:
+            return
+        width = max(len(row) for row in rows)
+        self.line_break(2)
+        for number, row in enumerate(rows):
+            self.write('| ' + ' | '.join(row + [''] * (width - len(row))) + ' |\n')
+            if number == 0:
+                self.write('|' + ' --- |' * width + '\n')
+        self.line_break(2)
+    
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if '&' in data:
+            data = html.unescape(data)
+        if self.pre_depth:
+            self.write(data)
+            return
+        text = ' '.join(data.split())
+        if not text:
+            # Whitespace between words still separates them
+            if data and self.buffers[-1] and not self.tail().endswith((' ', '\n')):
+                self.write(' ')
+            return
+        if data[0].isspace() and self.buffers[-1] and not self.tail().endswith((' ', '\n')):
+            text = ' ' + text
+        if data[-1].isspace():
+            text += ' '
+        self.write(text)
+
+
 class OneNoteExporter:
+    RETRY_STATUSES = (429, 503)
+    # Largest $top OneNote accepts; without it the pages endpoint returns 20 at a time
+    LIST_PAGE_SIZE = 100
+    # Only the fields the exporter and advanced_examples.py read
+    NOTEBOOK_FIELDS = "id,displayName,lastModifiedDateTime"
+    SECTION_FIELDS = "id,displayName"
+    PAGE_FIELDS = "id,title,createdDateTime,lastModifiedDateTime,level,order"
+    # Characters of base64 decoded per slice (a multiple of 4)
+    BASE64_CHUNK = 1024 * 1024
+    WHITESPACE = re.compile(r'\s')
+    # Tags that can reference an image or a file; attribute order does not matter
+    RESOURCE_TAG = re.compile(
+        r"""<(img|object|embed|audio|video|source)\b([^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*)>""",
+        re.IGNORECASE)
+    
     def __init__(self):
         self.access_token = None
         self.refresh_token = None
@@ -34,8 +968,33 @@ class OneNoteExporter:
             'audio_files': 0,
             'images': 0,
             'pdfs': 0,
-            'errors': 0
+            'errors': 0,
+            'unchanged': 0,
+            'removed': 0,
+            'reused': 0,
+            'cached': 0
         }
+        self.manifest = None
+        self.store = None
+        self.cache = None
+        # Set when re-rendering from the cache: nothing is requested from OneNote
+        self.offline = False
+        self._resource_downloads = {}
+        self.listing_complete = True
+        # Pages exported at the same time; OneNote throttles hard above a few
+        self.page_workers = 4
+        # Attachment downloads in flight across all pages
+        self.download_workers = 8
+        self._download_pool = None
+        # A notebook's ENEX output is split into files of about this size
+        self.enex_max_bytes = 100 * 1024 * 1024
+        self._stats_lock = threading.Lock()
+        self._print_lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._throttle_lock = threading.Lock()
+        self._resume_at = 0.0
+        self._claimed_paths = set()
+        self._notebook_sections = {}
         
     def authenticate(self):
         """Authenticate with Microsoft Graph API"""
@@ -142,55 +1101,201 @@ class OneNoteExporter:
         except:
             return False
     
-    def make_api_request(self, url, method='GET', data=None):
-        """Make API request with automatic token refresh"""
-        headers = {'Authorization': f'Bearer {self.access_token}'}
+    def make_api_request(self, url, method='GET', data=None, timeout=60, stream=False):
+        """
+        Make API request with automatic token refresh.
         
-        try:
+        Safe to call from several export threads: only one of them refreshes
+        an expired token, and a 429/503 makes every thread wait out the
+        Retry-After interval before its next request.
+        """
+        if self.offline:
+            return None
+        
+        def send():
+            self.wait_for_throttle()
+            headers = {'Authorization': f'Bearer {token}'}
             if method == 'GET':
-                response = requests.get(url, headers=headers, timeout=60)
-            else:
-                response = requests.post(url, headers=headers, json=data, timeout=60)
+                return requests.get(url, headers=headers, timeout=timeout, stream=stream)
+            return requests.post(url, headers=headers, json=data, timeout=timeout)
+        
+        try:
+            token = self.access_token
+            response = send()
             
             if response.status_code == 401 and self.refresh_token:
-                if self.refresh_access_token():
-                    headers['Authorization'] = f'Bearer {self.access_token}'
-                    if method == 'GET':
-                        response = requests.get(url, headers=headers, timeout=60)
-                    else:
-                        response = requests.post(url, headers=headers, json=data, timeout=60)
+                with self._token_lock:
+                    # Another thread may have refreshed while this one waited
+                    refreshed = self.access_token != token or self.refresh_access_token()
+                if refreshed:
+                    token = self.access_token
+                    response = send()
+            
+            for attempt in range(5):
+                if response.status_code not in self.RETRY_STATUSES:
+                    break
+                self.back_off(response, attempt)
+                response = send()
             
             return response
         except Exception as e:
             print(f"❌ API request error: {e}")
             return None
     
-    def get_notebooks(self):
-        """Get all OneNote notebooks"""
-        url = "https://graph.microsoft.com/v1.0/me/onenote/notebooks"
-        response = self.make_api_request(url)
+    def wait_for_throttle(self):
+        """Block until a shared throttling back-off is over"""
+        while True:
+            with self._throttle_lock:
+                delay = self._resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+    
+    def back_off(self, response, attempt):
+        """Start a back-off period for all threads after a throttled response"""
+        try:
+            delay = float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            delay = min(60, 2 ** (attempt + 1))
+        with self._throttle_lock:
+            if self._resume_at > time.time():
+                return
+            self._resume_at = time.time() + delay
+        print(f"\n⏳ Throttled by OneNote ({response.status_code}), waiting {delay:.0f}s...")
+    
+    def count(self, stat, amount=1):
+        """Add to an export statistic (pages are exported on several threads)"""
+        with self._stats_lock:
+            self.stats[stat] += amount
+    
+    def claim_path(self, path):
+        """Reserve an output path, adding ' (2)', ' (3)'... if another page already took it"""
+        with self._stats_lock:
+            candidate = path
+            n = 1
+            while candidate in self._claimed_paths:
+                n += 1
+                candidate = path.with_name(f"{path.stem} ({n}){path.suffix}")
+            self._claimed_paths.add(candidate)
+        return candidate
+    
+    def list_all(self, path, **query):
+        """
+        GET a OneNote collection and follow @odata.nextLink until every item is read.
         
-        if response and response.status_code == 200:
-            return response.json().get('value', [])
-        return []
+        $top is set to the largest page OneNote allows. If a later page
+        fails, the items read so far are returned and a warning is printed,
+        so a short listing never goes unnoticed.
+        """
+        items, error = self.read_collection(path, query)
+        if error:
+            # Pages missing from a short listing must not be taken as deleted
+            self.listing_complete = False
+            if items:
+                print(f"  ⚠️  Listing of {path} stopped after {len(items)} items ({error})")
+                self.count('errors')
+        return items
+    
+    def read_collection(self, path, query):
+        """Read every page of a collection; returns (items, None) or (items read so far, error)"""
+        query.setdefault('$top', self.LIST_PAGE_SIZE)
+        url = f"https://graph.microsoft.com/v1.0/me/onenote/{path}?{urlencode(query, safe='$,()=;')}"
+        items = []
+        while url:
+            response = self.make_api_request(url)
+            if not response or response.status_code != 200:
+                return items, (response.status_code if response is not None else 'no response')
+            result = response.json()
+            items.extend(result.get('value', []))
+            url = result.get('@odata.nextLink')
+        return items, None
+    
+    def get_notebooks(self):
+        """Get all OneNote notebooks, with their sections expanded into the same response"""
+        notebooks = self.list_all('notebooks', **{
+            '$select': self.NOTEBOOK_FIELDS,
+            '$expand': f"sections($select={self.SECTION_FIELDS})"
+        })
+        for notebook in notebooks:
+            if 'sections' in notebook:
+                self._notebook_sections[notebook['id']] = notebook.pop('sections')
+        return notebooks
     
     def get_sections(self, notebook_id):
-        """Get all sections in a notebook"""
-        url = f"https://graph.microsoft.com/v1.0/me/onenote/notebooks/{notebook_id}/sections"
-        response = self.make_api_request(url)
-        
-        if response and response.status_code == 200:
-            return response.json().get('value', [])
-        return []
+        """Get all sections in a notebook (no request if get_notebooks already expanded them)"""
+        if notebook_id in self._notebook_sections:
+            return list(self._notebook_sections[notebook_id])
+        return self.list_all(f"notebooks/{notebook_id}/sections", **{'$select': self.SECTION_FIELDS})
     
     def get_pages(self, section_id):
         """Get all pages in a section"""
-        url = f"https://graph.microsoft.com/v1.0/me/onenote/sections/{section_id}/pages"
-        response = self.make_api_request(url)
+        return self.list_all(f"sections/{section_id}/pages", **{'$select': self.PAGE_FIELDS})
+    
+    def get_inventory(self):
+        """
+        List every notebook, section group, section and page in bulk.
         
-        if response and response.status_code == 200:
-            return response.json().get('value', [])
-        return []
+        Instead of one request per notebook and per section, the four
+        collections are read account-wide (/me/onenote/pages with the parent
+        section expanded, and so on) and the tree is rebuilt locally, so the
+        number of requests depends on the page count, not the number of
+        sections. Sections inside section groups are included.
+        
+        Returns:
+            Notebooks, each with 'sections': section dicts with their 'pages'
+            and 'groups' (enclosing section group names, outermost first)
+        """
+        parents = "parentNotebook($select=id),parentSectionGroup($select=id)"
+        notebooks = self.list_all('notebooks', **{'$select': self.NOTEBOOK_FIELDS})
+        groups = {group['id']: group for group in self.list_all(
+            'sectionGroups', **{'$select': 'id,displayName', '$expand': parents})}
+        sections = self.list_all('sections', **{'$select': self.SECTION_FIELDS, '$expand': parents})
+        pages, error = self.read_collection('pages', {
+            '$select': self.PAGE_FIELDS,
+            '$expand': "parentSection($select=id)"
+        })
+        
+        def group_names(item):
+            names = []
+            group = groups.get((item.get('parentSectionGroup') or {}).get('id'))
+            while group and len(names) < len(groups):
+                names.insert(0, group['displayName'])
+                group = groups.get((group.get('parentSectionGroup') or {}).get('id'))
+            return names
+        
+        by_notebook = {notebook['id']: dict(notebook, sections=[]) for notebook in notebooks}
+        by_section = {}
+        for section in sections:
+            notebook = by_notebook.get((section.get('parentNotebook') or {}).get('id'))
+            if notebook is None:
+                continue
+            entry = {
+                'id': section['id'],
+                'displayName': section['displayName'],
+                'groups': group_names(section),
+                'pages': []
+            }
+            notebook['sections'].append(entry)
+            by_section[entry['id']] = entry
+        
+        if error is None:
+            orphans = 0
+            for page in pages:
+                # parentSection is null for pages whose section is gone or not visible
+                section = by_section.get((page.pop('parentSection', None) or {}).get('id'))
+                if section is not None:
+                    section['pages'].append(page)
+                else:
+                    orphans += 1
+            if orphans:
+                print(f"  ⚠️  Skipped {orphans} page(s) without a listed section")
+        else:
+            # The account-wide page listing can time out on very large accounts
+            print(f"  ⚠️  Bulk page listing failed ({error}), listing pages section by section")
+            for section in by_section.values():
+                section['pages'] = self.get_pages(section['id'])
+        
+        return list(by_notebook.values())
     
     def get_page_content(self, page_id):
         """Get page content in HTML format"""
@@ -201,6 +1306,20 @@ class OneNoteExporter:
             return response.text
         return None
     
+    def fetch_page_content(self, page):
+        """Page HTML from the page cache if it is current there, otherwise from OneNote"""
+        if self.cache:
+            content = self.cache.get(page)
+            if content is not None:
+                self.count('cached')
+                return content
+        if self.offline:
+            return None
+        content = self.get_page_content(page['id'])
+        if content and self.cache:
+            self.cache.put(page, content)
+        return content
+    
     def sanitize_filename(self, filename):
         """Sanitize filename for filesystem"""
         # Remove or replace invalid characters
@@ -210,126 +1329,252 @@ class OneNoteExporter:
             filename = 'untitled'
         return filename[:200]  # Limit length
     
+    def find_resources(self, html_content):
+        """
+        Collect the images and files a page references, in one pass over its tags.
+        
+        The same URL is returned once even if several tags use it (an <img>
+        and its full-resolution copy, or a picture pasted twice). Images use
+        data-fullres-src when present.
+        
+        Embedded data: URLs are not copied out of the page; they are
+        returned as the span of the page where the URL is.
+        
+        Returns:
+            List of dicts with 'url' (None for embedded data), 'data' ((start,
+            end) of a data: URL in the page, or None), 'kind' (image, audio,
+            pdf or file), 'filename', 'urls' (every remote URL the page uses
+            for it) and 'offsets' (start of every data: URL used for it)
+        """
+        resources = {}
+        aliases = {}
+        used_names = set()
+        counters = {}
+        for match in self.RESOURCE_TAG.finditer(html_content):
+            tag = match.group(1).lower()
+            spans = MarkdownConverter.attribute_spans(html_content, *match.span(2))
+            
+            def attribute(name):
+                start, end = spans.get(name, (0, 0))
+                return html.unescape(html_content[start:end])
+            
+            urls = []
+            data = None
+            for name in ('data-fullres-src', 'data', 'src'):
+                start, end = spans.get(name, (0, 0))
+                if end <= start:
+                    continue
+                if html_content.startswith('data:', start):
+                    data = data or (start, end)
+                else:
+                    urls.append(attribute(name))
+            urls = [url for url in urls if url.startswith('http')]
+            if urls:
+                url = urls[0]
+            elif data:
+                url = None
+            else:
+                continue
+            offsets = [data[0]] if data else []
+            known = next((aliases[alias] for alias in urls if alias in aliases), None)
+            if known is not None:
+                for alias in urls:
+                    aliases.setdefault(alias, known)
+                resources[known]['offsets'] += offsets
+                continue
+            
+            mime_type = attribute('type')
+            if url is None:
+                header_end = html_content.find(';', data[0], min(data[1], data[0] + 100))
+                mime_type = html_content[data[0] + 5:header_end] if header_end > 0 else mime_type
+            if tag == 'img':
+                kind = 'image'
+            elif tag == 'audio' or 'audio' in mime_type:
+                kind = 'audio'
+            elif 'pdf' in mime_type:
+                kind = 'pdf'
+            else:
+                kind = 'file'
+            
+            counters[kind] = counters.get(kind, 0) + 1
+            filename = attribute('data-attachment')
+            if filename and url is None:
+                # Embedded files are named here for good, so the name carries the data's type
+                ext = mimetypes.guess_extension(mime_type) if mime_type else None
+                if ext and not filename.endswith(ext):
+                    filename = f"{filename}{ext}"
+            elif not filename:
+                if url is None:
+                    ext = (mimetypes.guess_extension(mime_type) or '').lstrip('.') or None
+                else:
+                    ext = self.get_extension_from_url(url)
+                if kind == 'image':
+                    filename = f"image_{counters[kind]}.{ext or 'png'}"
+                elif kind == 'audio':
+                    filename = f"audio_{counters[kind]}.{ext or 'm4a'}"
+                else:
+                    guessed = mimetypes.guess_extension(mime_type) if mime_type else None
+                    filename = f"attachment_{counters[kind]}{guessed or ('.' + ext if ext else '.bin')}"
+            filename = self.sanitize_filename(filename)
+            
+            # Two attachments with the same name must not overwrite each other
+            stem, suffix = os.path.splitext(filename)
+            n = 1
+            while filename.lower() in used_names:
+                n += 1
+                filename = f"{stem} ({n}){suffix}"
+            used_names.add(filename.lower())
+            key = url or data
+            resources[key] = {'url': url, 'data': data, 'kind': kind, 'filename': filename,
+                              'urls': urls, 'offsets': offsets}
+            for alias in urls:
+                aliases.setdefault(alias, key)
+        return list(resources.values())
+    
+    def download_pool(self):
+        """Thread pool shared by the attachment downloads of all pages"""
+        with self._stats_lock:
+            if self._download_pool is None:
+                self._download_pool = ThreadPoolExecutor(max_workers=self.download_workers,
+                                                         thread_name_prefix="attachment")
+            return self._download_pool
+    
     def extract_attachments(self, html_content, page_path):
         """Extract and download all attachments from page HTML"""
         attachments = []
         attachments_dir = page_path.parent / f"{page_path.stem}_attachments"
         attachments_dir.mkdir(exist_ok=True)
         
-        # Find all data-attachment tags (embedded files)
-        attachment_pattern = r'data-attachment="([^"]+)"[^>]*src="([^"]+)"'
-        for match in re.finditer(attachment_pattern, html_content):
-            filename = match.group(1)
-            url = match.group(2)
-            
-            if url.startswith('data:'):
-                # Base64 embedded data
-                self.save_base64_attachment(url, filename, attachments_dir)
-                attachments.append(filename)
+        resources = self.find_resources(html_content)
+        downloads = {}
+        for resource in resources:
+            if resource['url'] is None:
+                # Base64 embedded data, decoded straight from the page
+                saved = self.save_base64_attachment(html_content, resource['filename'], attachments_dir,
+                                                    *resource['data'])
+                if saved:
+                    self.store.adopt(*saved)
+                    self.record_attachment(resource, attachments)
             else:
-                # URL to download
-                self.download_attachment(url, filename, attachments_dir)
-                attachments.append(filename)
-        
-        # Find all img tags
-        img_pattern = r'<img[^>]*src="([^"]+)"[^>]*(?:data-fullres-src="([^"]+)")?'
-        img_count = 0
-        for match in re.finditer(img_pattern, html_content):
-            img_count += 1
-            src = match.group(1)
-            fullres = match.group(2) if match.group(2) else src
-            
-            # Use fullres if available
-            url = fullres if fullres else src
-            
-            if url.startswith('data:'):
-                filename = f"image_{img_count}.png"
-                self.save_base64_attachment(url, filename, attachments_dir)
-                attachments.append(filename)
-                self.stats['images'] += 1
-            elif url.startswith('http'):
-                # Extract extension from URL or use png
-                ext = self.get_extension_from_url(url) or 'png'
-                filename = f"image_{img_count}.{ext}"
-                if self.download_attachment(url, filename, attachments_dir):
-                    attachments.append(filename)
-                    self.stats['images'] += 1
-        
-        # Find all object/embed tags (PDFs, audio, video)
-        object_pattern = r'<object[^>]*data="([^"]+)"[^>]*type="([^"]+)"'
-        for match in re.finditer(object_pattern, html_content):
-            url = match.group(1)
-            mime_type = match.group(2)
-            
-            ext = mimetypes.guess_extension(mime_type) or '.bin'
-            filename = f"attachment_{len(attachments) + 1}{ext}"
-            
-            if self.download_attachment(url, filename, attachments_dir):
-                attachments.append(filename)
-                self.stats['attachments'] += 1
-                
-                if 'audio' in mime_type:
-                    self.stats['audio_files'] += 1
-                elif 'pdf' in mime_type:
-                    self.stats['pdfs'] += 1
-        
-        # Find audio tags
-        audio_pattern = r'<audio[^>]*src="([^"]+)"'
-        audio_count = 0
-        for match in re.finditer(audio_pattern, html_content):
-            audio_count += 1
-            url = match.group(1)
-            ext = self.get_extension_from_url(url) or 'm4a'
-            filename = f"audio_{audio_count}.{ext}"
-            
-            if self.download_attachment(url, filename, attachments_dir):
-                attachments.append(filename)
-                self.stats['audio_files'] += 1
+                future = self.download_pool().submit(
+                    self.fetch_attachment, resource['url'], resource['filename'], attachments_dir)
+                downloads[future] = resource
+        
+        for future in as_completed(downloads):
+            if future.result():
+                self.record_attachment(downloads[future], attachments)
         
         return attachments, attachments_dir
     
-    def save_base64_attachment(self, data_url, filename, attachments_dir):
-        """Save base64 encoded attachment"""
+    def fetch_attachment(self, url, filename, attachments_dir):
+        """
+        Put one remote attachment into a page folder (runs on the download pool).
+        
+        A resource already in the store is linked instead of downloaded. When
+        several pages need the same resource at once, one of them downloads
+        it and the others wait for it and link it.
+        """
+        key = ResourceStore.resource_key(url)
+        target = attachments_dir / filename
+        with self._stats_lock:
+            pending = self._resource_downloads.get(key)
+            owner = pending is None and self.store.lookup(key) is None
+            if owner:
+                pending = self._resource_downloads[key] = threading.Event()
+        
+        if not owner:
+            if pending:
+                pending.wait()
+            stored = self.store.lookup(key)
+            if stored:
+                self.store.link(stored, target)
+                self.count('reused')
+                return True
+            # The other download failed; try again here
+        
+        try:
+            if self.offline:
+                with self._print_lock:
+                    print(f"    ⚠️  {filename} is not in the attachment store, skipped")
+                return False
+            saved = self.download_attachment(url, filename, attachments_dir)
+            if saved:
+                self.store.adopt(*saved, key)
+            return bool(saved)
+        finally:
+            if owner:
+                with self._stats_lock:
+                    del self._resource_downloads[key]
+                pending.set()
+    
+    def record_attachment(self, resource, attachments):
+        """Count a saved attachment in the statistics"""
+        attachments.append(resource)
+        self.count('attachments')
+        if resource['kind'] == 'image':
+            self.count('images')
+        elif resource['kind'] == 'audio':
+            self.count('audio_files')
+        elif resource['kind'] == 'pdf':
+            self.count('pdfs')
+    
+    def save_base64_attachment(self, data_url, filename, attachments_dir, start=0, end=None):
+        """
+        Save base64 encoded attachment; returns (path, sha256 hex digest) or None.
+        
+        The file is written under filename as given (find_resources() picks
+        it). The data URL can be given in place, as data_url[start:end] of the
+        whole page. It is decoded a slice at a time and written as it goes,
+        so neither the base64 text nor the decoded file is ever held whole.
+        """
+        end = len(data_url) if end is None else end
         try:
             # Parse data URL: data:mime/type;base64,xxxxx
-            match = re.match(r'data:([^;]+);base64,(.+)', data_url)
-            if match:
-                mime_type = match.group(1)
-                base64_data = match.group(2)
-                
-                # Decode base64
-                file_data = base64.b64decode(base64_data)
-                
-                # Determine extension
-                ext = mimetypes.guess_extension(mime_type)
-                if ext and not filename.endswith(ext):
-                    filename = f"{filename}{ext}"
-                
+            comma = data_url.find(',', start, min(end, start + 256))
+            header = data_url[start + 5:comma] if data_url.startswith('data:', start) and comma > 0 else ''
+            if header.endswith(';base64'):
                 filepath = attachments_dir / self.sanitize_filename(filename)
+                digest = hashlib.sha256()
+                carry = ''
                 with open(filepath, 'wb') as f:
-                    f.write(file_data)
+                    for position in range(comma + 1, end, self.BASE64_CHUNK):
+                        chunk = carry + data_url[position:min(position + self.BASE64_CHUNK, end)]
+                        if self.WHITESPACE.search(chunk):
+                            chunk = ''.join(chunk.split())
+                        # Decode whole 4-character groups; the rest waits for the next slice
+                        usable = len(chunk) - len(chunk) % 4
+                        carry = chunk[usable:]
+                        file_data = binascii.a2b_base64(chunk[:usable])
+                        digest.update(file_data)
+                        f.write(file_data)
+                    if carry:
+                        file_data = binascii.a2b_base64(carry + '=' * (-len(carry) % 4))
+                        digest.update(file_data)
+                        f.write(file_data)
                 
-                return True
+                return filepath, digest.hexdigest()
         except Exception as e:
             print(f"  ⚠️  Failed to save base64 attachment {filename}: {e}")
-            self.stats['errors'] += 1
-        return False
+            self.count('errors')
+        return None
     
     def download_attachment(self, url, filename, attachments_dir):
-        """Download attachment from URL"""
+        """Download attachment from URL; returns (path, sha256 hex digest) or None"""
         try:
-            headers = {'Authorization': f'Bearer {self.access_token}'}
-            response = requests.get(url, headers=headers, timeout=120)
+            response = self.make_api_request(url, timeout=120, stream=True)
             
-            if response.status_code == 200:
+            if response is not None and response.status_code == 200:
                 filepath = attachments_dir / self.sanitize_filename(filename)
+                digest = hashlib.sha256()
                 with open(filepath, 'wb') as f:
-                    f.write(response.content)
-                return True
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+                return filepath, digest.hexdigest()
         except Exception as e:
             print(f"  ⚠️  Failed to download {filename}: {e}")
-            self.stats['errors'] += 1
-        return False
+            self.count('errors')
+        return None
     
     def get_extension_from_url(self, url):
         """Extract file extension from URL"""
@@ -337,55 +1582,33 @@ class OneNoteExporter:
         ext = Path(path).suffix
         return ext.lstrip('.') if ext else None
     
-    def convert_html_to_markdown(self, html_content):
-        """Convert HTML to Markdown (simple conversion)"""
-        # This is a basic conversion - for production use, consider using html2text library
-        md = html_content
-        
-        # Remove OneNote-specific tags
-        md = re.sub(r'<\?xml[^>]*>', '', md)
-        md = re.sub(r'data-id="[^"]*"', '', md)
-        
-        # Convert headers
-        md = re.sub(r'<h1[^>]*>(.*?)</h1>', r'# \1\n', md, flags=re.DOTALL)
-        md = re.sub(r'<h2[^>]*>(.*?)</h2>', r'## \1\n', md, flags=re.DOTALL)
-        md = re.sub(r'<h3[^>]*>(.*?)</h3>', r'### \1\n', md, flags=re.DOTALL)
-        
-        # Convert lists
-        md = re.sub(r'<ul[^>]*>', '\n', md)
-        md = re.sub(r'</ul>', '\n', md)
-        md = re.sub(r'<li[^>]*>(.*?)</li>', r'- \1\n', md, flags=re.DOTALL)
-        
-        # Convert formatting
-        md = re.sub(r'<strong[^>]*>(.*?)</strong>', r'**\1**', md, flags=re.DOTALL)
-        md = re.sub(r'<em[^>]*>(.*?)</em>', r'*\1*', md, flags=re.DOTALL)
-        md = re.sub(r'<b[^>]*>(.*?)</b>', r'**\1**', md, flags=re.DOTALL)
-        md = re.sub(r'<i[^>]*>(.*?)</i>', r'*\1*', md, flags=re.DOTALL)
-        
-        # Convert links
-        md = re.sub(r'<a[^>]*href="([^"]+)"[^>]*>(.*?)</a>', r'[\2](\1)', md, flags=re.DOTALL)
-        
-        # Convert images
-        md = re.sub(r'<img[^>]*src="([^"]+)"[^>]*alt="([^"]*)"[^>]*>', r'![\2](\1)', md)
-        md = re.sub(r'<img[^>]*src="([^"]+)"[^>]*>', r'![](\1)', md)
-        
-        # Remove remaining HTML tags
-        md = re.sub(r'<[^>]+>', '', md)
-        
-        # Clean up whitespace
-        md = re.sub(r'\n\s*\n\s*\n', '\n\n', md)
-        
-        # Decode HTML entities
-        md = html.unescape(md)
-        
-        return md.strip()
+    def convert_html_to_markdown(self, html_content, data_links=None):
+        """Convert HTML to Markdown (see MarkdownConverter)"""
+        return MarkdownConverter(data_links).convert(html_content)
     
-    def export_for_joplin(self, notebook_folder, page_title, page_content, attachments_dir, metadata):
-        """Export page in Joplin format (Markdown with frontmatter)"""
-        md_content = self.convert_html_to_markdown(page_content)
+    def export_for_joplin(self, notebook_folder, page_title, page_content, attachments_dir, metadata,
+                          attachments=None):
+        """
+        Export page in Joplin format (Markdown with frontmatter).
+        
+        With the attachments from extract_attachments(), every image and link
+        pointing at OneNote is replaced by a relative link to the saved file.
+        """
+        joplin_folder = notebook_folder / 'joplin'
+        local_links = {}
+        data_links = {}
+        for attachment in attachments or []:
+            local = quote(Path(os.path.relpath(attachments_dir / attachment['filename'], joplin_folder)).as_posix())
+            local_links.update((url, local) for url in attachment['urls'])
+            # Embedded images get their link while converting, so the data is never copied
+            data_links.update((offset, local) for offset in attachment['offsets'])
+        md_content = self.convert_html_to_markdown(page_content, data_links)
         
         # Update image/attachment references
-        if attachments_dir.exists():
+        if attachments:
+            for url, local in local_links.items():
+                md_content = md_content.replace(f"]({url})", f"]({local})")
+        elif attachments_dir.exists():
             attachment_folder_name = attachments_dir.name
             md_content = re.sub(
                 r'!\[([^\]]*)\]\((?:data:[^)]+|https?://[^)]+)\)',
@@ -394,7 +1617,7 @@ class OneNoteExporter:
             )
         
         # Create Joplin markdown file
-        joplin_file = notebook_folder / 'joplin' / f"{self.sanitize_filename(page_title)}.md"
+        joplin_file = self.claim_path(joplin_folder / f"{self.sanitize_filename(page_title)}.md")
         joplin_file.parent.mkdir(parents=True, exist_ok=True)
         
         with open(joplin_file, 'w', encoding='utf-8') as f:
@@ -405,131 +1628,268 @@ class OneNoteExporter:
         
         return joplin_file
     
-    def export_for_evernote(self, notebook_folder, page_title, page_content, attachments, metadata):
-        """Export page in ENEX format (Evernote XML)"""
-        # Create ENEX file
-        enex_file = notebook_folder / 'evernote' / f"{self.sanitize_filename(page_title)}.enex"
-        enex_file.parent.mkdir(parents=True, exist_ok=True)
-        
-        # Clean HTML for Evernote
-        content = page_content
-        content = re.sub(r'data-id="[^"]*"', '', content)
-        content = html.escape(content)
-        
-        enex_content = f"""<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">
-<en-export export-date="{datetime.now().strftime('%Y%m%dT%H%M%SZ')}" application="OneNote Exporter" version="1.0">
-  <note>
-    <title>{html.escape(page_title)}</title>
-    <content><![CDATA[<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
-<en-note>
-{content}
-</en-note>]]></content>
-    <created>{metadata['created']}</created>
-    <updated>{metadata['modified']}</updated>
-  </note>
-</en-export>
-"""
+    def export_for_evernote(self, enex, page_title, page_content, attachments_dir, attachments, metadata):
+        """Add page with its attachments to the notebook's ENEX file (see EnexWriter)"""
+        paths = [attachments_dir / attachment['filename'] for attachment in attachments]
+        return enex.add_note(page_title, page_content, metadata, paths)
+    
+    def export_kept_page(self, enex, page, idx, total, section_folder, notebook_folder, export_formats):
+        """
+        Add a page kept from the previous run to the ENEX file, from its files on disk.
+        
+        If the manifest entry or the page's HTML file is missing or damaged,
+        the page is exported again like a changed one.
+        """
+        outputs = (self.manifest.pages.get(page['id']) or {}).get('outputs') or []
+        page_content = None
+        if isinstance(outputs, list) and len(outputs) >= 2:
+            try:
+                html_file, attachments_dir = (self.export_root / path for path in outputs[:2])
+                with open(html_file, 'r', encoding='utf-8') as f:
+                    page_content = f.read()
+            except (OSError, TypeError, ValueError):
+                page_content = None
         
-        with open(enex_file, 'w', encoding='utf-8') as f:
-            f.write(enex_content)
+        if not page_content:
+            with self._print_lock:
+                print(f"    ⚠️  Kept files of {page['title'] or page['id']} are missing or damaged, exporting it again")
+            self.manifest.remove(page['id'])
+            self.manifest.unchanged.discard(page['id'])
+            with self._stats_lock:
+                self._claimed_paths.difference_update(
+                    self.export_root / path for path in outputs if isinstance(path, str))
+            self.export_page(page, idx, total, section_folder, notebook_folder, export_formats, enex)
+            return
         
-        return enex_file
+        try:
+            paths = sorted(attachments_dir.iterdir()) if attachments_dir.is_dir() else []
+            enex.add_note(page['title'] or html_file.stem, page_content, self.page_metadata(page), paths)
+            self.count('unchanged')
+        except OSError as e:
+            with self._print_lock:
+                print(f"    ❌ Could not add {html_file.name} to the ENEX file: {e}")
+            self.count('errors')
+    
+    @staticmethod
+    def page_metadata(page):
+        return {
+            'created': page.get('createdDateTime', ''),
+            'modified': page.get('lastModifiedDateTime', ''),
+            'author': page.get('createdBy', {}).get('user', {}).get('displayName', 'Unknown')
+        }
     
     def export_notebook(self, notebook, export_formats=['both']):
-        """Export a single notebook"""
+        """
+        Export a single notebook.
+        
+        Pages are exported on a pool of page_workers threads, so page
+        downloads, attachment downloads and conversion of different pages
+        overlap. Pages of a section start exporting as soon as that section
+        is listed, while the next section is still being listed. A notebook
+        from get_inventory() needs no listing at all.
+        """
         notebook_name = self.sanitize_filename(notebook['displayName'])
         notebook_folder = self.export_root / notebook_name
         notebook_folder.mkdir(exist_ok=True)
+        if self.store is None:
+            self.store = ResourceStore(self.export_root)
         
         print(f"\n📓 Exporting notebook: {notebook['displayName']}")
         print(f"   Location: {notebook_folder}")
         
-        sections = self.get_sections(notebook['id'])
-        self.stats['notebooks'] += 1
+        # Notebooks from get_inventory() already carry their sections and pages
+        if 'sections' in notebook:
+            sections = notebook['sections']
+        else:
+            with RunProfiler.phase("list sections"):
+                sections = self.get_sections(notebook['id'])
+        self.count('notebooks')
         
-        for section in sections:
-            section_name = self.sanitize_filename(section['displayName'])
-            section_folder = notebook_folder / section_name
-            section_folder.mkdir(exist_ok=True)
+        enex = None
+        if 'evernote' in export_formats or 'both' in export_formats:
+            enex = EnexWriter(notebook_folder / 'evernote', notebook_name, self.enex_max_bytes)
+        
+        # The ENEX files replace the previous run's only once every page is in
+        finished = False
+        try:
+            with ThreadPoolExecutor(max_workers=self.page_workers) as pool:
+                futures = []
+                try:
+                    for section in sections:
+                        groups = section.get('groups', [])
+                        section_folder = notebook_folder.joinpath(
+                            *[self.sanitize_filename(name) for name in groups + [section['displayName']]])
+                        section_folder.mkdir(parents=True, exist_ok=True)
+                        
+                        if 'pages' in section:
+                            pages = section['pages']
+                        else:
+                            with RunProfiler.phase("list pages"):
+                                pages = self.get_pages(section['id'])
+                        
+                        with self._print_lock:
+                            print(f"\n  📑 Section: {'/'.join(groups + [section['displayName']])} ({len(pages)} pages)")
+                        self.count('sections')
+                        
+                        for idx, page in enumerate(pages, 1):
+                            if self.manifest and page['id'] in self.manifest.unchanged:
+                                if enex:
+                                    futures.append(pool.submit(self.export_kept_page, enex, page, idx, len(pages),
+                                                               section_folder, notebook_folder, export_formats))
+                                else:
+                                    self.count('unchanged')
+                                continue
+                            futures.append(pool.submit(self.export_page, page, idx, len(pages),
+                                                       section_folder, notebook_folder, export_formats, enex))
+                    
+                    for future in as_completed(futures):
+                        future.result()
+                except KeyboardInterrupt:
+                    for future in futures:
+                        future.cancel()
+                    raise
+                finally:
+                    self.store.save()
+            
+            finished = True
+        finally:
+            if enex:
+                if finished:
+                    enex.close()
+                else:
+                    enex.discard()
+        
+        if enex and enex.notes:
+            files = enex.files[0].name if len(enex.files) == 1 else f"{len(enex.files)} files"
+            print(f"\n  🐘 Evernote: {enex.notes} notes in {files}")
+    
+    def export_page(self, page, idx, total, section_folder, notebook_folder, export_formats, enex=None):
+        """Export one page with its attachments (runs on an export thread)"""
+        page_title = page['title'] or f"Untitled_{idx}"
+        label = f"    [{idx}/{total}] 📄 {section_folder.name}/{page_title[:50]}"
+        try:
+            # Get page content
+            with RunProfiler.phase("fetch page"):
+                page_content = self.fetch_page_content(page)
+            if not page_content:
+                with self._print_lock:
+                    print(f"{label} ⚠️  {'Not in the page cache' if self.offline else 'No content'}")
+                return
             
-            print(f"\n  📑 Section: {section['displayName']}")
-            self.stats['sections'] += 1
+            # Save raw HTML
+            html_file = self.claim_path(section_folder / f"{self.sanitize_filename(page_title)}.html")
+            with open(html_file, 'w', encoding='utf-8') as f:
+                f.write(page_content)
             
-            pages = self.get_pages(section['id'])
+            # Extract attachments
+            with RunProfiler.phase("attachments"):
+                attachments, attachments_dir = self.extract_attachments(page_content, html_file)
             
-            for idx, page in enumerate(pages, 1):
-                try:
-                    page_title = page['title'] or f"Untitled_{idx}"
-                    print(f"    [{idx}/{len(pages)}] 📄 {page_title[:50]}", end='')
-                    
-                    # Get page content
-                    page_content = self.get_page_content(page['id'])
-                    if not page_content:
-                        print(" ⚠️  No content")
-                        continue
-                    
-                    # Save raw HTML
-                    html_file = section_folder / f"{self.sanitize_filename(page_title)}.html"
-                    with open(html_file, 'w', encoding='utf-8') as f:
-                        f.write(page_content)
-                    
-                    # Extract attachments
-                    attachments, attachments_dir = self.extract_attachments(page_content, html_file)
-                    
-                    # Metadata
-                    metadata = {
-                        'created': page.get('createdDateTime', ''),
-                        'modified': page.get('lastModifiedDateTime', ''),
-                        'author': page.get('createdBy', {}).get('user', {}).get('displayName', 'Unknown')
-                    }
-                    
-                    # Export in requested formats
-                    if 'joplin' in export_formats or 'both' in export_formats:
-                        self.export_for_joplin(notebook_folder, page_title, page_content, attachments_dir, metadata)
-                    
-                    if 'evernote' in export_formats or 'both' in export_formats:
-                        self.export_for_evernote(notebook_folder, page_title, page_content, attachments, metadata)
-                    
-                    self.stats['pages'] += 1
-                    
-                    # Show attachment count
-                    if attachments:
-                        print(f" ✓ ({len(attachments)} attachments)")
-                    else:
-                        print(" ✓")
-                    
-                except Exception as e:
-                    print(f" ❌ Error: {e}")
-                    self.stats['errors'] += 1
+            # Metadata
+            metadata = self.page_metadata(page)
+            
+            # Export in requested formats
+            outputs = [html_file, attachments_dir]
+            if 'joplin' in export_formats or 'both' in export_formats:
+                with RunProfiler.phase("joplin"):
+                    outputs.append(self.export_for_joplin(notebook_folder, page_title, page_content, attachments_dir,
+                                                          metadata, attachments))
+            
+            # The ENEX file is shared by the whole notebook, so it is not one of the page's outputs
+            if enex:
+                with RunProfiler.phase("evernote"):
+                    self.export_for_evernote(enex, page_title, page_content, attachments_dir, attachments, metadata)
+            
+            if self.manifest:
+                self.manifest.record(page, outputs)
+            self.count('pages')
+            
+            # Show attachment count
+            with self._print_lock:
+                if attachments:
+                    print(f"{label} ✓ ({len(attachments)} attachments)")
+                else:
+                    print(f"{label} ✓")
+            
+        except Exception as e:
+            with self._print_lock:
+                print(f"{label} ❌ Error: {e}")
+            self.count('errors')
     
-    def export_all(self, destination_path, export_formats=['both']):
-        """Export all notebooks"""
-        self.export_root = Path(destination_path)
+    def export_all(self, destination_path, export_formats=['both'], incremental=False, rerender=False):
+        """
+        Export all notebooks.
+        
+        With incremental set, the newest earlier export in destination_path
+        is updated in place (see ExportManifest) instead of starting a new
+        OneNote_Export_<timestamp> folder.
+        
+        With rerender set, nothing is fetched from OneNote: notebooks, pages
+        and attachments come from the PageCache and ResourceStore left in
+        destination_path by earlier exports, so no sign-in is needed.
+        """
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.export_root = self.export_root / f"OneNote_Export_{timestamp}"
+        previous = ExportManifest.find(destination_path) if incremental else None
+        self.export_root = previous or Path(destination_path) / f"OneNote_Export_{timestamp}"
         self.export_root.mkdir(parents=True, exist_ok=True)
+        self.manifest = ExportManifest(self.export_root, export_formats)
+        # Shared by all exports in the destination folder
+        self.store = ResourceStore(destination_path)
+        self.cache = PageCache(destination_path)
+        self.offline = rerender
         
-        print(f"\n💾 Export destination: {self.export_root}\n")
+        if previous:
+            print(f"\n🔄 Updating previous export: {self.export_root}\n")
+        else:
+            print(f"\n💾 Export destination: {self.export_root}\n")
         print("="*70)
         print("Starting OneNote Export")
         print("="*70)
         
-        notebooks = self.get_notebooks()
+        if rerender:
+            notebooks = self.cache.load_inventory()
+            if not notebooks:
+                print(f"❌ Nothing cached in {destination_path} yet; run a normal export there first")
+                return False
+            print("📦 Re-rendering from the page cache (offline)")
+        else:
+            with RunProfiler.phase("inventory"):
+                notebooks = self.get_inventory()
+            if notebooks and self.listing_complete:
+                self.cache.save_inventory(notebooks)
         
         if not notebooks:
             print("❌ No notebooks found!")
             return False
         
-        print(f"\nFound {len(notebooks)} notebook(s)")
+        section_count = sum(len(notebook['sections']) for notebook in notebooks)
+        page_count = sum(len(section['pages']) for notebook in notebooks for section in notebook['sections'])
+        print(f"\nFound {len(notebooks)} notebook(s), {section_count} section(s), {page_count} page(s)")
         
-        for notebook in notebooks:
-            try:
-                self.export_notebook(notebook, export_formats)
-            except Exception as e:
-                print(f"\n❌ Error exporting notebook {notebook['displayName']}: {e}")
-                self.stats['errors'] += 1
+        if self.manifest.pages:
+            pages = [page for notebook in notebooks for section in notebook['sections'] for page in section['pages']]
+            changed, removed = self.manifest.plan(pages, remove_deleted=self.listing_complete)
+            self.count('removed', removed)
+            for path in self.manifest.kept_paths():
+                self.claim_path(path)
+            print(f"   {len(self.manifest.unchanged)} unchanged, {changed} changed, "
+                  f"{page_count - len(self.manifest.unchanged) - changed} new, {removed} deleted in OneNote")
+            if not self.listing_complete:
+                print("   ⚠️  Listing was incomplete, so no pages are removed this time")
+        
+        try:
+            for notebook in notebooks:
+                try:
+                    self.export_notebook(notebook, export_formats)
+                except Exception as e:
+                    print(f"\n❌ Error exporting notebook {notebook['displayName']}: {e}")
+                    self.count('errors')
+        finally:
+            self.manifest.save()
+            self.cache.save()
+            if self._download_pool:
+                self._download_pool.shutdown()
+                self._download_pool = None
         
         # Save export summary
         summary_file = self.export_root / "export_summary.json"
@@ -593,8 +1953,9 @@ OneNote_Export_YYYYMMDD_HHMMSS/
 
 1. Open Evernote desktop application
 2. Go to File → Import → Evernote Export Files (.enex)
-3. Select ENEX files from the 'evernote' folder
-4. Files will be imported into Evernote
+3. Select the ENEX file from the 'evernote' folder of a notebook
+   (large notebooks are split into "Notebook (2).enex" and so on)
+4. The notes are imported into Evernote with their attachments
 
 Note: Evernote has limitations on attachment types and sizes.
 
@@ -657,10 +2018,17 @@ For issues or questions, please check the project documentation.
         print(f"Notebooks exported:     {self.stats['notebooks']}")
         print(f"Sections processed:     {self.stats['sections']}")
         print(f"Pages exported:         {self.stats['pages']}")
+        if self.stats['cached']:
+            print(f"  - From page cache:    {self.stats['cached']}")
+        if self.stats['unchanged'] or self.stats['removed']:
+            print(f"Pages unchanged:        {self.stats['unchanged']}")
+            print(f"Pages removed:          {self.stats['removed']}")
         print(f"Total attachments:      {self.stats['attachments']}")
         print(f"  - Images:             {self.stats['images']}")
         print(f"  - Audio files:        {self.stats['audio_files']}")
         print(f"  - PDFs:               {self.stats['pdfs']}")
+        if self.stats['reused']:
+            print(f"  - Already downloaded: {self.stats['reused']}")
         if self.stats['errors'] > 0:
             print(f"Errors encountered:     {self.stats['errors']}")
         print(f"\nExport location:        {self.export_root}")
@@ -668,16 +2036,50 @@ For issues or questions, please check the project documentation.
         print("="*70)
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export OneNote notebooks with attachments for Evernote, Joplin, etc.")
+    parser.add_argument('--profile', nargs='?', const='.', metavar='DIR',
+                        help="Profile the export: write flame graph stacks and per-step timings "
+                             "to DIR (default: current folder)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="With --profile, also report the peak traced memory (slows the export)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Update the newest earlier export in the destination folder "
+                             "instead of starting a new one")
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                        help="Pages exported at the same time (default: 4)")
+    parser.add_argument('--rerender', action='store_true',
+                        help="Export again from the pages and attachments cached by earlier exports "
+                             "in the destination folder, without signing in or going online")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+    profiler = RunProfiler('onenote_exporter', args.profile,
+                           memory=args.profile_memory).start() if args.profile else None
+    try:
+        run(args)
+    finally:
+        if profiler:
+            profiler.stop()
+
+
+def run(args):
+    """Interactive export"""
     print("="*70)
     print("OneNote Export Tool")
     print("Export OneNote notebooks with attachments for Evernote, Joplin, etc.")
     print("="*70)
     
     exporter = OneNoteExporter()
+    exporter.page_workers = max(1, args.workers)
     
-    # Authenticate
-    if not exporter.authenticate():
+    # Authenticate (re-rendering works from the cache only)
+    if args.rerender:
+        print("\n📦 Re-render mode: pages and attachments come from earlier exports, no sign-in needed")
+    elif not exporter.authenticate():
         print("\n❌ Authentication failed. Exiting.")
         return
     
@@ -689,6 +2091,12 @@ def main():
         destination = str(Path.home() / "Desktop")
         print(f"Using default: {destination}")
     
+    incremental = args.incremental
+    previous = ExportManifest.find(destination)
+    if previous and not incremental and not args.rerender:
+        print(f"\n🔄 Found an earlier export: {previous.name}")
+        incremental = input("Update it with only the pages that changed? (y/n): ").strip().lower() == 'y'
+    
     # Choose export format
     print("\n📝 Export format:")
     print("1. Both Joplin (Markdown) and Evernote (ENEX)")
@@ -711,7 +2119,8 @@ def main():
     print("\n🚀 Starting export...")
     print("This may take a while for large notebooks...\n")
     
-    success = exporter.export_all(destination, export_formats)
+    with RunProfiler.phase("export"):
+        success = exporter.export_all(destination, export_formats, incremental, args.rerender)
     
     if success:
         print("\n✅ Export complete!")
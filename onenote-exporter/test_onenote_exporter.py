@@ -0,0 +1,239 @@
+import base64
+import hashlib
+import os
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+
+from onenote_exporter import (EnexWriter, ExportManifest, MarkdownConverter, OneNoteExporter, PageCache,
+                              ResourceStore)
+
+
+class ExportManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = Path(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def export(self, pages):
+        """Write a file per page and save a manifest for them, as a finished export would"""
+        manifest = ExportManifest(self.root, ['joplin'])
+        for page in pages:
+            path = self.root / "Notebook" / f"{page['id']}.md"
+            path.parent.mkdir(exist_ok=True)
+            path.write_text(page['id'])
+            manifest.record(page, [path])
+        manifest.save()
+
+    def test_plan_sorts_changed_removed_and_unchanged(self):
+        self.export([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'},
+                     {'id': 'edited', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'},
+                     {'id': 'deleted', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}])
+
+        manifest = ExportManifest(self.root, ['joplin'])
+        changed, removed = manifest.plan([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'},
+                                          {'id': 'edited', 'lastModifiedDateTime': '2026-02-01T00:00:00Z'},
+                                          {'id': 'new', 'lastModifiedDateTime': '2026-02-01T00:00:00Z'}])
+        self.assertEqual((changed, removed), (1, 1))
+        self.assertEqual(manifest.unchanged, {'kept'})
+        self.assertEqual(manifest.kept_paths(), [self.root / "Notebook" / "kept.md"])
+        self.assertFalse((self.root / "Notebook" / "edited.md").exists())
+        self.assertFalse((self.root / "Notebook" / "deleted.md").exists())
+
+    def test_incomplete_listing_removes_nothing(self):
+        self.export([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'},
+                     {'id': 'unlisted', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}])
+
+        manifest = ExportManifest(self.root, ['joplin'])
+        changed, removed = manifest.plan([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}],
+                                         remove_deleted=False)
+        self.assertEqual((changed, removed), (0, 0))
+        self.assertTrue((self.root / "Notebook" / "unlisted.md").exists())
+
+    def test_other_formats_are_exported_again(self):
+        self.export([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}])
+
+        manifest = ExportManifest(self.root, ['evernote', 'joplin'])
+        changed, removed = manifest.plan([{'id': 'kept', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}])
+        self.assertEqual((changed, removed), (1, 0))
+        self.assertEqual(manifest.unchanged, set())
+
+
+class MarkdownConverterTest(unittest.TestCase):
+    def convert(self, page, data_links=None):
+        return MarkdownConverter(data_links).convert(page)
+
+    def test_headings_and_emphasis(self):
+        self.assertEqual(self.convert("<h1>Title</h1><p>Some <b>bold </b>text</p><h3>Sub</h3>"),
+                         "# Title\n\nSome **bold** text\n\n### Sub")
+
+    def test_lists(self):
+        # The second <li> closes the first one, which was left open
+        self.assertEqual(self.convert("<ul><li>one<li>two<ul><li>inner</li></ul></li></ul>"
+                                      "<ol><li>a</li><li>b</li></ol>"),
+                         "- one\n- two\n  - inner\n\n1. a\n2. b")
+
+    def test_links(self):
+        self.assertEqual(self.convert('<p>See <a href="https://example.com/?a=1&amp;b=2">the  site</a> '
+                                      'and <a href="https://example.org"></a></p>'),
+                         "See [the site](https://example.com/?a=1&b=2) "
+                         "and [https://example.org](https://example.org)")
+
+    def test_data_url_image_uses_its_link(self):
+        page = '<p><img alt="dot" src="data:image/png;base64,iVBO\nRw0K"></p>'
+        self.assertEqual(self.convert(page, {page.index('data:'): "attachments/dot.png"}),
+                         "![dot](attachments/dot.png)")
+
+    def test_table(self):
+        self.assertEqual(self.convert("<table><tr><th>Name</th><th>Qty</th></tr>"
+                                      "<tr><td>a|b</td><td>2</td></tr></table>"),
+                         "| Name | Qty |\n| --- | --- |\n| a\\|b | 2 |")
+
+    def test_unclosed_cells_and_rows(self):
+        self.assertEqual(self.convert("<table><tr><td>a<td>b<tr><td>c</table><p>after</p>"),
+                         "| a | b |\n| --- | --- |\n| c |  |\n\nafter")
+
+    def test_nested_table_becomes_cell_text(self):
+        self.assertEqual(self.convert("<table><tr><td><table><tr><td>in1</td><td>in2</td></tr></table></td>"
+                                      "<td>x</td></tr></table>"),
+                         "| in1 in2 | x |\n| --- | --- |")
+
+
+class FindResourcesTest(unittest.TestCase):
+    RESOURCE = "https://graph.microsoft.com/v1.0/me/onenote/resources/{}/$value"
+
+    def test_each_resource_is_found_once(self):
+        page = (f'<img src="{self.RESOURCE.format("1-small")}" data-fullres-src="{self.RESOURCE.format("1-full")}">'
+                # The same picture again, this time only by its full-resolution URL
+                f'<img src="{self.RESOURCE.format("1-full")}">'
+                f'<object data-attachment="notes.pdf" type="application/pdf" data="{self.RESOURCE.format(2)}"/>'
+                f'<object type="application/pdf" data-attachment="Notes.pdf" data="{self.RESOURCE.format(3)}"/>'
+                f'<object data="{self.RESOURCE.format(2)}" data-attachment="notes.pdf" type="application/pdf"/>')
+        resources = OneNoteExporter().find_resources(page)
+        self.assertEqual([(resource['url'], resource['kind'], resource['filename']) for resource in resources],
+                         [(self.RESOURCE.format("1-full"), 'image', "image_1.png"),
+                          (self.RESOURCE.format(2), 'pdf', "notes.pdf"),
+                          (self.RESOURCE.format(3), 'pdf', "Notes (2).pdf")])
+
+
+class ResourceStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = Path(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def attachment(self, name, data):
+        path = self.root / name
+        path.write_bytes(data)
+        return path, hashlib.sha256(data).hexdigest()
+
+    def test_same_content_is_stored_once(self):
+        store = ResourceStore(self.root)
+        first, digest = self.attachment("first.PNG", b"picture")
+        store.adopt(first, digest, "1-abc")
+        second, _ = self.attachment("second.png", b"picture")
+        store.adopt(second, digest)
+
+        stored = store.root / f"{digest}.png"
+        self.assertEqual(store.lookup("1-abc"), stored)
+        self.assertEqual(second.read_bytes(), b"picture")
+        if os.stat(stored).st_nlink > 1:  # Filesystems without hardlinks get copies
+            self.assertTrue(os.path.samefile(first, second))
+
+    def test_index_is_kept_between_runs(self):
+        store = ResourceStore(self.root)
+        path, digest = self.attachment("scan.pdf", b"%PDF")
+        store.adopt(path, digest, ResourceStore.resource_key(
+            "https://graph.microsoft.com/v1.0/me/onenote/resources/0-f00/$value"))
+        store.save()
+
+        store = ResourceStore(self.root)
+        stored = store.lookup("0-f00")
+        self.assertEqual(stored, store.root / f"{digest}.pdf")
+        self.assertIsNone(store.lookup("0-missing"))
+
+        target = self.root / "page_attachments" / "scan.pdf"
+        target.parent.mkdir()
+        ResourceStore.link(stored, target)
+        self.assertEqual(target.read_bytes(), b"%PDF")
+        stored.unlink()
+        self.assertIsNone(store.lookup("0-f00"))
+
+
+class SaveBase64AttachmentTest(unittest.TestCase):
+    def test_decodes_wrapped_data_in_any_slice_size(self):
+        data = os.urandom(5000)
+        encoded = base64.b64encode(data).decode('ascii')
+        # Pages wrap long base64 text, with line breaks and indentation inside the value
+        wrapped = '\r\n  '.join(encoded[n:n + 76] for n in range(0, len(encoded), 76))
+        page = f'<p>before</p><img src="data:image/png;base64,{wrapped}"><p>after</p>'
+        start = page.index('data:')
+        end = page.index('"', start)
+
+        exporter = OneNoteExporter()
+        with tempfile.TemporaryDirectory() as folder:
+            for chunk in (5, 7, 64, 1021, exporter.BASE64_CHUNK):
+                exporter.BASE64_CHUNK = chunk
+                path, digest = exporter.save_base64_attachment(page, "photo.png", Path(folder), start, end)
+                self.assertEqual(path, Path(folder) / "photo.png")
+                self.assertEqual(path.read_bytes(), base64.b64decode(''.join(wrapped.split())))
+                self.assertEqual(digest, hashlib.sha256(data).hexdigest())
+
+
+class EmbeddedFileNameTest(unittest.TestCase):
+    def test_saved_under_the_name_find_resources_gives(self):
+        encoded = base64.b64encode(b"%PDF-1.4").decode('ascii')
+        page = (f'<object data-attachment="scan" type="application/pdf" data="data:application/pdf;base64,{encoded}"/>'
+                f'<object data-attachment="scan.pdf" type="application/pdf" data="data:application/pdf;base64,{encoded}"/>')
+        exporter = OneNoteExporter()
+        resources = exporter.find_resources(page)
+        self.assertEqual([resource['filename'] for resource in resources], ["scan.pdf", "scan (2).pdf"])
+
+        with tempfile.TemporaryDirectory() as folder:
+            for resource in resources:
+                path, _ = exporter.save_base64_attachment(page, resource['filename'], Path(folder), *resource['data'])
+                # The exports link attachments by this name
+                self.assertEqual(path, Path(folder) / resource['filename'])
+                self.assertEqual(path.read_bytes(), b"%PDF-1.4")
+
+
+class EnmlTest(unittest.TestCase):
+    def test_page_becomes_well_formed_enml(self):
+        page = ('<html><head><title>Page</title></head><body data-id="body">'
+                '<p id="p1" style="color:red" onclick="x()">Tom &amp; Jerry <img src="a.png"> a]]>b<br></p>'
+                '<script>alert(1)</script></body></html>')
+        content = EnexWriter.enml(page)
+        self.assertEqual(content, '<p style="color:red">Tom &amp; Jerry  a]]&gt;b<br/></p>')
+        ElementTree.fromstring(f"<en-note>{content}</en-note>")
+
+
+class PageCacheTest(unittest.TestCase):
+    def test_page_is_served_while_unmodified(self):
+        page = {'id': '0-abc!1-def', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}
+        with tempfile.TemporaryDirectory() as folder:
+            cache = PageCache(folder)
+            self.assertIsNone(cache.get(page))
+            cache.put(page, "<p>cached</p>")
+            cache.save()
+
+            cache = PageCache(folder)
+            self.assertEqual(cache.get(page), "<p>cached</p>")
+            self.assertIsNone(cache.get(dict(page, lastModifiedDateTime='2026-02-01T00:00:00Z')))
+            self.assertIsNone(cache.get({'id': '0-other', 'lastModifiedDateTime': '2026-01-01T00:00:00Z'}))
+
+    def test_inventory_round_trip(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = PageCache(folder)
+            self.assertIsNone(cache.load_inventory())
+            notebooks = [{'id': 'nb', 'displayName': 'Work', 'sections': []}]
+            cache.save_inventory(notebooks)
+            self.assertEqual(PageCache(folder).load_inventory(), notebooks)
+
+
+if __name__ == "__main__":
+    unittest.main()